@@ -4,6 +4,8 @@ import matplotlib.style as style
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import yaml
 from scipy.optimize import minimize
+from scipy.linalg import lu_factor, lu_solve
+import functools
 
 from qick import *
 from qick.helpers import gauss
@@ -51,6 +53,20 @@ def phase_to_other_drive(phase):
     """
     return phase
 
+"""
+Normalize the confusion matrix (rows: prep states) and factor its transpose for solving C_noisy = M . C_id:
+LU factorization if square, otherwise the pseudo-inverse. Cached by the matrix contents so repeated corrections
+with the same calibration counts reuse one factorization.
+"""
+@functools.lru_cache(maxsize=16)
+def factor_conf_mat(conf_mat_bytes, shape):
+    conf_mat = np.frombuffer(conf_mat_bytes, dtype=float).reshape(shape).copy()
+    conf_mat /= np.sum(conf_mat, axis=1, keepdims=True) # normalize so counts for each state prep sum to 1
+    conf_mat = np.transpose(conf_mat) # want counts for each state prep on columns
+    assert np.all(np.isfinite(conf_mat)), 'confusion matrix has non-finite entries' # checked once here instead of in every lu_solve
+    if shape[0] == shape[1]: return 'lu', lu_factor(conf_mat, check_finite=False)
+    return 'pinv', np.linalg.pinv(conf_mat)
+
 class TomoAnalysis(): 
 
     basis_list = ['Z', 'X', 'Y']
@@ -140,31 +156,16 @@ class TomoAnalysis():
     shots_q should be shape (nb_qubits, reps)
     """
     def sort_counts(self, shots_q):
-        counts = []
         shots_q = np.array(shots_q)
         assert shots_q.shape[0] == self.nb_qubits # should be num tomo qubits, reps (0/1)
         assert len(shots_q.shape) == 2
-        qcounts_e = shots_q
-        qcounts_g = np.logical_not(qcounts_e)
-        qcounts = np.array([qcounts_g, qcounts_e]) # shape: 2, num tomo qubits, reps (0/1)
-        for q1_state in (0, 1):
-            if self.nb_qubits == 1:
-                counts.append(np.sum(qcounts[q1_state, 0]))
-                continue
-
-            assert self.nb_qubits > 1
-            for q2_state in (0, 1):
-                and_q1q2_counts = np.logical_and(qcounts[q1_state, 0], qcounts[q2_state, 1])
-                if self.nb_qubits == 2:
-                    counts.append(np.sum(and_q1q2_counts))
-                    continue
-
-                assert self.nb_qubits == 3, 'sort counts only implemented up to 3 qubits'
-                for q3_state in (0, 1):
-                    and_q1q2q3_counts = np.logical_and(and_q1q2_counts, qcounts[q3_state, 2])
-                    counts.append(np.sum(and_q1q2q3_counts))
-
-        return np.array(counts)
+        assert self.nb_qubits <= 3, 'sort counts only implemented up to 3 qubits'
+        # pack the 0/1 shots of all qubits into one index per shot, first qubit as the most significant bit,
+        # so the counts come out in the order g..g, g..e, ..., e..e
+        idx = np.zeros(shots_q.shape[1], dtype=np.uint8)
+        for q_shots in shots_q.astype(np.uint8):
+            idx = (idx << 1) | q_shots
+        return np.bincount(idx, minlength=2**self.nb_qubits)
 
     """
     Get the sorted raw counts for each prep state given raw iq data and apply post selection if
@@ -368,32 +369,25 @@ class TomoAnalysis():
     """
     See qiskit measurement error mitigation procedure: [https://qiskit.org/textbook/ch-quantum-hardware/measurement-error-mitigation.html](https://qiskit.org/textbook/ch-quantum-hardware/measurement-error-mitigation.html)
     """
-    def correct_readout_err_legacy(self, n, n_conf):
+    def correct_readout_err_legacy(self, n, n_conf, round_output=False):
         n = np.array(n, dtype=float)
         conf_mat = np.array(n_conf, dtype=float)
         assert len(n.shape) == 2 # 2d array
         assert len(conf_mat.shape) == 2 # 2d array
-        old_sum = sum(n[0])
+        old_sum = np.sum(n[0])
         n_out_states = np.shape(conf_mat)[0] # number of possible states that we are correcting our counts into
-        for r, row in enumerate(conf_mat):
-            conf_mat[r] /= sum(row) # normalize so counts for each state prep sum to 1
-        conf_mat = np.transpose(conf_mat) # want counts for each state prep on columns
         # Check the determinant to make sure we are not running into machine precision
         # det = np.linalg.det(conf_mat)
         # print('DETERMINANT', det)
-        if np.shape(conf_mat)[0] == np.shape(conf_mat)[1]: # square matrix
-            conf_mat_inv = np.linalg.inv(conf_mat)
-        else: conf_mat_inv = np.linalg.pinv(conf_mat)
-        # print('conf mat transpose', conf_mat) 
-        # print('inv conf mat transpose', conf_mat_inv)
-        # C_id = invM . C_noisy
-        n = np.array(n, dtype=float)
-        out_n = np.zeros(shape=(np.shape(n)[0], n_out_states))
-        for r in range(np.shape(n)[0]): # correct each set of measurements (rows of n)
-            # print('n[r]', r, n[r])
-            out_n[r] = (conf_mat_inv @ n[r].T).T
-            out_n[r] *= old_sum/sum(n[r]) # scale so total counts in each row of out_n is same as total counts in each row of n
-        return np.around(out_n, decimals=5)
+        # C_noisy = M . C_id: solve for C_id for all sets of measurements (rows of n) at once instead of forming invM
+        factor_type, conf_mat_factor = factor_conf_mat(conf_mat.tobytes(), conf_mat.shape)
+        if factor_type == 'lu': # square matrix
+            out_n = lu_solve(conf_mat_factor, n.T, check_finite=False).T
+        else: out_n = (conf_mat_factor @ n.T).T
+        assert np.shape(out_n)[1] == n_out_states
+        out_n *= old_sum/np.sum(n, axis=1, keepdims=True) # scale so total counts in each row of out_n is same as total counts in each row of n
+        if round_output: np.around(out_n, decimals=5, out=out_n)
+        return out_n
     
     
     """
@@ -469,20 +463,38 @@ class TomoAnalysis():
 
     #     return n_corrected.T
 
-    def correct_readout_err(self, n, n_conf, verbose=False, method='SLSQP'):
+    def correct_readout_err(self, n, n_conf, verbose=False, method='SLSQP', tensored=False, tensored_tol=1e-2):
 
         n = np.array(n ,dtype=float)
         conf_mat = np.array(n_conf, dtype=float)
 
         # normalize the conf_mat
-        for r, row in enumerate(conf_mat):
-            conf_mat[r] /= sum(row)
+        conf_mat /= np.sum(conf_mat, axis=1, keepdims=True)
 
         # normalize the counts
-        if len(n.shape) == 1: n /= sum(n)
-        else:
-            for r, row in enumerate(n):
-                n[r] /= sum(row)
+        n /= np.sum(n, axis=-1, keepdims=True)
+
+        if tensored and np.shape(conf_mat) == (4, 4):
+            # if the readout errors are uncorrelated between the 2 qubits, conf_mat = conf_A (x) conf_B, and the correction
+            # only needs the inverses of the 2x2 confusion matrices of each qubit (estimated from the marginals of conf_mat)
+            conf_mat_4d = np.reshape(conf_mat, (2, 2, 2, 2)) # prep A, prep B, meas A, meas B
+            conf_A = np.average(np.sum(conf_mat_4d, axis=3), axis=1)
+            conf_B = np.average(np.sum(conf_mat_4d, axis=2), axis=0)
+            if np.allclose(np.kron(conf_A, conf_B), conf_mat, rtol=0, atol=tensored_tol):
+                if len(n.shape) == 1: n = np.reshape(n, (1, len(n)))
+                out_n = np.einsum('rij,ia,jb->rab', np.reshape(n, (-1, 2, 2)), np.linalg.inv(conf_A), np.linalg.inv(conf_B))
+                out_n = np.maximum(np.reshape(out_n, (-1, 4)), 0)
+                out_n /= np.sum(out_n, axis=1, keepdims=True)
+                return out_n
+            elif verbose: print('Confusion matrix is not a tensor product within tolerance, using full correction')
+
+        if method == 'pinv':
+            # unconstrained least squares for all rows at once with the pseudo-inverse of the confusion matrix,
+            # then clip negative populations and renormalize (does not enforce the constraints during the fit like SLSQP)
+            if len(n.shape) == 1: n = np.reshape(n, (1, len(n)))
+            out_n = np.maximum(n @ np.linalg.pinv(conf_mat), 0)
+            out_n /= np.sum(out_n, axis=1, keepdims=True)
+            return out_n
 
         # define the objective function
         def objective(x_flat, n, conf_mat):
@@ -547,19 +559,34 @@ class TomoAnalysis():
         return out_n
         # return n_corrected.T
 
+    """
+    Set negative counts (e.g. from the readout error correction) to 0 and rescale each row so its total
+    counts are unchanged. Vectorized over all rows, replaces the iterative redistribution of fix_neg_counts_legacy.
+    """
+    def fix_neg_counts(self, counts):
+        counts = np.array(counts, dtype=float)
+        assert len(counts.shape) == 2 # 2d array
+        if not np.any(counts < 0): return counts # nothing to fix, and rescaling would be a no-op
+        orig_sum = np.sum(counts, axis=1, keepdims=True)
+        assert np.all(orig_sum > 0), 'Negative sum of counts'
+        counts = np.maximum(counts, 0)
+        counts *= orig_sum/np.sum(counts, axis=1, keepdims=True)
+        return counts
+
     def fix_neg_counts_legacy(self, counts):
         counts = np.array(counts)
         assert len(counts.shape) == 2 # 2d array
 
-        for i_n, n in enumerate(counts):
-            orig_sum = sum(n)
+        for i_n in np.flatnonzero(np.any(counts < 0, axis=1)): # only rows with neg counts need to be fixed
+            n = counts[i_n]
+            orig_sum = np.sum(n)
             while len(n[n<0]) > 0: # repeat while still has neg counts
                 # print(i_n, n)
                 assert orig_sum > 0, 'Negative sum of counts'
                 most_neg_ind = np.argmin(n)
                 n += abs(n[most_neg_ind]) / (len(n) - 1)
                 n[most_neg_ind] = 0
-            n *= orig_sum/sum(n)
+            n *= orig_sum/np.sum(n)
         return counts
     
     # =========================== Cholesky-esque decomposition ====================================== #
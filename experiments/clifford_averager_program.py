@@ -1,4 +1,5 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import experiments.fitting as fitter
 import matplotlib.pyplot as plt
@@ -181,6 +182,68 @@ def ps_threshold_adjust(ps_thresholds_init, adjust, ge_avgs, angles):
     return ps_thresholds
 
 
+def expand_cfg(cfg, num_qubits_sample):
+    """
+    Expand entries in the device readout, device qubit, and hw soc configs that are
+    not lists (i.e. length 1) to fill all qubits, in place.
+    """
+    for subcfg in (cfg.device.readout, cfg.device.qubit, cfg.hw.soc):
+        for key, value in subcfg.items():
+            if isinstance(value, dict):
+                for key2, value2 in value.items():
+                    value2.update(
+                        {key3: [value3] * num_qubits_sample for key3, value3 in value2.items() if not isinstance(value3, list)}
+                    )
+            elif not (isinstance(value, list)):
+                subcfg.update({key: [value] * num_qubits_sample})
+
+
+def cfg_json_default(obj):
+    """
+    json.dumps default for keying caches on a cfg: numpy arrays/scalars are written out in full with tolist (str
+    truncates long arrays with ...), anything else falls back to str.
+    """
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+
+# single background worker for building the next program while the current one runs on the soc
+_prog_build_pool = ThreadPoolExecutor(max_workers=1)
+
+
+def prebuild_iter(build, keys):
+    """
+    Yield build(*key) for each key in order, building the next one in a background thread
+    while the caller uses the current one (e.g. while waiting on the soc to acquire it)
+    """
+    keys = list(keys)
+    if len(keys) == 0:
+        return
+    future = _prog_build_pool.submit(build, *keys[0])
+    for i in range(len(keys)):
+        result = future.result()
+        if i + 1 < len(keys):
+            future = _prog_build_pool.submit(build, *keys[i + 1])
+        yield result
+
+
+def display_axes(figs, name, nrows, figsize):
+    """
+    Returns the cleared axes of the figure stored as figs[name] by a previous display() call, or makes a new figure
+    (and stores it in figs) if there is none or it has been closed (e.g. by the inline backend at the end of a cell)
+    """
+    fig = figs.get(name)
+    if fig is None or not plt.fignum_exists(fig.number):
+        fig, _ = plt.subplots(nrows, 1, figsize=figsize)
+        figs[name] = fig
+    else:
+        plt.figure(fig.number)
+        for ax in fig.axes:
+            ax.clear()
+    return fig.axes
+
+
 """
 Averager program that takes care of the standard pulse loading for basic X, Y, Z +/- pi and pi/2
 """
@@ -1145,9 +1208,9 @@ class CliffordAveragerProgram(AveragerProgram):
     Returns avgi (idata), avgq (qdata) which avgi/q are avg over shot_avg
     """
 
-    def get_shots(self, angle=None, threshold=None, avg_shots=False, verbose=False):
+    def get_shots(self, angle=None, threshold=None, avg_shots=False, verbose=False, channels=None):
 
-        idata, qdata = self.get_multireadout_shots(angle=angle, threshold_final=threshold)
+        idata, qdata = self.get_multireadout_shots(angle=angle, threshold_final=threshold, channels=channels)
 
         idata = idata[:, -1, :]
         qdata = qdata[:, -1, :]
@@ -1156,13 +1219,22 @@ class CliffordAveragerProgram(AveragerProgram):
             qdata = np.average(qdata, axis=1)
         return idata, qdata
 
+    def get_threshold_shots(self, angle, threshold):
+        """
+        Final readout shots thresholded to 0/1 for all ro chs as a compact uint8 array, shape (ro_chs, reps)
+        """
+        assert threshold is not None
+        shots, _ = self.get_shots(angle=angle, threshold=threshold)
+        return shots.astype(np.uint8)
+
     """
     For all readouts, angle is applied if None; threshold_final is applied only to the last readout
     threshold_final should be specified for all qubits
     if avg_trigs is False, return as if each trig is a separate readout
+    channels: indices into ro_chs to process and return (default all), angle and threshold_final are still indexed by ro ch
     """
 
-    def get_multireadout_shots(self, angle=None, threshold_final=None, avg_trigs=True):
+    def get_multireadout_shots(self, angle=None, threshold_final=None, avg_trigs=True, channels=None):
         n_init_readout = self.cfg.expt.n_init_readout
         n_trig = self.cfg.expt.n_trig
         # print('n_init_readout', n_init_readout, 'n_trig', n_trig)
@@ -1173,24 +1245,30 @@ class CliffordAveragerProgram(AveragerProgram):
         if angle is None:
             angle = [0] * self.num_qubits_sample
 
-        di_buf = np.array([self.di_buf[i] / ro["length"] for i, (ch, ro) in enumerate(self.ro_chs.items())])
-        dq_buf = np.array([self.dq_buf[i] / ro["length"] for i, (ch, ro) in enumerate(self.ro_chs.items())])
-        for i, ch in enumerate(self.ro_chs):
-            idata_ch, qdata_ch = rotate_and_threshold(
-                ishots_1q=di_buf[i], qshots_1q=dq_buf[i], angle=angle[i], threshold=None, avg_shots=False
-            )
-            di_buf[i] = idata_ch
-            dq_buf[i] = qdata_ch
+        if channels is None:
+            channels = range(len(self.ro_chs))
+        n_chs = len(channels)
+
+        # only the requested channels' buffers are copied out and rotated
+        ro_lengths = [ro["length"] for ro in self.ro_chs.values()]
+        di_buf = np.array([self.di_buf[i] / ro_lengths[i] for i in channels])
+        dq_buf = np.array([self.dq_buf[i] / ro_lengths[i] for i in channels])
+        # rotate all channels at once (same as rotate_and_threshold per channel, an angle of None means no rotation)
+        angle_rad = np.array([0 if angle[i] is None else np.pi / 180 * angle[i] for i in channels], dtype=float)[
+            :, np.newaxis
+        ]
+        cos_angle, sin_angle = np.cos(angle_rad), np.sin(angle_rad)
+        di_buf, dq_buf = di_buf * cos_angle - dq_buf * sin_angle, di_buf * sin_angle + dq_buf * cos_angle
 
-        shots_i = di_buf.reshape((len(self.ro_chs), (1 + n_init_readout * n_trig) * self.cfg.expt.reps))
-        shots_q = dq_buf.reshape((len(self.ro_chs), (1 + n_init_readout * n_trig) * self.cfg.expt.reps))
+        shots_i = di_buf.reshape((n_chs, (1 + n_init_readout * n_trig) * self.cfg.expt.reps))
+        shots_q = dq_buf.reshape((n_chs, (1 + n_init_readout * n_trig) * self.cfg.expt.reps))
 
-        shots_reshaped_shape = (len(self.ro_chs), 1 + n_init_readout, self.cfg.expt.reps)
+        shots_reshaped_shape = (n_chs, 1 + n_init_readout, self.cfg.expt.reps)
         if not avg_trigs:
-            shots_reshaped_shape = (len(self.ro_chs), 1 + n_init_readout * n_trig, self.cfg.expt.reps)
+            shots_reshaped_shape = (n_chs, 1 + n_init_readout * n_trig, self.cfg.expt.reps)
         shots_i_reshaped = np.zeros(shots_reshaped_shape)
         shots_q_reshaped = np.zeros(shots_reshaped_shape)
-        for i in range(len(self.ro_chs)):
+        for i in range(n_chs):
             meas_per_expt = 1 + n_init_readout * n_trig
 
             # reshape + average over n_trig for the init readouts
@@ -1227,13 +1305,13 @@ class CliffordAveragerProgram(AveragerProgram):
             shots_q_reshaped[i, -1, :] = shots_q_final_read
 
         if threshold_final is not None:
-            for ch in range(len(self.ro_chs)):
-                shots_i_reshaped[ch, -1, :], _ = rotate_and_threshold(
-                    ishots_1q=shots_i_reshaped[ch, -1, :], threshold=threshold_final[ch]
-                )
+            # threshold the final readout of all channels at once (same as rotate_and_threshold per channel, a threshold of None means no thresholding)
+            chs = [i for i, ch in enumerate(channels) if threshold_final[ch] is not None]
+            thresholds = np.array([threshold_final[channels[i]] for i in chs], dtype=float)[:, np.newaxis]
+            shots_i_reshaped[chs, -1, :] = np.heaviside(shots_i_reshaped[chs, -1, :] - thresholds, 0)
 
-        # final shape: (ro_chs, n_init_readout + 1, reps)
-        # or if not avg_trigs: (ro_chs, n_init_readout*n_trig + 1, reps)
+        # final shape: (len(channels), n_init_readout + 1, reps)
+        # or if not avg_trigs: (len(channels), n_init_readout*n_trig + 1, reps)
         return shots_i_reshaped, shots_q_reshaped
 
     def acquire(self, soc, load_pulses=True, progress=False, save_experiments=None):
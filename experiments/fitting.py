@@ -91,7 +91,14 @@ def get_best_fit(
 
 def expfunc(x, *p):
     y0, yscale, x0, decay = p
-    return y0 + yscale * np.exp(-(x - x0) / decay)
+    # evaluated in place in a single buffer (curve_fit calls this every iteration)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.subtract(x0, x, out=np.empty_like(x))
+    y /= decay
+    np.exp(y, out=y)
+    y *= yscale
+    y += y0
+    return y
 
 
 def fitexp(xdata, ydata, fitparams=None):
@@ -452,7 +459,36 @@ def fitquadratic(xdata, ydata, fitparams=None):
 
 def decaysin(x, *p):
     yscale, freq, phase_deg, decay, y0 = p
-    return yscale * np.sin(2 * np.pi * freq * x + phase_deg * np.pi / 180) * np.exp(-x / decay) + y0
+    # evaluated in place in two buffers (curve_fit calls this every iteration)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.multiply(x, 2 * np.pi * freq, out=np.empty_like(x))
+    y += phase_deg * np.pi / 180
+    np.sin(y, out=y)
+    env = np.divide(x, -decay, out=np.empty_like(x))
+    np.exp(env, out=env)
+    y *= env
+    y *= yscale
+    y += y0
+    return y
+
+
+def decaysin_jac(x, *p):
+    """
+    Analytic jacobian of decaysin wrt (yscale, freq, phase_deg, decay, y0), shape (len(x), 5)
+    """
+    yscale, freq, phase_deg, decay, y0 = p
+    x = np.asarray(x, dtype=np.float64)
+    theta = 2 * np.pi * freq * x + phase_deg * np.pi / 180
+    env = np.exp(-x / decay)
+    sin_env = np.sin(theta) * env
+    cos_env = yscale * np.cos(theta) * env
+    jac = np.empty((len(x), 5))
+    jac[:, 0] = sin_env
+    jac[:, 1] = cos_env * 2 * np.pi * x
+    jac[:, 2] = cos_env * np.pi / 180
+    jac[:, 3] = yscale * sin_env * x / decay**2
+    jac[:, 4] = 1
+    return jac
 
 
 def fitdecaysin(xdata, ydata, fitparams=None):
@@ -493,7 +529,9 @@ def fitdecaysin(xdata, ydata, fitparams=None):
     pOpt = fitparams
     pCov = np.full(shape=(len(fitparams), len(fitparams)), fill_value=np.inf)
     try:
-        pOpt, pCov = sp.optimize.curve_fit(decaysin, xdata, ydata, p0=fitparams, bounds=bounds)
+        pOpt, pCov = sp.optimize.curve_fit(
+            decaysin, xdata, ydata, p0=fitparams, bounds=bounds, jac=decaysin_jac, check_finite=False
+        )
         # return pOpt, pCov
     except RuntimeError:
         print("Warning: fit failed!")
@@ -506,10 +544,49 @@ def fitdecaysin(xdata, ydata, fitparams=None):
 
 def twofreq_decaysin(x, *p):
     yscale0, freq0, phase_deg0, decay0, yscale1, freq1, phase_deg1, y0 = p
-    return y0 + np.exp(-x / decay0) * yscale0 * (
-        (1 - yscale1) * np.sin(2 * np.pi * freq0 * x + phase_deg0 * np.pi / 180)
-        + yscale1 * np.sin(2 * np.pi * freq1 * x + phase_deg1 * np.pi / 180)
-    )
+    # evaluated in place in two buffers, like decaysin
+    x = np.asarray(x, dtype=np.float64)
+    y = np.multiply(x, 2 * np.pi * freq0, out=np.empty_like(x))
+    y += phase_deg0 * np.pi / 180
+    np.sin(y, out=y)
+    y *= 1 - yscale1
+    tmp = np.multiply(x, 2 * np.pi * freq1, out=np.empty_like(x))
+    tmp += phase_deg1 * np.pi / 180
+    np.sin(tmp, out=tmp)
+    tmp *= yscale1
+    y += tmp
+    np.divide(x, -decay0, out=tmp)
+    np.exp(tmp, out=tmp)
+    y *= tmp
+    y *= yscale0
+    y += y0
+    return y
+
+
+def twofreq_decaysin_jac(x, *p):
+    """
+    Analytic jacobian of twofreq_decaysin wrt (yscale0, freq0, phase_deg0, decay0, yscale1, freq1, phase_deg1, y0),
+    shape (len(x), 8)
+    """
+    yscale0, freq0, phase_deg0, decay0, yscale1, freq1, phase_deg1, y0 = p
+    x = np.asarray(x, dtype=np.float64)
+    theta0 = 2 * np.pi * freq0 * x + phase_deg0 * np.pi / 180
+    theta1 = 2 * np.pi * freq1 * x + phase_deg1 * np.pi / 180
+    env = np.exp(-x / decay0)
+    sin0, sin1 = np.sin(theta0), np.sin(theta1)
+    osc = (1 - yscale1) * sin0 + yscale1 * sin1
+    cos0_env = yscale0 * (1 - yscale1) * np.cos(theta0) * env
+    cos1_env = yscale0 * yscale1 * np.cos(theta1) * env
+    jac = np.empty((len(x), 8))
+    jac[:, 0] = env * osc
+    jac[:, 1] = cos0_env * 2 * np.pi * x
+    jac[:, 2] = cos0_env * np.pi / 180
+    jac[:, 3] = yscale0 * env * osc * x / decay0**2
+    jac[:, 4] = yscale0 * env * (sin1 - sin0)
+    jac[:, 5] = cos1_env * 2 * np.pi * x
+    jac[:, 6] = cos1_env * np.pi / 180
+    jac[:, 7] = 1
+    return jac
 
 
 def fittwofreq_decaysin(xdata, ydata, fitparams=None):
@@ -565,7 +642,9 @@ def fittwofreq_decaysin(xdata, ydata, fitparams=None):
     pOpt = fitparams
     pCov = np.full(shape=(len(fitparams), len(fitparams)), fill_value=np.inf)
     try:
-        pOpt, pCov = sp.optimize.curve_fit(twofreq_decaysin, xdata, ydata, p0=fitparams, bounds=bounds)
+        pOpt, pCov = sp.optimize.curve_fit(
+            twofreq_decaysin, xdata, ydata, p0=fitparams, bounds=bounds, jac=twofreq_decaysin_jac, check_finite=False
+        )
         # return pOpt, pCov
     except RuntimeError:
         print("Warning: fit failed!")
@@ -792,7 +871,10 @@ def rb_gate_fidelity(p_rb, p_irb, d, p_rb_err=None, p_irb_err=None):
     return fid
 
 
-def fitrb(xdata, ydata, fitparams=None):
+def fitrb(xdata, ydata, fitparams=None, **kwargs):
+    """
+    kwargs (e.g. sigma, absolute_sigma) are passed to curve_fit
+    """
     if fitparams is None:
         fitparams = [None] * 3
     else:
@@ -813,7 +895,7 @@ def fitrb(xdata, ydata, fitparams=None):
     pOpt = fitparams
     pCov = np.full(shape=(len(fitparams), len(fitparams)), fill_value=np.inf)
     try:
-        pOpt, pCov = sp.optimize.curve_fit(rb_func, xdata, ydata, p0=fitparams, bounds=bounds)
+        pOpt, pCov = sp.optimize.curve_fit(rb_func, xdata, ydata, p0=fitparams, bounds=bounds, **kwargs)
         # print(pOpt)
         # print(pCov[0][0], pCov[1][1], pCov[2][2])
         # return pOpt, pCov
@@ -891,6 +973,65 @@ def fitrb_l1_l2(xdata, ydata, p1, offset, fitparams=None):
     return pOpt, pCov
 
 
+def fitrb_l1_l2_joint(xdata, ydata_subspace, ydata_eg, fitparams=None):
+    """
+    Fit the subspace population (rb_func with p1, a, offset) and the g state population in the
+    subspace (rb_decay_l1_l2) at the same time, sharing p1 between the two decays instead of
+    fixing it from a separate fit first.
+    fitparams: [p1, a, offset, a0, b0, c0, p2]
+    """
+    xdata = np.asarray(xdata)
+    ydata_subspace = np.asarray(ydata_subspace)
+    if fitparams is None:
+        fitparams = [None] * 7
+    else:
+        fitparams = np.copy(fitparams)
+    if fitparams[0] is None:
+        fitparams[0] = 0.9  # p1
+    if fitparams[1] is None:
+        fitparams[1] = np.max(ydata_subspace) - np.min(ydata_subspace)  # a
+    if fitparams[2] is None:
+        fitparams[2] = np.min(ydata_subspace)  # offset
+    if fitparams[3] is None:
+        fitparams[3] = 0.5 * fitparams[2]  # a0
+    if fitparams[4] is None:
+        fitparams[4] = 0.5  # b0
+    if fitparams[5] is None:
+        fitparams[5] = 0.5  # c0
+    if fitparams[6] is None:
+        fitparams[6] = 0.9  # p2
+    bounds = (
+        [0, 0, 0, 0, 0, 0, 0],
+        [1, 10 * np.max(ydata_subspace) - np.min(ydata_subspace), np.max(ydata_subspace), 1, 1, 1, 1],
+    )
+    for i, param in enumerate(fitparams):
+        if not (bounds[0][i] < param < bounds[1][i]):
+            fitparams[i] = np.mean((bounds[0][i], bounds[1][i]))
+            print(
+                f"Attempted to init fitparam {i} to {param}, which is out of bounds {bounds[0][i]} to {bounds[1][i]}. Instead init to {fitparams[i]}"
+            )
+    n = len(xdata)
+
+    def joint_func(depth, p1, a, offset, a0, b0, c0, p2):
+        return np.concatenate(
+            (rb_func(depth[:n], p1, a, offset), rb_decay_l1_l2(depth[n:], p1, a0, b0, c0, p2))
+        )
+
+    pOpt = fitparams
+    pCov = np.full(shape=(len(fitparams), len(fitparams)), fill_value=np.inf)
+    try:
+        pOpt, pCov = sp.optimize.curve_fit(
+            joint_func,
+            np.concatenate((xdata, xdata)),
+            np.concatenate((ydata_subspace, ydata_eg)),
+            p0=fitparams,
+            bounds=bounds,
+        )
+    except RuntimeError:
+        print("Warning: fit failed!")
+    return pOpt, pCov
+
+
 # ====================================================== #
 # Adiabatic pi pulse functions
 # beta ~ slope of the frequency sweep (also adjusts width)
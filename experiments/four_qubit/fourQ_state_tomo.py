@@ -11,20 +11,12 @@ from experiments.clifford_averager_program import QutritAveragerProgram, Cliffor
 from experiments.single_qubit.single_shot import hist
 
 def sort_counts_4q(shotsA, shotsB, shotsC, shotsD):
-    # data is returned as n0000, n0001, ..., n1111 measured for the 4 qubits
-    counts = []
-    qcounts_e = [shotsA, shotsB, shotsC, shotsD]
-    qcounts_g = np.logical_not(qcounts_e)
-    qcounts = [qcounts_g, qcounts_e]
-    for q1_state in (0, 1):
-        for q2_state in (0, 1):
-            for q3_state in (0, 1):
-                for q4_state in (0, 1):
-                    and_counts = np.logical_and(qcounts[q1_state][0], qcounts[q2_state][1])
-                    and_counts = np.logical_and(and_counts, qcounts[q3_state][2])
-                    and_counts = np.logical_and(and_counts, qcounts[q4_state][3])
-                    counts.append(np.sum(and_counts))
-    return np.array(counts)
+    # data is returned as n0000, n0001, ... measured for the 4 qubits
+    # pack the 0/1 shots into one index per shot (first qubit as the most significant bit) and count each index once
+    idx = np.zeros(len(shotsA), dtype=np.uint8)
+    for shots in (shotsA, shotsB, shotsC, shotsD):
+        idx = (idx << 1) | np.asarray(shots).astype(np.uint8)
+    return np.bincount(idx, minlength=16)
 
 def make_4q_meas_order():
     meas_order = []
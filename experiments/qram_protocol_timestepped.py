@@ -78,11 +78,11 @@ class QramProtocolProgram(AbstractStateTomo2QProgram):
 
         # get aliases for the sigmas we need in clock cycles
         self.pi_EgGf_types = self.cfg.device.qubit.pulses.pi_EgGf.type
-        assert all(type == "flat_top" for type in self.pi_EgGf_types)
+        assert np.all(np.asarray(self.pi_EgGf_types) == "flat_top")
         self.pi_EgGf_sigmas_us = self.cfg.device.qubit.pulses.pi_EgGf.sigma
 
         self.pi_EgGf_Q_types = self.cfg.device.qubit.pulses.pi_EgGf_Q.type
-        assert all(type == "flat_top" for type in self.pi_EgGf_Q_types)
+        assert np.all(np.asarray(self.pi_EgGf_Q_types) == "flat_top")
         self.pi_EgGf_Q_sigmas_us = self.cfg.device.qubit.pulses.pi_EgGf_Q.sigma
 
         # update timestep in outer loop over averager program
@@ -248,7 +248,7 @@ class QramProtocolProgram(AbstractStateTomo2QProgram):
 
         avgi, avgq = self.get_shots(angle=angle)
         # collect shots for all adcs, then sorts into e, g based on >/< threshold and angle rotation
-        shots = np.array([np.heaviside(avgi[i] - threshold[i], 0) for i in range(len(self.adc_chs))])
+        shots = np.heaviside(avgi - np.asarray(threshold, dtype=float)[: len(self.adc_chs), np.newaxis], 0)
 
         assert self.cfg.expt.tomo_qubits is not None
         qA, qB = self.cfg.expt.tomo_qubits
@@ -1,8 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 import experiments.fitting as fitter
 import matplotlib.pyplot as plt
 import numpy as np
+from experiments.clifford_averager_program import display_axes, expand_cfg
 from experiments.single_qubit.single_shot import hist
 from experiments.two_qubit.twoQ_state_tomography import (
     ErrorMitigationStateTomo1QProgram,
@@ -11,7 +13,7 @@ from qick import *
 from qick.helpers import gauss
 from slab import AttrDict, Experiment, dsfit
 from TomoAnalysis import TomoAnalysis
-from tqdm import tqdm_notebook as tqdm
+from tqdm.auto import tqdm
 
 """
 Measures Rabi oscillations by sweeping over the duration of the qubit drive pulse. This is a preliminary measurement to prove that we see Rabi oscillations. This measurement is followed up by the Amplitude Rabi experiment.
@@ -19,6 +21,10 @@ Measures Rabi oscillations by sweeping over the duration of the qubit drive puls
 
 
 class LengthRabiProgram(AveragerProgram):
+    # the length sweep rebuilds this program at every point; unit conversions only depend on the soccfg and their
+    # inputs, so share them across rebuilds. Keyed by id(soccfg), holding a reference so the id can't be reused.
+    _conversion_cache = {}
+
     def __init__(self, soccfg, cfg):
         self.cfg = AttrDict(cfg)
         self.cfg.update(self.cfg.expt)
@@ -45,12 +51,22 @@ class LengthRabiProgram(AveragerProgram):
                 )
         self.sync_all(10)
 
+    def cached_conversion(self, method, value, **kwargs):
+        """
+        method: name of the conversion method ("us2cycles", "freq2reg", "deg2reg", ...)
+        """
+        _, cache = LengthRabiProgram._conversion_cache.setdefault(id(self.soccfg), (self.soccfg, dict()))
+        key = (method, value, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = getattr(self, method)(value, **kwargs)
+        return cache[key]
+
     def set_gen_delays(self):
         for ch in self.gen_chs:
             delay_ns = self.cfg.hw.soc.dacs.delay_chs.delay_ns[
                 np.argwhere(np.array(self.cfg.hw.soc.dacs.delay_chs.ch) == ch)[0][0]
             ]
-            delay_cycles = self.us2cycles(delay_ns * 1e-3, gen_ch=ch)
+            delay_cycles = self.cached_conversion("us2cycles", delay_ns * 1e-3, gen_ch=ch)
             self.gen_delays[ch] = delay_cycles
 
     def sync_all(self, t=0):
@@ -100,17 +116,17 @@ class LengthRabiProgram(AveragerProgram):
         self.pi_ef_half_gain_pi_sigmas = np.reshape(self.cfg.device.qubit.pulses.pi_ef.half_gain_pi_sigma, (4, 4))
 
         self.f_res_regs = [
-            self.freq2reg(f, gen_ch=gen_ch, ro_ch=adc_ch)
+            self.cached_conversion("freq2reg", f, gen_ch=gen_ch, ro_ch=adc_ch)
             for f, gen_ch, adc_ch in zip(cfg.device.readout.frequency, self.res_chs, self.adc_chs)
         ]
         if "cool_qubits" in self.cfg.expt and self.cfg.expt.cool_qubits is not None:
             self.f_f0g1_regs = [self.freq2reg(f, gen_ch=ch) for f, ch in zip(cfg.device.qubit.f_f0g1, self.qubit_chs)]
         self.readout_lengths_dac = [
-            self.us2cycles(length, gen_ch=gen_ch)
+            self.cached_conversion("us2cycles", length, gen_ch=gen_ch)
             for length, gen_ch in zip(self.cfg.device.readout.readout_length, self.res_chs)
         ]
         self.readout_lengths_adc = [
-            self.us2cycles(length, ro_ch=ro_ch)
+            self.cached_conversion("us2cycles", length, ro_ch=ro_ch)
             for length, ro_ch in zip(self.cfg.device.readout.readout_length, self.adc_chs)
         ]
 
@@ -154,8 +170,8 @@ class LengthRabiProgram(AveragerProgram):
                 ro_ch=mux_ro_ch,
             )
 
-        # declare adcs - readout for all qubits everytime, defines number of buffers returned regardless of number of adcs triggered
         for q in range(self.num_qubits_sample):
+            # declare adcs - readout for all qubits everytime, defines number of buffers returned regardless of number of adcs triggered
             if self.adc_chs[q] not in self.ro_chs:
                 self.declare_readout(
                     ch=self.adc_chs[q],
@@ -164,8 +180,7 @@ class LengthRabiProgram(AveragerProgram):
                     gen_ch=self.res_chs[q],
                 )
 
-        # declare qubit dacs
-        for q in range(self.num_qubits_sample):
+            # declare qubit dacs
             mixer_freq = None
             if self.qubit_ch_types[q] == "int4":
                 mixer_freq = cfg.hw.soc.dacs.qubit.mixer_freq[q]
@@ -189,10 +204,10 @@ class LengthRabiProgram(AveragerProgram):
                     )
 
         # define pisigma_ge as the ge pulse for the qubit that we are calibrating the pulse on (mostly for use for preparation if we need to calibrate ef)
-        self.pisigma_ge = self.us2cycles(
-            self.pi_ge_sigmas[qTest, qZZ], gen_ch=self.qubit_chs[qTest]
+        self.pisigma_ge = self.cached_conversion(
+            "us2cycles", self.pi_ge_sigmas[qTest, qZZ], gen_ch=self.qubit_chs[qTest]
         )  # default pi_ge value
-        self.f_ge_init_reg = self.freq2reg(self.f_ges[qTest, qZZ], gen_ch=self.qubit_chs[qTest])
+        self.f_ge_init_reg = self.cached_conversion("freq2reg", self.f_ges[qTest, qZZ], gen_ch=self.qubit_chs[qTest])
         self.gain_ge_init = (
             self.pi_ge_gains[qTest, qZZ] if self.pi_ge_gains[qTest, qZZ] > 0 else self.pi_ge_gains[qTest, qTest]
         )  # this contingency is possible if the ge pulse is not calibrated but we want to calibrate the EF pulse for a specific ZZ configuration
@@ -213,9 +228,11 @@ class LengthRabiProgram(AveragerProgram):
                 )
         else:
             self.gain_pi_test = self.cfg.expt.gain
-        self.f_pi_test_reg = self.freq2reg(self.f_ges[qTest, qZZ], gen_ch=self.qubit_chs[qTest])
+        self.f_pi_test_reg = self.cached_conversion("freq2reg", self.f_ges[qTest, qZZ], gen_ch=self.qubit_chs[qTest])
         if self.checkEF:
-            self.f_pi_test_reg = self.freq2reg(self.f_efs[qTest, qZZ], gen_ch=self.qubit_chs[qTest])
+            self.f_pi_test_reg = self.cached_conversion(
+                "freq2reg", self.f_efs[qTest, qZZ], gen_ch=self.qubit_chs[qTest]
+            )
 
         # calibrate the pi/2 pulse instead of the pi pulse by taking half the sigma and calibrating the gain
         self.test_pi_half = False
@@ -325,11 +342,16 @@ class LengthRabiProgram(AveragerProgram):
 
         self.qTest_rphase = self.sreg(self.qubit_chs[qTest], "phase")
 
+        # readout timing used by body
+        self.trig_offset = cfg.device.readout.trig_offset[qTest]
+        self.relax_delay_cycles = self.cached_conversion(
+            "us2cycles", max([cfg.device.readout.relax_delay[q] for q in range(4)])
+        )
+
         self.set_gen_delays()
         self.sync_all(200)
 
     def body(self):
-        cfg = AttrDict(self.cfg)
         qTest = self.cfg.expt.qTest
         qZZ = self.cfg.expt.qZZ
         if qZZ is None:
@@ -432,6 +454,8 @@ class LengthRabiProgram(AveragerProgram):
             assert "delay_error_amp" in self.cfg.expt
 
         # play pi pulse that we want to calibrate
+        # (this branch is resolved in python while generating the program, so a zero length point already compiles to
+        # tProc code with no test pulse - no runtime branch is emitted)
         if self.pi_test_sigma > 0:
             if self.error_amp:
                 assert "n_pulses" in self.cfg.expt and self.cfg.expt.n_pulses is not None
@@ -482,7 +506,9 @@ class LengthRabiProgram(AveragerProgram):
                         num_test_pulses = 2
 
                     self.safe_regwi(
-                        self.q_rps[qTest], self.qTest_rphase, self.deg2reg(phase, gen_ch=self.qubit_chs[qTest])
+                        self.q_rps[qTest],
+                        self.qTest_rphase,
+                        self.cached_conversion("deg2reg", phase, gen_ch=self.qubit_chs[qTest]),
                     )
                     for j in range(num_test_pulses):
                         # print("phase", phase)
@@ -546,9 +572,9 @@ class LengthRabiProgram(AveragerProgram):
         self.measure(
             pulse_ch=self.measure_chs,
             adcs=self.adc_chs,
-            adc_trig_offset=cfg.device.readout.trig_offset[qTest],
+            adc_trig_offset=self.trig_offset,
             wait=True,
-            syncdelay=self.us2cycles(max([cfg.device.readout.relax_delay[q] for q in range(4)])),
+            syncdelay=self.relax_delay_cycles,
         )
 
     """ Collect shots for all adcs, rotates by given angle (degrees), separate based on threshold (if not None), and averages over all shots (i.e. returns data[num_chs, 1] as opposed to data[num_chs, num_shots]) if requested.
@@ -576,7 +602,7 @@ class LengthRabiProgram(AveragerProgram):
         )
         bufi = np.array([bufi[i] / ro["length"] for i, (ch, ro) in enumerate(self.ro_chs.items())])
         if threshold is not None:  # categorize single shots
-            bufi = np.array([np.heaviside(bufi[ch] - threshold[ch], 0) for ch in range(len(self.adc_chs))])
+            bufi = np.heaviside(bufi - np.asarray(threshold, dtype=float)[: len(self.adc_chs), np.newaxis], 0)
         avgi = np.average(bufi, axis=1)  # [num_chs]
         bufi_err = np.std(bufi, axis=1) / np.sqrt(buf_len)  # [num_chs]
         if verbose:
@@ -702,19 +728,16 @@ class LengthRabiExperiment(Experiment):
             config_file=config_file,
             progress=progress,
         )
-
-    def acquire(self, progress=False):
+        self._display_figs = dict()  # figures reused across display() calls while they are still open
+
+    def acquire(self, progress=False, live_fit_every=None):
+        """
+        live_fit_every: if not None, every live_fit_every points fit the amplitudes acquired so far in a background
+        thread while the sweep keeps acquiring. The latest (p, pCov) is kept in self.live_fit for monitoring long
+        sweeps; the fits from analyze() remain the authoritative result.
+        """
         # expand entries in config that are length 1 to fill all qubits
-        num_qubits_sample = len(self.cfg.device.readout.frequency)
-        for subcfg in (self.cfg.device.readout, self.cfg.device.qubit, self.cfg.hw.soc):
-            for key, value in subcfg.items():
-                if isinstance(value, dict):
-                    for key2, value2 in value.items():
-                        for key3, value3 in value2.items():
-                            if not (isinstance(value3, list)):
-                                value2.update({key3: [value3] * num_qubits_sample})
-                elif not (isinstance(value, list)):
-                    subcfg.update({key: [value] * num_qubits_sample})
+        expand_cfg(self.cfg, len(self.cfg.device.readout.frequency))
 
         qTest = self.cfg.expt.qTest
         qZZ = self.cfg.expt.qZZ
@@ -729,16 +752,33 @@ class LengthRabiExperiment(Experiment):
             f'Running length rabi {"EF " if self.cfg.expt.checkEF else ""}on Q{qTest} {"with ZZ Q" + str(qZZ) if self.checkZZ else ""}'
         )
 
-        lengths = self.cfg.expt["start"] + self.cfg.expt["step"] * np.arange(self.cfg.expt["expts"])
+        start, step, expts = self.cfg.expt["start"], self.cfg.expt["step"], self.cfg.expt["expts"]
+        lengths = np.linspace(start, start + step * (expts - 1), expts, dtype=np.float64)
 
-        data = {"xpts": [], "avgi": [], "avgq": [], "amps": [], "phases": []}
+        # averaged readouts have far less than float32 precision; analyze() upcasts to float64 for the fits
+        data = {k: np.empty(expts, dtype=np.float32) for k in ("avgi", "avgq", "amps", "phases")}
+        data["xpts"] = lengths
 
-        for length in tqdm(lengths, disable=not progress):
+        self.live_fit = None
+        live_fit_pool = ThreadPoolExecutor(max_workers=1) if live_fit_every else None
+        live_fit_future = None
+
+        prev_env_cycles = None
+        # bound progress bar redraws to ~2 Hz so they don't eat into fast sweeps
+        for i, length in enumerate(
+            tqdm(lengths, disable=not progress, mininterval=0.5, miniters=max(1, len(lengths) // 200))
+        ):
             self.cfg.expt.sigma_test = float(length)
             lengthrabi = LengthRabiProgram(soccfg=self.soccfg, cfg=self.cfg)
             self.prog = lengthrabi
             self.cfg.expt.gain = self.prog.gain_pi_test
 
+            # gaussian envelopes are fixed per sigma, so the sweep can't live in a tProc register; instead only
+            # re-upload envelopes when this point rounds to different cycle counts than the previous one
+            env_cycles = (lengthrabi.pi_test_sigma, getattr(lengthrabi, "pi_test_half_sigma", None))
+            load_pulses = env_cycles != prev_env_cycles
+            prev_env_cycles = env_cycles
+
             # print('\n\n', length)
             # from qick.helpers import progs2json
             # print(progs2json([self.prog.dump_prog()]))
@@ -746,27 +786,40 @@ class LengthRabiExperiment(Experiment):
             avgi, avgq = lengthrabi.acquire(
                 self.im[self.cfg.aliases.soc],
                 threshold=None,
-                load_pulses=True,
+                load_pulses=load_pulses,
                 progress=False,
             )
-            avgi = avgi[qTest][0]
-            avgq = avgq[qTest][0]
-            amp = np.abs(avgi + 1j * avgq)  # Calculating the magnitude
-            phase = np.angle(avgi + 1j * avgq)  # Calculating the phase
-            data["xpts"].append(length)
-            data["avgi"].append(avgi)
-            data["avgq"].append(avgq)
-            data["amps"].append(amp)
-            data["phases"].append(phase)
+            data["avgi"][i] = float(avgi[qTest][0])
+            data["avgq"][i] = float(avgq[qTest][0])
+
+            # only start a new partial fit once the previous one has finished so fits never queue up behind the sweep
+            if live_fit_pool is not None and (i + 1) % live_fit_every == 0 and i >= 4:
+                if live_fit_future is None or live_fit_future.done():
+                    if live_fit_future is not None:
+                        self.live_fit = live_fit_future.result()
+                    live_fit_future = live_fit_pool.submit(
+                        fitter.fitdecaysin,
+                        lengths[: i + 1].copy(),
+                        np.hypot(data["avgi"][: i + 1], data["avgq"][: i + 1], dtype=np.float64),
+                    )
 
-        for k, a in data.items():
-            data[k] = np.array(a)
+        if live_fit_pool is not None:
+            live_fit_pool.shutdown(wait=True)
+            if live_fit_future is not None:
+                self.live_fit = live_fit_future.result()
+
+        # magnitude and phase computed in one vectorized pass after the sweep, without complex temporaries
+        np.hypot(data["avgi"], data["avgq"], out=data["amps"])
+        np.arctan2(data["avgq"], data["avgi"], out=data["phases"])
 
         self.data = data
 
         return data
 
-    def analyze(self, data=None, fit=True, fit_func="decaysin"):
+    def analyze(self, data=None, fit=True, fit_func="decaysin", parallel_fit=True):
+        """
+        parallel_fit: run the independent avgi/avgq/amps fits in a thread pool (LAPACK releases the GIL)
+        """
         if data is None:
             data = self.data
         if fit:
@@ -784,9 +837,22 @@ class LengthRabiExperiment(Experiment):
                 fit_fitfunc = fitter.fitdecaysin
             elif fit_func == "sin":
                 fit_fitfunc = fitter.fitsin
-            p_avgi, pCov_avgi = fit_fitfunc(data["xpts"][:-1], data["avgi"][:-1], fitparams=fitparams)
-            p_avgq, pCov_avgq = fit_fitfunc(data["xpts"][:-1], data["avgq"][:-1], fitparams=fitparams)
-            p_amps, pCov_amps = fit_fitfunc(data["xpts"][:-1], data["amps"][:-1], fitparams=fitparams)
+            # trim the last point once and hand curve_fit contiguous float64 arrays so it doesn't re-copy them
+            xfit = np.ascontiguousarray(data["xpts"][:-1], dtype=np.float64)
+            yfit_avgi, yfit_avgq, yfit_amps = (
+                np.ascontiguousarray(data[k][:-1], dtype=np.float64) for k in ("avgi", "avgq", "amps")
+            )
+            if parallel_fit:
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    futures = [
+                        executor.submit(fit_fitfunc, xfit, yfit, fitparams=fitparams)
+                        for yfit in (yfit_avgi, yfit_avgq, yfit_amps)
+                    ]
+                    (p_avgi, pCov_avgi), (p_avgq, pCov_avgq), (p_amps, pCov_amps) = [f.result() for f in futures]
+            else:
+                p_avgi, pCov_avgi = fit_fitfunc(xfit, yfit_avgi, fitparams=fitparams)
+                p_avgq, pCov_avgq = fit_fitfunc(xfit, yfit_avgq, fitparams=fitparams)
+                p_amps, pCov_amps = fit_fitfunc(xfit, yfit_amps, fitparams=fitparams)
             data["fit_avgi"] = p_avgi
             data["fit_avgq"] = p_avgq
             data["fit_amps"] = p_amps
@@ -816,21 +882,25 @@ class LengthRabiExperiment(Experiment):
         gain = self.cfg.expt.gain
         title = f"Length Rabi {'EF ' if self.cfg.expt.checkEF else ''}on Q{qTest} (Gain {gain}){(', ZZ Q'+str(qZZ)) if self.checkZZ else ''}"
 
-        plt.figure(figsize=(8, 5))
-        plt.subplot(111, title=title, xlabel="Length [ns]", ylabel="Amplitude [ADC units]")
-        plt.plot(xpts_ns[:-1], data["amps"][:-1], ".-")
+        # per-point markers dominate draw time for long sweeps: draw those as rasterized lines (fits stay vector)
+        large_sweep = len(xpts_ns) > 500
+        data_fmt = "-" if large_sweep else ".-"
+
+        (ax,) = display_axes(self._display_figs, "amps", 1, figsize=(8, 5))
+        ax.set(title=title, xlabel="Length [ns]", ylabel="Amplitude [ADC units]")
+        ax.plot(xpts_ns[:-1], data["amps"][:-1], data_fmt, rasterized=large_sweep)
         if fit:
             p = data["fit_amps"]
-            plt.plot(xpts_ns[:-1], fit_func(data["xpts"][:-1], *p))
-        plt.tight_layout()
+            ax.plot(xpts_ns[:-1], fit_func(data["xpts"][:-1], *p))
+        ax.figure.tight_layout()
         plt.show()
 
-        plt.figure(figsize=(8, 9))
-        plt.subplot(211, title=title, ylabel="I [adc level]")
-        plt.plot(xpts_ns[1:-1], data["avgi"][1:-1], ".-")
+        ax_i, ax_q = display_axes(self._display_figs, "iq", 2, figsize=(8, 9))
+        ax_i.set(title=title, ylabel="I [adc level]")
+        ax_i.plot(xpts_ns[1:-1], data["avgi"][1:-1], data_fmt, rasterized=large_sweep)
         if fit:
             p = data["fit_avgi"]
-            plt.plot(xpts_ns[0:-1], fit_func(data["xpts"][0:-1], *p))
+            ax_i.plot(xpts_ns[0:-1], fit_func(data["xpts"][0:-1], *p))
             if p[2] > 180:
                 p[2] = p[2] - 360
             elif p[2] < -180:
@@ -844,15 +914,15 @@ class LengthRabiExperiment(Experiment):
                 print("Decay from avgi [us]", p[3])
             print(f"Pi length from avgi data [us]: {pi_length}")
             print(f"\tPi/2 length from avgi data [us]: {pi2_length}")
-            plt.axvline(pi_length * 1e3, color="0.2", linestyle="--")
-            plt.axvline(pi2_length * 1e3, color="0.2", linestyle="--")
+            ax_i.axvline(pi_length * 1e3, color="0.2", linestyle="--")
+            ax_i.axvline(pi2_length * 1e3, color="0.2", linestyle="--")
 
         print()
-        plt.subplot(212, xlabel="Pulse length [ns]", ylabel="Q [adc levels]")
-        plt.plot(xpts_ns[1:-1], data["avgq"][1:-1], ".-")
+        ax_q.set(xlabel="Pulse length [ns]", ylabel="Q [adc levels]")
+        ax_q.plot(xpts_ns[1:-1], data["avgq"][1:-1], data_fmt, rasterized=large_sweep)
         if fit:
             p = data["fit_avgq"]
-            plt.plot(xpts_ns[0:-1], fit_func(data["xpts"][0:-1], *p))
+            ax_q.plot(xpts_ns[0:-1], fit_func(data["xpts"][0:-1], *p))
             if p[2] > 180:
                 p[2] = p[2] - 360
             elif p[2] < -180:
@@ -866,9 +936,9 @@ class LengthRabiExperiment(Experiment):
                 print("Decay from avgq [us]", p[3])
             print(f"Pi length from avgq data [us]: {pi_length}")
             print(f"Pi/2 length from avgq data [us]: {pi2_length}")
-            plt.axvline(pi_length * 1e3, color="0.2", linestyle="--")
-            plt.axvline(pi2_length * 1e3, color="0.2", linestyle="--")
-        plt.tight_layout()
+            ax_q.axvline(pi_length * 1e3, color="0.2", linestyle="--")
+            ax_q.axvline(pi2_length * 1e3, color="0.2", linestyle="--")
+        ax_q.figure.tight_layout()
         plt.show()
 
     def save_data(self, data=None):
@@ -325,6 +325,62 @@ def hist(data, plot=True, span=None, verbose=True, title=None, fid_avg=False):
     return fids, thresholds, theta * 180 / np.pi  # fids: ge, gf, ef
 
 
+def hist_batch(shot_data_list, fid_avg=False):
+    """
+    Batched version of hist(data, plot=False) for the g/e fidelity of several qubits at once.
+    shot_data_list: list of dicts with Ig, Qg, Ie, Qe, all with the same number of shots
+    Returns lists of fids, thresholds, angles (one per qubit); fids[i] and thresholds[i]
+    match hist(shot_data_list[i], plot=False)[0][0] and [1][0].
+    """
+    Ig = np.array([data["Ig"] for data in shot_data_list], dtype=float)
+    Qg = np.array([data["Qg"] for data in shot_data_list], dtype=float)
+    Ie = np.array([data["Ie"] for data in shot_data_list], dtype=float)
+    Qe = np.array([data["Qe"] for data in shot_data_list], dtype=float)
+    nq = len(shot_data_list)
+    numbins = 200
+
+    xg, yg = np.average(Ig, axis=1), np.average(Qg, axis=1)
+    xe, ye = np.average(Ie, axis=1), np.average(Qe, axis=1)
+
+    """Compute the rotation angle"""
+    theta = -np.arctan2((ye - yg), (xe - xg))
+
+    """Rotate the IQ data"""
+    cos_theta = np.cos(theta)[:, np.newaxis]
+    sin_theta = np.sin(theta)[:, np.newaxis]
+    Ig_new = Ig * cos_theta - Qg * sin_theta
+    Ie_new = Ie * cos_theta - Qe * sin_theta
+
+    """X ranges for histogram"""
+    I_max = np.maximum(np.max(Ig_new, axis=1), np.max(Ie_new, axis=1))
+    I_min = np.minimum(np.min(Ig_new, axis=1), np.min(Ie_new, axis=1))
+    span = (I_max - I_min) / 2
+    lim_midpoint = (I_max + I_min) / 2
+    xlims = np.stack((lim_midpoint - span, lim_midpoint + span), axis=1)
+
+    """Histogram each qubit (same binning as hist)"""
+    ng = np.empty((nq, numbins), dtype=np.int64)
+    ne = np.empty((nq, numbins), dtype=np.int64)
+    bin_edges = np.empty((nq, numbins + 1))
+    for i in range(nq):
+        ng[i], bin_edges[i] = np.histogram(Ig_new[i], bins=numbins, range=tuple(xlims[i]))
+        ne[i], _ = np.histogram(Ie_new[i], bins=numbins, range=tuple(xlims[i]))
+
+    """Compute the fidelity using overlap of the histograms"""
+    ng_tot = ng.sum(axis=1)
+    ne_tot = ne.sum(axis=1)
+    contrast = np.abs(((np.cumsum(ng, axis=1) - np.cumsum(ne, axis=1)) / (0.5 * ng_tot + 0.5 * ne_tot)[:, np.newaxis]))
+    tind = contrast.argmax(axis=1)
+    thresholds = bin_edges[np.arange(nq), tind]
+    if not fid_avg:
+        fids = contrast[np.arange(nq), tind]
+    else:
+        above_tind = np.arange(numbins)[np.newaxis, :] >= tind[:, np.newaxis]
+        fids = 0.5 * (1 - np.sum(ng * above_tind, axis=1) / ng_tot + 1 - np.sum(ne * ~above_tind, axis=1) / ne_tot)
+
+    return list(fids), list(thresholds), list(theta * 180 / np.pi)
+
+
 # ===================================================================== #
 
 
@@ -1,12 +1,50 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
 import matplotlib.pyplot as plt
 import numpy as np
 from qick import *
 from qick.helpers import gauss
 
 from slab import Experiment, dsfit, AttrDict
-from tqdm import tqdm_notebook as tqdm
+from tqdm.auto import tqdm
 
 import experiments.fitting as fitter
+from experiments.clifford_averager_program import cfg_json_default, display_axes, expand_cfg
+
+# single worker so background saves are written in the order they were requested (pending saves finish at exit)
+_save_pool = ThreadPoolExecutor(max_workers=1)
+
+def resolve_qubits(expt_cfg):
+    """
+    Returns qTest, qZZ, checkZZ for the Ramsey expt config (qZZ defaults to qTest if not checking ZZ)
+    """
+    qTest = expt_cfg.qTest
+    qZZ = expt_cfg.qZZ
+    checkZZ = qZZ is not None
+    if not checkZZ: qZZ = qTest
+    return qTest, qZZ, checkZZ
+
+def ramsey_fit_curves(x, p, fit_num_sin=1):
+    """
+    Returns (fit curve, upper T2 envelope, lower T2 envelope) for fit params p evaluated on x
+    """
+    if fit_num_sin == 2: fitfunc = fitter.twofreq_decaysin
+    elif fit_num_sin == 3: fitfunc = fitter.threefreq_decaysin
+    else: fitfunc = fitter.decaysin
+    env = fitter.expfunc(x, p[-1], p[0], 0, p[3])
+    return fitfunc(x, *p), env, 2*p[-1] - env # lower envelope mirrored about the offset
+
+def ramsey_freq_adjustments(ramsey_freq, fit_freqs):
+    """
+    For each fit frequency, returns the two candidate qubit freq adjustments (wR - f_fit, -wR - f_fit) ordered by
+    magnitude, as a list of [smaller, larger] arrays (so a suggested freq can be computed in one op)
+    """
+    adjustments = []
+    for f_fit in fit_freqs:
+        a, b = ramsey_freq - f_fit, -ramsey_freq - f_fit
+        adjustments.append(np.array((a, b) if abs(a) <= abs(b) else (b, a)))
+    return adjustments
 
 class RamseyProgram(RAveragerProgram):
     def __init__(self, soccfg, cfg):
@@ -29,37 +67,35 @@ class RamseyProgram(RAveragerProgram):
         self.sync_all(10)
 
     def set_gen_delays(self):
+        delay_ns_by_ch = dict(zip(self.cfg.hw.soc.dacs.delay_chs.ch, self.cfg.hw.soc.dacs.delay_chs.delay_ns))
         for ch in self.gen_chs:
-            delay_ns = self.cfg.hw.soc.dacs.delay_chs.delay_ns[np.argwhere(np.array(self.cfg.hw.soc.dacs.delay_chs.ch) == ch)[0][0]]
-            delay_cycles = self.us2cycles(delay_ns*1e-3, gen_ch=ch)
-            self.gen_delays[ch] = delay_cycles
+            self.gen_delays[ch] = self.us2cycles(delay_ns_by_ch[ch]*1e-3, gen_ch=ch)
 
     def sync_all(self, t=0):
         super().sync_all(t=t, gen_t0=self.gen_delays)
 
 
     def initialize(self):
-        cfg = AttrDict(self.cfg)
-        self.cfg.update(cfg.expt)
-
-        qTest = self.cfg.expt.qTest
-        qZZ = self.cfg.expt.qZZ
-        self.checkZZ = False
-        if qZZ is not None: self.checkZZ = True
-        else: qZZ = qTest
+        cfg = self.cfg # already an AttrDict with expt merged in __init__
+        # local aliases for the config subtrees read in the declaration loops below (each AttrDict level is a python lookup)
+        dacs = cfg.hw.soc.dacs
+        readout = cfg.device.readout
+
+        self.qTest, self.qZZ, self.checkZZ = resolve_qubits(self.cfg.expt)
+        qTest, qZZ = self.qTest, self.qZZ
         self.checkEF = self.cfg.expt.checkEF
 
-        self.num_qubits_sample = len(self.cfg.device.readout.frequency)
+        self.num_qubits_sample = len(readout.frequency)
         
         self.adc_chs = cfg.hw.soc.adcs.readout.ch
-        self.res_chs = cfg.hw.soc.dacs.readout.ch
-        self.res_ch_types = cfg.hw.soc.dacs.readout.type
-        self.qubit_chs = cfg.hw.soc.dacs.qubit.ch
-        self.qubit_ch_types = cfg.hw.soc.dacs.qubit.type
+        self.res_chs = dacs.readout.ch
+        self.res_ch_types = dacs.readout.type
+        self.qubit_chs = dacs.qubit.ch
+        self.qubit_ch_types = dacs.qubit.type
         if 'cool_qubits' in self.cfg.expt and self.cfg.expt.cool_qubits is not None:
-            self.swap_f0g1_chs = self.cfg.hw.soc.dacs.swap_f0g1.ch
-            self.swap_f0g1_ch_types = self.cfg.hw.soc.dacs.swap_f0g1.type
-            mixer_freqs = self.cfg.hw.soc.dacs.swap_f0g1.mixer_freq
+            self.swap_f0g1_chs = dacs.swap_f0g1.ch
+            self.swap_f0g1_ch_types = dacs.swap_f0g1.type
+            mixer_freqs = dacs.swap_f0g1.mixer_freq
 
         self.q_rps = [self.ch_page(ch) for ch in self.qubit_chs] # get register page for qubit_chs
 
@@ -74,14 +110,16 @@ class RamseyProgram(RAveragerProgram):
         self.pi_ef_half_gains = np.reshape(self.cfg.device.qubit.pulses.pi_ef.half_gain, (4,4))
         self.pi_ef_half_gain_pi_sigmas = np.reshape(self.cfg.device.qubit.pulses.pi_ef.half_gain_pi_sigma, (4,4))
 
-        self.f_res_regs = [self.freq2reg(f, gen_ch=gen_ch, ro_ch=adc_ch) for f, gen_ch, adc_ch in zip(cfg.device.readout.frequency, self.res_chs, self.adc_chs)]
+        self.f_res_regs = [self.freq2reg(f, gen_ch=gen_ch, ro_ch=adc_ch) for f, gen_ch, adc_ch in zip(readout.frequency, self.res_chs, self.adc_chs)]
         if 'cool_qubits' in self.cfg.expt and self.cfg.expt.cool_qubits is not None:
-            self.f_f0g1_reg = [self.freq2reg(f, gen_ch=ch) for f, ch in zip(cfg.device.qubit.f_f0g1, self.qubit_chs)]
-        self.readout_lengths_dac = [self.us2cycles(length, gen_ch=gen_ch) for length, gen_ch in zip(self.cfg.device.readout.readout_length, self.res_chs)]
-        self.readout_lengths_adc = [1+self.us2cycles(length, ro_ch=ro_ch) for length, ro_ch in zip(self.cfg.device.readout.readout_length, self.adc_chs)]
+            # only the cooled qubits play f0g1 pulses, on their swap channels
+            self.f_f0g1_regs = {q: self.freq2reg(cfg.device.qubit.f_f0g1[q], gen_ch=self.swap_f0g1_chs[q]) for q in self.cfg.expt.cool_qubits}
+        self.readout_lengths_dac = [self.us2cycles(length, gen_ch=gen_ch) for length, gen_ch in zip(readout.readout_length, self.res_chs)]
+        self.readout_lengths_adc = [1+self.us2cycles(length, ro_ch=ro_ch) for length, ro_ch in zip(readout.readout_length, self.adc_chs)]
 
         # declare all res dacs
         self.measure_chs = []
+        declared_res_chs = set() # O(1) membership check, measure_chs keeps the declaration order
         mask = [] # indices of mux_freqs, mux_gains list to play
         mux_mixer_freq = None
         mux_freqs = [0]*4 # MHz
@@ -91,38 +129,39 @@ class RamseyProgram(RAveragerProgram):
         for q in range(self.num_qubits_sample):
             assert self.res_ch_types[q] in ['full', 'mux4']
             if self.res_ch_types[q] == 'full':
-                if self.res_chs[q] not in self.measure_chs:
-                    self.declare_gen(ch=self.res_chs[q], nqz=cfg.hw.soc.dacs.readout.nyquist[q])
+                if self.res_chs[q] not in declared_res_chs:
+                    self.declare_gen(ch=self.res_chs[q], nqz=dacs.readout.nyquist[q])
                     self.measure_chs.append(self.res_chs[q])
+                    declared_res_chs.add(self.res_chs[q])
                 
             elif self.res_ch_types[q] == 'mux4':
                 assert self.res_chs[q] == 6
                 mask.append(q)
-                if mux_mixer_freq is None: mux_mixer_freq = cfg.hw.soc.dacs.readout.mixer_freq[q]
-                else: assert mux_mixer_freq == cfg.hw.soc.dacs.readout.mixer_freq[q] # ensure all mux channels have specified the same mixer freq
-                mux_freqs[q] = cfg.device.readout.frequency[q]
-                mux_gains[q] = cfg.device.readout.gain[q]
+                if mux_mixer_freq is None: mux_mixer_freq = dacs.readout.mixer_freq[q]
+                else: assert mux_mixer_freq == dacs.readout.mixer_freq[q] # ensure all mux channels have specified the same mixer freq
+                mux_freqs[q] = readout.frequency[q]
+                mux_gains[q] = readout.gain[q]
                 mux_ro_ch = self.adc_chs[q]
-                mux_nqz = cfg.hw.soc.dacs.readout.nyquist[q]
-                if self.res_chs[q] not in self.measure_chs:
+                mux_nqz = dacs.readout.nyquist[q]
+                if self.res_chs[q] not in declared_res_chs:
                     self.measure_chs.append(self.res_chs[q])
+                    declared_res_chs.add(self.res_chs[q])
         if 'mux4' in self.res_ch_types: # declare mux4 channel
             # print('mux params', mux_mixer_freq, mux_freqs, mux_gains, mux_ro_ch, mask)
             self.declare_gen(ch=6, nqz=mux_nqz, mixer_freq=mux_mixer_freq, mux_freqs=mux_freqs, mux_gains=mux_gains, ro_ch=mux_ro_ch)
 
 
         # declare adcs - readout for all qubits everytime, defines number of buffers returned regardless of number of adcs triggered
+        # and declare qubit dacs, in the same pass (res dacs above must be declared first)
         for q in range(self.num_qubits_sample):
             if self.adc_chs[q] not in self.ro_chs:
-                self.declare_readout(ch=self.adc_chs[q], length=self.readout_lengths_adc[q], freq=self.cfg.device.readout.frequency[q], gen_ch=self.res_chs[q])
+                self.declare_readout(ch=self.adc_chs[q], length=self.readout_lengths_adc[q], freq=readout.frequency[q], gen_ch=self.res_chs[q])
 
-        # declare qubit dacs
-        for q in range(self.num_qubits_sample):
             mixer_freq = None
             if self.qubit_ch_types[q] == 'int4':
-                mixer_freq = cfg.hw.soc.dacs.qubit.mixer_freq[q]
+                mixer_freq = dacs.qubit.mixer_freq[q]
             if self.qubit_chs[q] not in self.gen_chs:
-                self.declare_gen(ch=self.qubit_chs[q], nqz=cfg.hw.soc.dacs.qubit.nyquist[q], mixer_freq=mixer_freq)
+                self.declare_gen(ch=self.qubit_chs[q], nqz=dacs.qubit.nyquist[q], mixer_freq=mixer_freq)
 
         if 'cool_qubits' in self.cfg.expt and self.cfg.expt.cool_qubits is not None:
             mixer_freq = None
@@ -130,7 +169,7 @@ class RamseyProgram(RAveragerProgram):
                 if self.swap_f0g1_ch_types[q] == 'int4':
                     mixer_freq = mixer_freqs[q]
                 if self.swap_f0g1_chs[q] not in self.gen_chs: 
-                    self.declare_gen(ch=self.swap_f0g1_chs[q], nqz=self.cfg.hw.soc.dacs.swap_f0g1.nyquist[q], mixer_freq=mixer_freq)
+                    self.declare_gen(ch=self.swap_f0g1_chs[q], nqz=dacs.swap_f0g1.nyquist[q], mixer_freq=mixer_freq)
 
         # declare registers for phase incrementing
         # self.r_wait = 3
@@ -146,7 +185,9 @@ class RamseyProgram(RAveragerProgram):
         self.pisigma_ge = self.us2cycles(self.pi_ge_sigmas[qTest, qZZ], gen_ch=self.qubit_chs[qTest]) # default pi_ge value
         self.f_ge_init_reg = self.freq2reg(self.f_ges[qTest, qZZ], gen_ch=self.qubit_chs[qTest])
         self.gain_ge_init = self.pi_ge_gains[qTest, qZZ] if self.pi_ge_gains[qTest, qZZ] > 0 else self.pi_ge_gains[qTest, qTest] # this contingency is possible if the ge pulse is not calibrated but we want to calibrate the EF pulse for a specific ZZ configuration
-        if self.checkZZ: self.pisigma_ge_qZZ = self.us2cycles(self.pi_ge_sigmas[qZZ, qZZ], gen_ch=self.qubit_chs[qZZ])
+        if self.checkZZ:
+            self.pisigma_ge_qZZ = self.us2cycles(self.pi_ge_sigmas[qZZ, qZZ], gen_ch=self.qubit_chs[qZZ])
+            self.f_ge_qZZ_reg = self.freq2reg(self.f_ges[qZZ, qZZ], gen_ch=self.qubit_chs[qZZ])
 
         # parameters for test pulse that we are trying to calibrate
         self.pi_test_sigma = self.us2cycles(self.pi_ge_sigmas[qTest, qZZ], gen_ch=self.qubit_chs[qTest]) # default pi_ge value
@@ -163,10 +204,21 @@ class RamseyProgram(RAveragerProgram):
         self.cfg.expt.gain = self.gain_pi_test
 
         if 'cool_qubits' in self.cfg.expt and self.cfg.expt.cool_qubits is not None:
+            # registers/cycles for the cooling pulses, used in body
+            self.cool_qubits = list(self.cfg.expt.cool_qubits)
+            pi_f0g1 = cfg.device.qubit.pulses.pi_f0g1
+            self.f_ef_cool_regs = {q: self.freq2reg(self.f_efs[q, q], gen_ch=self.qubit_chs[q]) for q in self.cool_qubits}
+            self.pisigma_f0g1s = {q: self.us2cycles(pi_f0g1.sigma[q], gen_ch=self.swap_f0g1_chs[q]) for q in self.cool_qubits}
+            cool_idle = [pi_f0g1.idle[q] for q in self.cool_qubits]
+            if 'cool_idle' in self.cfg.expt and self.cfg.expt.cool_idle is not None:
+                cool_idle = self.cfg.expt.cool_idle
+            sorted_indices = np.argsort(cool_idle)[::-1] # sort cooling times longest first
+            self.sorted_cool_qubits = np.array(self.cool_qubits)[sorted_indices]
+            self.sorted_cool_idle = np.array(cool_idle)[sorted_indices]
             for q in self.cfg.expt.cool_qubits:
                 self.pisigma_ef = self.us2cycles(self.pi_ef_sigmas[q, q], gen_ch=self.qubit_chs[q]) # default pi_ef value
                 self.add_gauss(ch=self.qubit_chs[q], name=f"pi_ef_qubit{q}", sigma=self.pisigma_ef, length=self.pisigma_ef*4)
-                if self.cfg.device.qubit.pulses.pi_f0g1.type[q] == 'flat_top':
+                if pi_f0g1.type[q] == 'flat_top':
                     self.add_gauss(ch=self.swap_f0g1_chs[q], name=f"pi_f0g1_{q}", sigma=3, length=3*4)
                 else: assert False, 'not implemented'
 
@@ -183,8 +235,8 @@ class RamseyProgram(RAveragerProgram):
             self.set_pulse_registers(ch=6, style="const", length=max(self.readout_lengths_dac), mask=mask)
         for q in range(self.num_qubits_sample):
             if self.res_ch_types[q] != 'mux4':
-                if cfg.device.readout.gain[q] < 1:
-                    gain = int(cfg.device.readout.gain[q] * 2**15)
+                if readout.gain[q] < 1:
+                    gain = int(readout.gain[q] * 2**15)
                 self.set_pulse_registers(ch=self.res_chs[q], style="const", freq=self.f_res_regs[q], phase=0, gain=gain, length=max(self.readout_lengths_dac))
 
         # initialize wait registers
@@ -195,10 +247,8 @@ class RamseyProgram(RAveragerProgram):
         self.sync_all(200)
 
     def body(self):
-        cfg=AttrDict(self.cfg)
-        qTest = self.cfg.expt.qTest
-        qZZ = self.cfg.expt.qZZ
-        if qZZ is None: qZZ = qTest
+        cfg = self.cfg # already an AttrDict, no need to rewrap
+        qTest, qZZ = self.qTest, self.qZZ
 
         self.reset_and_sync()
 
@@ -208,16 +258,11 @@ class RamseyProgram(RAveragerProgram):
         # self.sync_all()
 
 
-        if 'cool_qubits' in self.cfg.expt and self.cfg.expt.cool_qubits is not None:
-            cool_idle = [self.cfg.device.qubit.pulses.pi_f0g1.idle[q] for q in self.cfg.expt.cool_qubits]
-            cool_qubits = self.cfg.expt.cool_qubits
-            if 'cool_idle' in self.cfg.expt and self.cfg.expt.cool_idle is not None:
-                cool_idle = self.cfg.expt.cool_idle
-            sorted_indices = np.argsort(cool_idle)[::-1] # sort cooling times longest first
-            cool_qubits = np.array(cool_qubits)
-            cool_idle = np.array(cool_idle)
-            sorted_cool_qubits = cool_qubits[sorted_indices]
-            sorted_cool_idle = cool_idle[sorted_indices]
+        expt = self.cfg.expt
+        if 'cool_qubits' in expt and expt.cool_qubits is not None:
+            pi_f0g1 = self.cfg.device.qubit.pulses.pi_f0g1
+            assert list(expt.cool_qubits) == self.cool_qubits, 'cool_qubits changed since initialize'
+            sorted_cool_qubits, sorted_cool_idle = self.sorted_cool_qubits, self.sorted_cool_idle # sorted longest first in initialize
             max_idle = sorted_cool_idle[0]
         
             last_pulse_len = 0
@@ -226,28 +271,30 @@ class RamseyProgram(RAveragerProgram):
                 remaining_idle -= last_pulse_len
 
                 last_pulse_len = 0
-                self.setup_and_pulse(ch=self.qubit_chs[q], style="arb", phase=0, freq=self.freq2reg(self.f_efs[q, q], gen_ch=self.qubit_chs[q]), gain=self.pi_ef_gains[q, q], waveform=f"pi_ef_qubit{q}")
+                self.setup_and_pulse(ch=self.qubit_chs[q], style="arb", phase=0, freq=self.f_ef_cool_regs[q], gain=self.pi_ef_gains[q, q], waveform=f"pi_ef_qubit{q}")
                 self.sync_all()
                 last_pulse_len += self.pi_ef_sigmas[q, q]*4
 
-                pulse_type = self.cfg.device.qubit.pulses.pi_f0g1.type[q]
-                pisigma_f0g1 = self.us2cycles(self.cfg.device.qubit.pulses.pi_f0g1.sigma[q], gen_ch=self.swap_f0g1_chs[q])
+                pulse_type = pi_f0g1.type[q]
+                pisigma_f0g1 = self.pisigma_f0g1s[q]
                 if pulse_type == 'flat_top':
                     sigma_ramp_cycles = 3
                     flat_length_cycles = pisigma_f0g1 - sigma_ramp_cycles*4
-                    self.setup_and_pulse(ch=self.swap_f0g1_chs[q], style="flat_top", freq=self.f_f0g1_regs[q], phase=0, gain=self.cfg.device.qubit.pulses.pi_f0g1.gain[q], length=flat_length_cycles, waveform=f"pi_f0g1_{q}")
+                    self.setup_and_pulse(ch=self.swap_f0g1_chs[q], style="flat_top", freq=self.f_f0g1_regs[q], phase=0, gain=pi_f0g1.gain[q], length=flat_length_cycles, waveform=f"pi_f0g1_{q}")
                 else: assert False, 'not implemented'
                 self.sync_all()
-                last_pulse_len += self.cfg.device.qubit.pulses.pi_f0g1.sigma[q]
+                last_pulse_len += pi_f0g1.sigma[q]
 
             remaining_idle -= last_pulse_len
             last_idle = max((remaining_idle, sorted_cool_idle[-1]))
             self.sync_all(self.us2cycles(last_idle))
 
         # initializations as necessary
+        # (checkZZ/checkEF are fixed in initialize and body only runs once, while the tProc program is generated, so
+        # these branches never reach the firmware)
         if self.checkZZ:
             assert self.pi_ge_gains[qZZ, qZZ] > 0
-            self.setup_and_pulse(ch=self.qubit_chs[qZZ], style="arb", phase=0, freq=self.freq2reg(self.f_ges[qZZ, qZZ], gen_ch=self.qubit_chs[qZZ]), gain=self.pi_ge_gains[qZZ, qZZ], waveform="pi_qubitZZ")
+            self.setup_and_pulse(ch=self.qubit_chs[qZZ], style="arb", phase=0, freq=self.f_ge_qZZ_reg, gain=self.pi_ge_gains[qZZ, qZZ], waveform="pi_qubitZZ")
             self.sync_all()
         if self.checkEF:
             assert self.gain_ge_init > 0
@@ -300,9 +347,7 @@ class RamseyProgram(RAveragerProgram):
         )
 
     def update(self):
-        qTest = self.cfg.expt.qTest
-        qZZ = self.cfg.expt.qZZ
-        if qZZ is None: qZZ = qTest
+        qTest = self.qTest
 
         num_pi = 0
         if 'num_pi' in self.cfg.expt: num_pi = self.cfg.expt.num_pi
@@ -333,29 +378,33 @@ class RamseyExperiment(Experiment):
         num_pi
         echo_type: cp or cpmg
     )
+    All ADCs are read out every shot but only qTest is kept. Ramsey on several independent qubits in one program would
+    need the sweep wait (a global sync) and phase advance shared across qubits, so run one experiment per qubit.
     """
 
     def __init__(self, soccfg=None, path='', prefix='Ramsey', config_file=None, progress=None):
         super().__init__(soccfg=soccfg, path=path, prefix=prefix, config_file=config_file, progress=progress)
+        self._ramsey_prog = None
+        self._ramsey_prog_key = None
+        self._fit_curves = dict() # axis -> (fit params, curves) from the last analyze, reused by display
+        self._display_figs = dict() # figures reused across display() calls while they are still open
+        self._pending_saves = [] # futures of background save_data calls not yet waited on
 
     def acquire(self, progress=False):
         # expand entries in config that are length 1 to fill all qubits
-        num_qubits_sample = len(self.cfg.device.readout.frequency)
-        for subcfg in (self.cfg.device.readout, self.cfg.device.qubit, self.cfg.hw.soc):
-            for key, value in subcfg.items() :
-                if isinstance(value, dict):
-                    for key2, value2 in value.items():
-                        for key3, value3 in value2.items():
-                            if not(isinstance(value3, list)):
-                                value2.update({key3: [value3]*num_qubits_sample})
-                elif not(isinstance(value, list)):
-                    subcfg.update({key: [value]*num_qubits_sample})
-
-        ramsey = RamseyProgram(soccfg=self.soccfg, cfg=self.cfg)
-
-        qTest = self.cfg.expt.qTest
-        qZZ = self.cfg.expt.qZZ
-        if qZZ is None: qZZ = qTest
+        expand_cfg(self.cfg, len(self.cfg.device.readout.frequency))
+
+        # reuse the last compiled program if nothing in cfg has changed since it was built (e.g. repeated tune-up runs)
+        # initialize writes back into cfg (expt.gain), so the stored key is always taken from the cfg after building
+        prog_key = None
+        if self._ramsey_prog is not None:
+            prog_key = (self.soccfg, json.dumps(self.cfg, sort_keys=True, default=cfg_json_default))
+        if prog_key is None or prog_key != self._ramsey_prog_key:
+            self._ramsey_prog = RamseyProgram(soccfg=self.soccfg, cfg=self.cfg)
+            self._ramsey_prog_key = (self.soccfg, json.dumps(self.cfg, sort_keys=True, default=cfg_json_default))
+        ramsey = self._ramsey_prog
+
+        qTest, qZZ, _ = resolve_qubits(self.cfg.expt)
         num_pi = 0
         if 'num_pi' in self.cfg.expt: num_pi = self.cfg.expt.num_pi
         print(f'Running Ramsey {"EF " if self.cfg.expt.checkEF else ""}{"Echo " if num_pi > 0 else ""}on Q{qTest} {"with ZZ Q" + str(qZZ) if qZZ != qTest else ""}')
@@ -364,14 +413,19 @@ class RamseyExperiment(Experiment):
 
         avgi = avgi[qTest][0]
         avgq = avgq[qTest][0]
-        amps = np.abs(avgi+1j*avgq) # Calculating the magnitude
-        phases = np.angle(avgi+1j*avgq) # Calculating the phase
+        # amps/phases share one fresh block (not reused across acquires, since callers keep the returned data dicts)
+        amps, phases = np.empty((2, len(avgi)))
+        np.hypot(avgi, avgq, out=amps) # Calculating the magnitude
+        np.arctan2(avgq, avgi, out=phases) # Calculating the phase
 
         data={'xpts': x_pts, 'avgi':avgi, 'avgq':avgq, 'amps':amps, 'phases':phases}        
         self.data=data
         return data
 
-    def analyze(self, data=None, fit=True, fit_num_sin=1):
+    def analyze(self, data=None, fit=True, fit_num_sin=1, parallel_fit=True):
+        """
+        parallel_fit: run the independent avgi/avgq/amps fits in a thread pool (LAPACK releases the GIL)
+        """
         if data is None:
             data=self.data
 
@@ -403,39 +457,55 @@ class RamseyExperiment(Experiment):
             else:
                 fitfunc = fitter.fitdecaysin
                 fitparams=[None, self.cfg.expt.ramsey_freq, 0, None, None]
-            p_avgi, pCov_avgi = fitfunc(data['xpts'][:-1], data["avgi"][:-1], fitparams=fitparams)
-            p_avgq, pCov_avgq = fitfunc(data['xpts'][:-1], data["avgq"][:-1], fitparams=fitparams)
-            p_amps, pCov_amps = fitfunc(data['xpts'][:-1], data["amps"][:-1], fitparams=fitparams)
-            data['fit_avgi'] = p_avgi   
-            data['fit_avgq'] = p_avgq
-            data['fit_amps'] = p_amps
+            # trim the last point once for all fits (not stored in data so it isn't saved twice)
+            xfit = np.asarray(data['xpts'][:-1])
+            yfits = {axis: np.asarray(data[axis][:-1]) for axis in ('avgi', 'avgq', 'amps')}
+            if parallel_fit:
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    futures = [executor.submit(fitfunc, xfit, yfits[axis], fitparams=fitparams) for axis in ('avgi', 'avgq', 'amps')]
+                    (p_avgi, pCov_avgi), (p_avgq, pCov_avgq), (p_amps, pCov_amps) = [future.result() for future in futures]
+            else:
+                p_avgi, pCov_avgi = fitfunc(xfit, yfits['avgi'], fitparams=fitparams)
+                p_avgq, pCov_avgq = fitfunc(xfit, yfits['avgq'], fitparams=fitparams)
+                p_amps, pCov_amps = fitfunc(xfit, yfits['amps'], fitparams=fitparams)
+            # fitter always returns params (the initial guess if the fit failed, flagged by an inf pCov); store them as
+            # ndarrays so downstream only needs to check for None (missing fit)
+            data['fit_avgi'] = np.asarray(p_avgi)
+            data['fit_avgq'] = np.asarray(p_avgq)
+            data['fit_amps'] = np.asarray(p_amps)
             data['fit_err_avgi'] = pCov_avgi   
             data['fit_err_avgq'] = pCov_avgq
             data['fit_err_amps'] = pCov_amps
 
+            # evaluate the fit curves once here so display only has to plot them
+            self._fit_curves = dict()
+            for axis in ('avgi', 'avgq', 'amps'):
+                p = data[f'fit_{axis}']
+                if p is not None:
+                    self._fit_curves[axis] = (p, ramsey_fit_curves(xfit, p, fit_num_sin=fit_num_sin))
+
             # print('p avgi', p_avgi)
             # print('p avgq', p_avgq)
             # print('p amps', p_amps)
 
-            if isinstance(p_avgi, (list, np.ndarray)): data['f_adjust_ramsey_avgi'] = sorted((self.cfg.expt.ramsey_freq - p_avgi[1], -self.cfg.expt.ramsey_freq - p_avgi[1]), key=abs)
-            if isinstance(p_avgq, (list, np.ndarray)): data['f_adjust_ramsey_avgq'] = sorted((self.cfg.expt.ramsey_freq - p_avgq[1], -self.cfg.expt.ramsey_freq - p_avgq[1]), key=abs)
-            if isinstance(p_amps, (list, np.ndarray)): data['f_adjust_ramsey_amps'] = sorted((self.cfg.expt.ramsey_freq - p_amps[1], -self.cfg.expt.ramsey_freq - p_amps[1]), key=abs)
-
-            if fit_num_sin == 2:
-                data['f_adjust_ramsey_avgi2'] = sorted((self.cfg.expt.ramsey_freq - p_avgi[5], -self.cfg.expt.ramsey_freq - p_avgi[5]), key=abs)
-                data['f_adjust_ramsey_avgq2'] = sorted((self.cfg.expt.ramsey_freq - p_avgq[5], -self.cfg.expt.ramsey_freq - p_avgq[5]), key=abs)
-                data['f_adjust_ramsey_amps2'] = sorted((self.cfg.expt.ramsey_freq - p_amps[5], -self.cfg.expt.ramsey_freq - p_amps[5]), key=abs)
+            # candidate freq adjustments (wR - f_fit, -wR - f_fit) for each fit, sorted by magnitude
+            ramsey_freq = self.cfg.expt.ramsey_freq
+            fit_axes = [axis for axis in ('avgi', 'avgq', 'amps') if data[f'fit_{axis}'] is not None]
+            freq_inds = {'': 1, '2': 5} if fit_num_sin == 2 else {'': 1}
+            for suffix, freq_ind in freq_inds.items():
+                cands = ramsey_freq_adjustments(ramsey_freq, [data[f'fit_{axis}'][freq_ind] for axis in fit_axes])
+                for axis, cand in zip(fit_axes, cands):
+                    data[f'f_adjust_ramsey_{axis}{suffix}'] = cand
         return data
 
-    def display(self, data=None, fit=True, fit_num_sin=1):
+    def display(self, data=None, fit=True, fit_num_sin=1, verbose=True):
+        """
+        verbose: print the fit summaries; with verbose=False they are not formatted at all
+        """
         if data is None:
             data=self.data
 
-        qTest = self.cfg.expt.qTest
-        qZZ = self.cfg.expt.qZZ
-        self.checkZZ = False
-        if qZZ is not None: self.checkZZ = True
-        else: qZZ = qTest
+        qTest, qZZ, self.checkZZ = resolve_qubits(self.cfg.expt)
         self.checkEF = self.cfg.expt.checkEF
 
         f_pi_test = np.reshape(self.cfg.device.qubit.f_ge, (4,4))[qTest, qZZ]
@@ -446,92 +516,115 @@ class RamseyExperiment(Experiment):
 
         title = ('EF' if self.checkEF else '') + f'Ramsey {"Echo " if num_pi > 0 else ""}on Q{qTest}' + (f' with Q{qZZ} in e' if self.checkZZ else '') 
 
-        if fit_num_sin == 2: fitfunc = fitter.twofreq_decaysin
-        elif fit_num_sin == 3: fitfunc = fitter.threefreq_decaysin
-        else: fitfunc = fitter.decaysin
-
-        plt.figure(figsize=(10, 6))
-        plt.subplot(111,title=f"{title} (Ramsey {'Echo ' if num_pi > 0 else ''}Freq: {self.cfg.expt.ramsey_freq} MHz)",
-                    xlabel="Wait Time [us]", ylabel="Amplitude [ADC level]")
-        plt.plot(data["xpts"][:-1], data["amps"][:-1],'.-')
+        lines = [] # fit results, printed in one write at the end
+        wR2 = 2*self.cfg.expt.ramsey_freq # fit freqs above this suggest the pi pulse freq is far off
+        # only the 2 freq fit has a beat component to report; pick the reporter once instead of branching per panel
+        if fit_num_sin == 2:
+            def beat_lines(name, p):
+                return [f'Beating frequencies from fit {name} [MHz]:\n\tyscale base: {1-p[4]:.6g}\tfit freq {p[1]:.6g}\n\tyscale1: {p[4]:.6g}\tfit freq {p[5]:.6g}']
+        else:
+            def beat_lines(name, p):
+                return []
+
+        # trim the last point once, shared by all 3 plots
+        x = np.ascontiguousarray(data["xpts"][:-1])
+        # per-point markers dominate draw time for long sweeps, so only draw the line there
+        large_sweep = len(x) > 500
+        data_fmt = '-' if large_sweep else '.-'
+        def plot_fit(ax, axis, p, captionStr):
+            # fit curve plus both T2 envelopes on the current axes, reusing the curves from analyze if they match p
+            cached = self._fit_curves.get(axis)
+            if cached is not None and cached[0] is p and len(cached[1][0]) == len(x): yfit, env_up, env_dn = cached[1]
+            else: yfit, env_up, env_dn = ramsey_fit_curves(x, p, fit_num_sin=fit_num_sin)
+            ax.plot(x, yfit, label=captionStr)
+            # draw both envelopes in one call (one column per line)
+            ax.plot(x, np.column_stack((env_up, env_dn)), color='0.2', linestyle='--')
+            ax.legend()
+
+        (ax,) = display_axes(self._display_figs, 'amps', 1, figsize=(10, 6))
+        ax.set(title=f"{title} (Ramsey {'Echo ' if num_pi > 0 else ''}Freq: {self.cfg.expt.ramsey_freq} MHz)",
+               xlabel="Wait Time [us]", ylabel="Amplitude [ADC level]")
+        ax.plot(x, data["amps"][:-1], data_fmt, rasterized=large_sweep)
         if fit:
-            p = data['fit_amps']
-            if isinstance(p, (list, np.ndarray)): 
+            p = data.get('fit_amps')
+            if p is not None:
                 pCov = data['fit_err_amps']
-                captionStr = f'$T_2$ Ramsey fit [us]: {p[3]:.3} $\pm$ {np.sqrt(pCov[3][3]):.3}'
-                plt.plot(data["xpts"][:-1], fitfunc(data["xpts"][:-1], *p), label=captionStr)
-                plt.plot(data["xpts"][:-1], fitter.expfunc(data['xpts'][:-1], p[-1], p[0], 0, p[3]), color='0.2', linestyle='--')
-                plt.plot(data["xpts"][:-1], fitter.expfunc(data['xpts'][:-1], p[-1], -p[0], 0, p[3]), color='0.2', linestyle='--')
-                plt.legend()
-                print(f'Current pi pulse frequency: {f_pi_test}')
-                print(f"Fit frequency from amps [MHz]: {p[1]} +/- {np.sqrt(pCov[1][1])}")
-                if p[1] > 2*self.cfg.expt.ramsey_freq: print('WARNING: Fit frequency >2*wR, you may be too far from the real pi pulse frequency!')
-                print(f'Suggested new pi pulse frequencies from fit amps [MHz]:\n',
-                      f'\t{f_pi_test + data["f_adjust_ramsey_amps"][0]}\n',
-                      f'\t{f_pi_test + data["f_adjust_ramsey_amps"][1]}')
-                if fit_num_sin == 2:
-                    print('Beating frequencies from fit amps [MHz]:\n',
-                          f'\tyscale base: {1-p[4]}',
-                          f'\tfit freq {p[1]}\n',
-                          f'\tyscale1: {p[4]}'
-                          f'\tfit freq {p[5]}\n')
-                print(f'T2 Ramsey from fit amps [us]: {p[3]} +/- {np.sqrt(pCov[3][3])}')
-
-        plt.figure(figsize=(10,9))
-        plt.subplot(211, 
-            title=f"{title} (Ramsey Freq: {self.cfg.expt.ramsey_freq} MHz)",
-            ylabel="I [ADC level]")
-        plt.plot(data["xpts"][:-1], data["avgi"][:-1],'.-')
+                errs = np.sqrt(np.diag(pCov))
+                captionStr = f'$T_2$ Ramsey fit [us]: {p[3]:.3} $\pm$ {errs[3]:.3}'
+                plot_fit(ax, 'amps', p, captionStr)
+                if verbose:
+                    lines.append(f'Current pi pulse frequency: {f_pi_test}')
+                    lines.append(f"Fit frequency from amps [MHz]: {p[1]} +/- {errs[1]}")
+                    if p[1] > wR2: lines.append('WARNING: Fit frequency >2*wR, you may be too far from the real pi pulse frequency!')
+                    f_suggested = f_pi_test + data["f_adjust_ramsey_amps"]
+                    lines.append(f'Suggested new pi pulse frequencies from fit amps [MHz]:\n \t{f_suggested[0]}\n \t{f_suggested[1]}')
+                    lines.extend(beat_lines('amps', p))
+                    lines.append(f'T2 Ramsey from fit amps [us]: {p[3]} +/- {errs[3]}')
+
+        ax_i, ax_q = display_axes(self._display_figs, 'iq', 2, figsize=(10,9))
+        ax_i.set(title=f"{title} (Ramsey Freq: {self.cfg.expt.ramsey_freq} MHz)", ylabel="I [ADC level]")
+        ax_i.plot(x, data["avgi"][:-1], data_fmt, rasterized=large_sweep)
         if fit:
-            p = data['fit_avgi']
-            if isinstance(p, (list, np.ndarray)): 
+            p = data.get('fit_avgi')
+            if p is not None:
                 pCov = data['fit_err_avgi']
-                captionStr = f'$T_2$ Ramsey fit [us]: {p[3]:.3} $\pm$ {np.sqrt(pCov[3][3]):.3}'
-                plt.plot(data["xpts"][:-1], fitfunc(data["xpts"][:-1], *p), label=captionStr)
-                plt.plot(data["xpts"][:-1], fitter.expfunc(data['xpts'][:-1], p[-1], p[0], 0, p[3]), color='0.2', linestyle='--')
-                plt.plot(data["xpts"][:-1], fitter.expfunc(data['xpts'][:-1], p[-1], -p[0], 0, p[3]), color='0.2', linestyle='--')
-                plt.legend()
-                print(f'Current pi pulse frequency: {f_pi_test}')
-                print(f'Fit frequency from I [MHz]: {p[1]} +/- {np.sqrt(pCov[1][1])}')
-                if p[1] > 2*self.cfg.expt.ramsey_freq: print('WARNING: Fit frequency >2*wR, you may be too far from the real pi pulse frequency!')
-                print('Suggested new pi pulse frequency from fit I [MHz]:\n',
-                      f'\t{f_pi_test + data["f_adjust_ramsey_avgi"][0]}\n',
-                      f'\t{f_pi_test + data["f_adjust_ramsey_avgi"][1]}')
-                if fit_num_sin == 2:
-                    print('Beating frequencies from fit avgi [MHz]:\n',
-                          f'\tyscale base: {1-p[4]}',
-                          f'\tfit freq {p[1]}\n',
-                          f'\tyscale1: {p[4]}'
-                          f'\tfit freq {p[5]}\n')
-                print(f'T2 Ramsey from fit I [us]: {p[3]} +/- {np.sqrt(pCov[3][3])}')
-        plt.subplot(212, xlabel="Wait Time [us]", ylabel="Q [ADC level]")
-        plt.plot(data["xpts"][:-1], data["avgq"][:-1],'.-')
+                errs = np.sqrt(np.diag(pCov))
+                captionStr = f'$T_2$ Ramsey fit [us]: {p[3]:.3} $\pm$ {errs[3]:.3}'
+                plot_fit(ax_i, 'avgi', p, captionStr)
+                if verbose:
+                    lines.append(f'Current pi pulse frequency: {f_pi_test}')
+                    lines.append(f'Fit frequency from I [MHz]: {p[1]} +/- {errs[1]}')
+                    if p[1] > wR2: lines.append('WARNING: Fit frequency >2*wR, you may be too far from the real pi pulse frequency!')
+                    f_suggested = f_pi_test + data["f_adjust_ramsey_avgi"]
+                    lines.append(f'Suggested new pi pulse frequency from fit I [MHz]:\n \t{f_suggested[0]}\n \t{f_suggested[1]}')
+                    lines.extend(beat_lines('avgi', p))
+                    lines.append(f'T2 Ramsey from fit I [us]: {p[3]} +/- {errs[3]}')
+        ax_q.set(xlabel="Wait Time [us]", ylabel="Q [ADC level]")
+        ax_q.plot(x, data["avgq"][:-1], data_fmt, rasterized=large_sweep)
         if fit:
-            p = data['fit_avgq']
-            if isinstance(p, (list, np.ndarray)): 
+            p = data.get('fit_avgq')
+            if p is not None:
                 pCov = data['fit_err_avgq']
-                captionStr = f'$T_2$ Ramsey fit [us]: {p[3]:.3} $\pm$ {np.sqrt(pCov[3][3]):.3}'
-                plt.plot(data["xpts"][:-1], fitfunc(data["xpts"][:-1], *p), label=captionStr)
-                plt.plot(data["xpts"][:-1], fitter.expfunc(data['xpts'][:-1], p[-1], p[0], 0, p[3]), color='0.2', linestyle='--')
-                plt.plot(data["xpts"][:-1], fitter.expfunc(data['xpts'][:-1], p[-1], -p[0], 0, p[3]), color='0.2', linestyle='--')
-                plt.legend()
-                print(f'Fit frequency from Q [MHz]: {p[1]} +/- {np.sqrt(pCov[1][1])}')
-                if p[1] > 2*self.cfg.expt.ramsey_freq: print('WARNING: Fit frequency >2*wR, you may be too far from the real pi pulse frequency!')
-                print('Suggested new pi pulse frequencies from fit Q [MHz]:\n',
-                      f'\t{f_pi_test + data["f_adjust_ramsey_avgq"][0]}\n',
-                      f'\t{f_pi_test + data["f_adjust_ramsey_avgq"][1]}')
-                if fit_num_sin == 2:
-                    print('Beating frequencies from fit avgq [MHz]:\n',
-                          f'\tyscale base: {1-p[4]}',
-                          f'\tfit freq {p[1]}\n',
-                          f'\tyscale1: {p[4]}'
-                          f'\tfit freq {p[5]}\n')
-                print(f'T2 Ramsey from fit Q [us]: {p[3]} +/- {np.sqrt(pCov[3][3])}')
-
-        plt.tight_layout()
+                errs = np.sqrt(np.diag(pCov))
+                captionStr = f'$T_2$ Ramsey fit [us]: {p[3]:.3} $\pm$ {errs[3]:.3}'
+                plot_fit(ax_q, 'avgq', p, captionStr)
+                if verbose:
+                    lines.append(f'Fit frequency from Q [MHz]: {p[1]} +/- {errs[1]}')
+                    if p[1] > wR2: lines.append('WARNING: Fit frequency >2*wR, you may be too far from the real pi pulse frequency!')
+                    f_suggested = f_pi_test + data["f_adjust_ramsey_avgq"]
+                    lines.append(f'Suggested new pi pulse frequencies from fit Q [MHz]:\n \t{f_suggested[0]}\n \t{f_suggested[1]}')
+                    lines.extend(beat_lines('avgq', p))
+                    lines.append(f'T2 Ramsey from fit Q [us]: {p[3]} +/- {errs[3]}')
+
+        if lines: print('\n'.join(lines))
+
+        ax_i.figure.tight_layout()
         plt.show()
 
-    def save_data(self, data=None):
+    def save_data(self, data=None, background=False):
+        """
+        background: write the file in a background thread so a sweep can start its next acquire; call wait_for_save()
+        before reading the file back. The data dict is bound and shallow copied now, so later changes to self.data
+        (e.g. analyze adding fits, or the next acquire replacing it) are not written
+        """
         print(f'Saving {self.fname}')
-        super().save_data(data=data)
-        return self.fname
\ No newline at end of file
+        if background:
+            data = self.data if data is None else data
+            self._pending_saves.append(_save_pool.submit(super().save_data, data=dict(data)))
+        else:
+            super().save_data(data=data)
+        return self.fname
+
+    def wait_for_save(self):
+        """
+        Blocks until all background save_data calls have been written (re-raises the first error from the writes)
+        """
+        pending, self._pending_saves = self._pending_saves, []
+        errors = []
+        for future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
\ No newline at end of file
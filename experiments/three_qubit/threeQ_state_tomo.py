@@ -14,17 +14,11 @@ from TomoAnalysis import TomoAnalysis
 
 def sort_counts_3q(shotsA, shotsB, shotsC):
     # data is returned as n000, n001, ... measured for the 3 qubits
-    counts = []
-    qcounts_e = [shotsA, shotsB, shotsC]
-    qcounts_g = np.logical_not(qcounts_e)
-    qcounts = [qcounts_g, qcounts_e]
-    for q1_state in (0, 1):
-        for q2_state in (0, 1):
-            for q3_state in (0, 1):
-                and_counts = np.logical_and(qcounts[q1_state][0], qcounts[q2_state][1])
-                and_counts = np.logical_and(and_counts, qcounts[q3_state][2])
-                counts.append(np.sum(and_counts))
-    return np.array(counts)
+    # pack the 0/1 shots into one index per shot (first qubit as the most significant bit) and count each index once
+    idx = np.zeros(len(shotsA), dtype=np.uint8)
+    for shots in (shotsA, shotsB, shotsC):
+        idx = (idx << 1) | np.asarray(shots).astype(np.uint8)
+    return np.bincount(idx, minlength=8)
 
 def make_3q_meas_order():
     meas_order = []
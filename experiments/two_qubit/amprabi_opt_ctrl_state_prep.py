@@ -225,7 +225,7 @@ class AmplitudeRabiOptimalCtrlProgram(RAveragerProgram):
             for i, ch in enumerate(self.ro_chs)])
         bufi = np.array([bufi[i]/ro['length'] for i, (ch, ro) in enumerate(self.ro_chs.items())])
         if threshold is not None: # categorize single shots
-            bufi = np.array([np.heaviside(bufi[ch] - threshold[ch], 0) for ch in range(len(self.adc_chs))])
+            bufi = np.heaviside(bufi - np.asarray(threshold, dtype=float)[:len(self.adc_chs), np.newaxis], 0)
         avgi = np.average(np.reshape(bufi, (len(self.ro_chs.items()), self.cfg.expt.expts, self.cfg.expt.reps)), axis=2)
         bufi_err = np.std(np.reshape(bufi, (len(self.ro_chs.items()), self.cfg.expt.expts, self.cfg.expt.reps)), axis=2) / np.sqrt(self.cfg.expt.reps)
         if verbose: print([np.median(bufi[i]) for i in range(4)])
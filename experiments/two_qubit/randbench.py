@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from scipy.optimize import curve_fit
 from copy import deepcopy
+import functools
 import json
 
 from qick import *
@@ -12,8 +13,8 @@ from qick.helpers import gauss
 from slab import Experiment, NpEncoder, AttrDict
 from tqdm import tqdm_notebook as tqdm
 
-from experiments.single_qubit.single_shot import hist
-from experiments.clifford_averager_program import CliffordAveragerProgram, CliffordEgGfAveragerProgram, QutritAveragerProgram
+from experiments.single_qubit.single_shot import hist, hist_batch
+from experiments.clifford_averager_program import CliffordAveragerProgram, CliffordEgGfAveragerProgram, QutritAveragerProgram, cfg_json_default, expand_cfg, prebuild_iter
 from experiments.two_qubit.length_rabi_EgGf import LengthRabiEgGfProgram
 from experiments.two_qubit.twoQ_state_tomography import AbstractStateTomo2QProgram, ErrorMitigationStateTomo1QProgram, ErrorMitigationStateTomo2QProgram, infer_gef_popln_2readout
 from TomoAnalysis import TomoAnalysis
@@ -30,61 +31,61 @@ can be uniquely identified just by checking where +X and +Y
 go.
 """
 clifford_1q = dict()
-clifford_1q['Z'] = np.matrix([[1, 0, 0, 0, 0, 0],
-                             [0, 0, 0, 0, 1, 0],
-                             [0, 0, 0, 0, 0, 1],
-                             [0, 0, 0, 1, 0, 0],
-                             [0, 1, 0, 0, 0, 0],
-                             [0, 0, 1, 0, 0, 0]])
-clifford_1q['X'] = np.matrix([[0, 0, 0, 1, 0, 0],
-                             [0, 1, 0, 0, 0, 0],
-                             [0, 0, 0, 0, 0, 1],
-                             [1, 0, 0, 0, 0, 0],
-                             [0, 0, 0, 0, 1, 0],
-                             [0, 0, 1, 0, 0, 0]])
-clifford_1q['Y'] = np.matrix([[0, 0, 0, 1, 0, 0],
-                             [0, 0, 0, 0, 1, 0],
-                             [0, 0, 1, 0, 0, 0],
-                             [1, 0, 0, 0, 0, 0],
-                             [0, 1, 0, 0, 0, 0],
-                             [0, 0, 0, 0, 0, 1]])
-clifford_1q['Z/2'] = np.matrix([[1, 0, 0, 0, 0, 0],
-                             [0, 0, 0, 0, 0, 1],
-                             [0, 1, 0, 0, 0, 0],
-                             [0, 0, 0, 1, 0, 0],
-                             [0, 0, 1, 0, 0, 0],
-                             [0, 0, 0, 0, 1, 0]])
-clifford_1q['X/2'] = np.matrix([[0, 0, 1, 0, 0, 0],
-                             [0, 1, 0, 0, 0, 0],
-                             [0, 0, 0, 1, 0, 0],
-                             [0, 0, 0, 0, 0, 1],
-                             [0, 0, 0, 0, 1, 0],
-                             [1, 0, 0, 0, 0, 0]])
-clifford_1q['Y/2'] = np.matrix([[0, 0, 0, 0, 1, 0],
-                             [1, 0, 0, 0, 0, 0],
-                             [0, 0, 1, 0, 0, 0],
-                             [0, 1, 0, 0, 0, 0],
-                             [0, 0, 0, 1, 0, 0],
-                             [0, 0, 0, 0, 0, 1]])
-clifford_1q['-Z/2'] = np.matrix([[1, 0, 0, 0, 0, 0],
-                             [0, 0, 1, 0, 0, 0],
-                             [0, 0, 0, 0, 1, 0],
-                             [0, 0, 0, 1, 0, 0],
-                             [0, 0, 0, 0, 0, 1],
-                             [0, 1, 0, 0, 0, 0]])
-clifford_1q['-X/2'] = np.matrix([[0, 0, 0, 0, 0, 1],
-                             [0, 1, 0, 0, 0, 0],
-                             [1, 0, 0, 0, 0, 0],
-                             [0, 0, 1, 0, 0, 0],
-                             [0, 0, 0, 0, 1, 0],
-                             [0, 0, 0, 1, 0, 0]])
-clifford_1q['-Y/2'] = np.matrix([[0, 1, 0, 0, 0, 0],
-                             [0, 0, 0, 1, 0, 0],
-                             [0, 0, 1, 0, 0, 0],
-                             [0, 0, 0, 0, 1, 0],
-                             [1, 0, 0, 0, 0, 0],
-                             [0, 0, 0, 0, 0, 1]])
-clifford_1q['I'] = np.diag([1]*6)
+clifford_1q['Z'] = np.array([[1, 0, 0, 0, 0, 0],
+                            [0, 0, 0, 0, 1, 0],
+                            [0, 0, 0, 0, 0, 1],
+                            [0, 0, 0, 1, 0, 0],
+                            [0, 1, 0, 0, 0, 0],
+                            [0, 0, 1, 0, 0, 0]], dtype=np.int8)
+clifford_1q['X'] = np.array([[0, 0, 0, 1, 0, 0],
+                            [0, 1, 0, 0, 0, 0],
+                            [0, 0, 0, 0, 0, 1],
+                            [1, 0, 0, 0, 0, 0],
+                            [0, 0, 0, 0, 1, 0],
+                            [0, 0, 1, 0, 0, 0]], dtype=np.int8)
+clifford_1q['Y'] = np.array([[0, 0, 0, 1, 0, 0],
+                            [0, 0, 0, 0, 1, 0],
+                            [0, 0, 1, 0, 0, 0],
+                            [1, 0, 0, 0, 0, 0],
+                            [0, 1, 0, 0, 0, 0],
+                            [0, 0, 0, 0, 0, 1]], dtype=np.int8)
+clifford_1q['Z/2'] = np.array([[1, 0, 0, 0, 0, 0],
+                            [0, 0, 0, 0, 0, 1],
+                            [0, 1, 0, 0, 0, 0],
+                            [0, 0, 0, 1, 0, 0],
+                            [0, 0, 1, 0, 0, 0],
+                            [0, 0, 0, 0, 1, 0]], dtype=np.int8)
+clifford_1q['X/2'] = np.array([[0, 0, 1, 0, 0, 0],
+                            [0, 1, 0, 0, 0, 0],
+                            [0, 0, 0, 1, 0, 0],
+                            [0, 0, 0, 0, 0, 1],
+                            [0, 0, 0, 0, 1, 0],
+                            [1, 0, 0, 0, 0, 0]], dtype=np.int8)
+clifford_1q['Y/2'] = np.array([[0, 0, 0, 0, 1, 0],
+                            [1, 0, 0, 0, 0, 0],
+                            [0, 0, 1, 0, 0, 0],
+                            [0, 1, 0, 0, 0, 0],
+                            [0, 0, 0, 1, 0, 0],
+                            [0, 0, 0, 0, 0, 1]], dtype=np.int8)
+clifford_1q['-Z/2'] = np.array([[1, 0, 0, 0, 0, 0],
+                            [0, 0, 1, 0, 0, 0],
+                            [0, 0, 0, 0, 1, 0],
+                            [0, 0, 0, 1, 0, 0],
+                            [0, 0, 0, 0, 0, 1],
+                            [0, 1, 0, 0, 0, 0]], dtype=np.int8)
+clifford_1q['-X/2'] = np.array([[0, 0, 0, 0, 0, 1],
+                            [0, 1, 0, 0, 0, 0],
+                            [1, 0, 0, 0, 0, 0],
+                            [0, 0, 1, 0, 0, 0],
+                            [0, 0, 0, 0, 1, 0],
+                            [0, 0, 0, 1, 0, 0]], dtype=np.int8)
+clifford_1q['-Y/2'] = np.array([[0, 1, 0, 0, 0, 0],
+                            [0, 0, 0, 1, 0, 0],
+                            [0, 0, 1, 0, 0, 0],
+                            [0, 0, 0, 0, 1, 0],
+                            [1, 0, 0, 0, 0, 0],
+                            [0, 0, 0, 0, 0, 1]], dtype=np.int8)
+clifford_1q['I'] = np.eye(6, dtype=np.int8)
 
 # Read pulse as a matrix product acting on state (meaning apply pulses in reverse order of the tuple)
 two_step_pulses= [
@@ -95,15 +96,14 @@ two_step_pulses= [
     ('X','-Z/2'), ('X/2','-Z/2'), ('-X/2','-Z/2'),
     ('Y','-Z/2'), ('Y/2','-Z/2'), ('-Y/2','-Z/2'),
 ]
-# Get rid of repeats
+# Get rid of repeats: a Clifford is uniquely identified by where +Z and +X go
+existing_zx = {(np.argmax(matrix[:,0]), np.argmax(matrix[:,1])) for matrix in clifford_1q.values()}
 for pulse in two_step_pulses:
     new_mat = clifford_1q[pulse[0]] @ clifford_1q[pulse[1]]
-    repeat = False
-    for existing_pulse_name, existing_pulse in clifford_1q.items():
-        if np.array_equal(new_mat, existing_pulse):
-            # print(pulse, existing_pulse_name)
-            repeat = True
-    if not repeat: clifford_1q[pulse[0]+','+pulse[1]] = new_mat
+    zx = (np.argmax(new_mat[:,0]), np.argmax(new_mat[:,1]))
+    if zx in existing_zx: continue
+    existing_zx.add(zx)
+    clifford_1q[pulse[0]+','+pulse[1]] = new_mat
 clifford_1q_names = list(clifford_1q.keys())
 
 for name, matrix in clifford_1q.items():
@@ -112,50 +112,95 @@ for name, matrix in clifford_1q.items():
     # print(name, z_new, x_new)
     clifford_1q[name] = (matrix, (z_new, x_new))
 
-def gate_sequence(rb_depth, pulse_n_seq=None, debug=False):
+"""
+Composition table for the Cliffords: clifford_compose[i, j] is the index in
+clifford_1q_names of the Clifford equivalent to applying clifford j, then
+clifford i (i.e. the matrix product M_i @ M_j). Lets gate_sequence track the
+total Clifford as a single index instead of multiplying matrices.
+"""
+# Reverse lookup from where (+Z, +X) go to the Clifford name
+clifford_1q_by_zx = {zx: name for name, (_, zx) in clifford_1q.items()}
+clifford_identity_idx = clifford_1q_names.index('I')
+clifford_compose = np.empty((len(clifford_1q_names), len(clifford_1q_names)), dtype=np.int32)
+for i, name_i in enumerate(clifford_1q_names):
+    for j, name_j in enumerate(clifford_1q_names):
+        product = clifford_1q[name_i][0] @ clifford_1q[name_j][0]
+        zx = (np.argmax(product[:,0]), np.argmax(product[:,1]))
+        clifford_compose[i, j] = clifford_1q_names.index(clifford_1q_by_zx[zx])
+# nested list copy for the per-gate lookups in gate_sequence (python list indexing is much faster than numpy scalar indexing)
+_clifford_compose_rows = clifford_compose.tolist()
+
+"""
+Decoded pulse plan for each Clifford, keyed by (name, inverted): the (axis, pihalf, neg)
+of each non-identity sub-gate in the order they are played. Normally gates are applied
+right to left; if inverted they are applied left to right with the sign flipped.
+"""
+clifford_1q_pulse_plan = dict()
+for name in clifford_1q_names:
+    gates = name.split(',')
+    for inverted in (False, True):
+        gate_order = gates if inverted else reversed(gates)
+        plan = []
+        for gate in gate_order:
+            if gate == 'I': continue
+            if 'X' in gate: axis = 'X'
+            elif 'Y' in gate: axis = 'Y'
+            elif 'Z' in gate: axis = 'Z'
+            else: assert False, 'Invalid gate'
+            plan.append((axis, '/2' in gate, ('-' in gate) != inverted))
+        clifford_1q_pulse_plan[name, inverted] = tuple(plan)
+
+@functools.lru_cache(maxsize=4096)
+def _total_clifford_idx(pulse_n_seq:tuple):
+    """
+    Index of the Clifford equivalent to the sequence of Clifford indices pulse_n_seq
+    (cached, so replayed sequences e.g. from a fixed seed are not recomposed)
+    """
+    total_idx = clifford_identity_idx
+    for n in pulse_n_seq: # n is index in clifford_1q_names; each new gate acts on the left of the total so far
+        total_idx = _clifford_compose_rows[n][total_idx]
+    return total_idx
+
+def gate_sequence(rb_depth, pulse_n_seq=None, debug=False, return_idx=False):
     """
     Generate RB forward gate sequence of length rb_depth as a list of pulse names;
     also return the Clifford gate that is equivalent to the total pulse sequence.
     The effective inverse is pi phase + the total Clifford.
     Optionally, provide pulse_n_seq which is a list of the indices of the Clifford
     gates to apply in the sequence.
+    If return_idx, return the gates and total Clifford as indices in clifford_1q_names
+    instead of names.
     """
-    if pulse_n_seq == None: 
-        pulse_n_seq = (len(clifford_1q_names)*np.random.rand(rb_depth)).astype(int)
+    if pulse_n_seq is None:
+        pulse_n_seq = np.random.randint(len(clifford_1q_names), size=rb_depth)
     if debug: print('pulse seq', pulse_n_seq)
-    pulse_name_seq = [clifford_1q_names[n] for n in pulse_n_seq]
-    psi_nz = np.matrix([[1, 0, 0, 0, 0, 0]]).transpose()
-    psi_nx = np.matrix([[0, 1, 0, 0, 0, 0]]).transpose()
-    for n in pulse_n_seq: # n is index in clifford_1q_names
-        gates = clifford_1q_names[n].split(',')
-        for gate in reversed(gates): # Apply matrices from right to left of gates
-            psi_nz = clifford_1q[gate][0] @ psi_nz
-            psi_nx = clifford_1q[gate][0] @ psi_nx
-    psi_nz = psi_nz.flatten()
-    psi_nx = psi_nx.flatten()
-    if debug: print('+Z axis after seq:', psi_nz, '+X axis after seq:', psi_nx)
-    for clifford in clifford_1q_names: # Get the clifford equivalent to the total seq
-        if clifford_1q[clifford][1] == (np.argmax(psi_nz), np.argmax(psi_nx)):
-            total_clifford = clifford
-            break
+    pulse_n_seq = np.asarray(pulse_n_seq).tolist()
+    total_idx = _total_clifford_idx(tuple(pulse_n_seq))
+    total_clifford = clifford_1q_names[total_idx]
+    if debug: print('+Z axis after seq:', clifford_1q[total_clifford][1][0], '+X axis after seq:', clifford_1q[total_clifford][1][1])
     if debug: print('Total gate matrix:\n', clifford_1q[total_clifford][0])
+    if return_idx: return pulse_n_seq, total_idx
+    pulse_name_seq = [clifford_1q_names[n] for n in pulse_n_seq]
     return pulse_name_seq, total_clifford
 
-def interleaved_gate_sequence(rb_depth, gate_char:str, debug=False):
+def interleaved_gate_sequence(rb_depth, gate_char:str, pulse_n_seq_rand=None, debug=False, return_idx=False):
     """
     Generate RB gate sequence with rb_depth random gates interleaved with gate_char
     Returns the total gate list (including the interleaved gates) and the total
     Clifford gate equivalent to the total pulse sequence.
+    Optionally, provide pulse_n_seq_rand which is the list of indices of the
+    rb_depth random Clifford gates.
+    If return_idx, return indices in clifford_1q_names instead of names.
     """
-    pulse_n_seq_rand = (len(clifford_1q_names)*np.random.rand(rb_depth)).astype(int)
-    pulse_n_seq = []
+    if pulse_n_seq_rand is None:
+        pulse_n_seq_rand = np.random.randint(len(clifford_1q_names), size=rb_depth)
     assert gate_char in clifford_1q_names
     n_gate_char = clifford_1q_names.index(gate_char)
     if debug: print('n gate char:', n_gate_char, clifford_1q_names[n_gate_char])
-    for n_rand in pulse_n_seq_rand:
-        pulse_n_seq.append(n_rand)
-        pulse_n_seq.append(n_gate_char)
-    return gate_sequence(len(pulse_n_seq), pulse_n_seq=pulse_n_seq, debug=debug)    
+    pulse_n_seq = np.empty(2*len(pulse_n_seq_rand), dtype=int)
+    pulse_n_seq[0::2] = pulse_n_seq_rand
+    pulse_n_seq[1::2] = n_gate_char
+    return gate_sequence(len(pulse_n_seq), pulse_n_seq=pulse_n_seq, debug=debug, return_idx=return_idx)
 
 if __name__ == '__main__':
     print('Clifford gates:', clifford_1q_names)
@@ -177,35 +222,25 @@ class SimultaneousRBProgram(QutritAveragerProgram):
     RB program for single qubit gates
     """
 
-    def clifford(self, qubit, pulse_name:str, extra_phase=0, inverted=False, play=False):
+    def clifford(self, qubit, pulse_name, extra_phase=0, inverted=False, play=False):
         """
-        Convert a clifford pulse name into the function that performs the pulse.
+        Convert a clifford pulse name (or its index in clifford_1q_names) into the function that performs the pulse.
         If inverted, play the inverse of this gate (the extra phase is added on top of the inversion)
         """
-        pulse_name = pulse_name.upper()
-        assert pulse_name in clifford_1q_names
-        gates = pulse_name.split(',')
-
-        # Normally gates are applied right to left, but if inverted apply them left to right
-        gate_order = reversed(gates)
-        if inverted:
-            gate_order = gates
-        for gate in gate_order:
-            pulse_func = None
-            if gate == 'I': continue
-            if 'X' in gate: pulse_func = self.X_pulse
-            elif 'Y' in gate: pulse_func = self.Y_pulse
-            elif 'Z' in gate: pulse_func = self.Z_pulse
-            else: assert False, 'Invalid gate'
-
-            neg = '-' in gate
-            if inverted: neg = not neg
-            # pulse_func(qubit, pihalf='/2' in gate, neg=neg, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
-            pulse_func(qubit, pihalf='/2' in gate, neg=neg, divide_len=False, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
+        if isinstance(pulse_name, str):
+            pulse_name = pulse_name.upper()
+            assert pulse_name in clifford_1q_names
+        else: pulse_name = clifford_1q_names[pulse_name]
+        pulse_funcs = dict(X=self.X_pulse, Y=self.Y_pulse, Z=self.Z_pulse)
+
+        # Plan is already in play order (and sign flipped if inverted), see clifford_1q_pulse_plan
+        for axis, pihalf, neg in clifford_1q_pulse_plan[pulse_name, inverted]:
+            # pulse_funcs[axis](qubit, pihalf=pihalf, neg=neg, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
+            pulse_funcs[axis](qubit, pihalf=pihalf, neg=neg, divide_len=False, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
             # print(self.overall_phase[qubit])
 
     def __init__(self, soccfg, cfg, gate_list, qubit_list):
-        # gate_list should include the total gate!
+        # gate_list should include the total gate! gates can be given as names or indices in clifford_1q_names
         # qubit_list should specify the qubit on which each random gate will be applied
         self.gate_list = gate_list
         self.qubit_list = qubit_list
@@ -225,14 +260,16 @@ class SimultaneousRBProgram(QutritAveragerProgram):
         assert num_rb_qubits == 1, 'only support 1 qubit in rb right now'
 
         # Do all the gates given in the initialize except for the total gate, measure
-        cfg=AttrDict(self.cfg)
-        for i in range(len(self.gate_list) - 1):
-            self.clifford(qubit=self.qubit_list[i], pulse_name=self.gate_list[i], play=True)
-            self.sync_all()
+        cfg = self.cfg
+        gate_list, qubit_list = self.gate_list, self.qubit_list
+        clifford, sync_all = self.clifford, self.sync_all
+        for i in range(len(gate_list) - 1):
+            clifford(qubit=qubit_list[i], pulse_name=gate_list[i], play=True)
+            sync_all()
 
         # Do the inverse by applying the total gate with pi phase
         # This is actually wrong if there is more than 1 qubit!!! need to apply an inverse total gate for each qubit!!
-        self.clifford(qubit=self.qubit_list[-1], pulse_name=self.gate_list[-1], inverted=True, play=True)
+        clifford(qubit=qubit_list[-1], pulse_name=gate_list[-1], inverted=True, play=True)
         self.sync_all() # align channels and wait 10ns
 
         self.measure(
@@ -258,6 +295,7 @@ class SimultaneousRBExperiment(Experiment):
         qubits: the qubits to perform simultaneous RB on. If using EgGf subspace, specify just qA (where qA, qB represents the Eg->Gf qubits)
         singleshot_reps: reps per state for singleshot calibration
         post_process: 'threshold' (uses single shot binning), 'scale' (scale by ge_avgs), or None
+        seed: (optional) seed for drawing the random Clifford sequences, to replay the same sequences
         thresholds: (optional) don't rerun singleshot and instead use this
         ge_avgs: (optional) don't rerun singleshot and instead use this
         angles: (optional) don't rerun singleshot and instead use this
@@ -274,16 +312,7 @@ class SimultaneousRBExperiment(Experiment):
 
         # expand entries in config that are length 1 to fill all qubits
         num_qubits_sample = len(self.cfg.device.readout.frequency)
-        for subcfg in (self.cfg.device.readout, self.cfg.device.qubit, self.cfg.hw.soc):
-            for key, value in subcfg.items() :
-                if isinstance(value, dict):
-                    for key2, value2 in value.items():
-                        for key3, value3 in value2.items():
-                            if not(isinstance(value3, list)):
-                                value2.update({key3: [value3]*num_qubits_sample})                                
-                elif not(isinstance(value, list)):
-                    subcfg.update({key: [value]*num_qubits_sample})
-
+        expand_cfg(self.cfg, num_qubits_sample)
 
         if 'use_EgGf_subspace' in self.cfg.expt and self.cfg.expt.use_EgGf_subspace:
             assert False, 'use the RbEgGfExperiment!'
@@ -311,7 +340,9 @@ class SimultaneousRBExperiment(Experiment):
 
         else:
             # Error mitigation measurements: prep in g, e to recalibrate measurement angle and measure confusion matrix
-            sscfg = AttrDict(deepcopy(self.cfg))
+            # only the expt fields are changed for the calibration (here and by the programs), so just copy expt instead of the whole cfg
+            sscfg = AttrDict(self.cfg)
+            sscfg.expt = AttrDict(dict(self.cfg.expt))
             sscfg.expt.qubit = self.qubit
             sscfg.expt.reps = self.cfg.expt.singleshot_reps
 
@@ -356,19 +387,34 @@ class SimultaneousRBExperiment(Experiment):
         # ================= #
 
         if 'shot_avg' not in self.cfg.expt: self.cfg.expt.shot_avg=1
-        data.update({"xpts":[], "popln":[], "popln_err":[]})
 
         depths = self.cfg.expt.start + self.cfg.expt.step * np.arange(self.cfg.expt.expts)
+        # a seeded generator replays the same sequences (and hits the total Clifford cache); otherwise use the global np.random state
+        rng = np.random.RandomState(self.cfg.expt.seed) if self.cfg.expt.get('seed') is not None else np.random
+        # (depth, variation) grids; popln_err is only measured without threshold post processing and stays nan otherwise
+        # popln starts as nan so an entry that was never written is not mistaken for a measurement (analyze skips such depths)
+        data.update({
+            "xpts":np.repeat(depths[:, np.newaxis], self.cfg.expt.variations, axis=1),
+            "popln":np.full((self.cfg.expt.expts, self.cfg.expt.variations), np.nan),
+            "popln_err":np.full((self.cfg.expt.expts, self.cfg.expt.variations), np.nan),
+        })
+        if self.cfg.expt.post_process == 'threshold':
+            # raw g, e counts per sequence; readout error correction is applied to all of them at once after the sweep
+            data['counts_raw'] = np.empty((self.cfg.expt.expts, self.cfg.expt.variations, 2), dtype=np.int64)
         tomo_analysis = TomoAnalysis(nb_qubits=1)
-        for depth in tqdm(depths):
+        irb = 'gate_char' in self.cfg.expt and self.cfg.expt.gate_char is not None
+        adc_ch = self.cfg.hw.soc.adcs.readout.ch[qubits[0]]
+        assert self.cfg.expt.post_process is not None, 'need post processing for RB to make sense!'
+        for i_depth, depth in enumerate(tqdm(depths)):
             # print(f'depth {depth} gate list (last gate is the total gate)')
-            data['xpts'].append([])
-            data["popln"].append([])
-            data["popln_err"].append([])
+            # draw the random Cliffords and the qubit for each gate (excluding the total gate) for all variations at this depth at once
+            pulse_n_seqs = rng.randint(len(clifford_1q_names), size=(self.cfg.expt.variations, depth))
+            qubit_lists = rng.choice(self.cfg.expt.qubits, size=(self.cfg.expt.variations, 2*depth if irb else depth))
             for var in range(self.cfg.expt.variations):
-                if 'gate_char' in self.cfg.expt and self.cfg.expt.gate_char is not None:
-                    gate_list, total_gate = interleaved_gate_sequence(depth, gate_char=self.cfg.expt.gate_char)
-                else: gate_list, total_gate = gate_sequence(depth)
+                # gates as indices in clifford_1q_names, the program resolves them directly to pulse plans
+                if irb:
+                    gate_list, total_gate = interleaved_gate_sequence(depth, gate_char=self.cfg.expt.gate_char, pulse_n_seq_rand=pulse_n_seqs[var], return_idx=True)
+                else: gate_list, total_gate = gate_sequence(depth, pulse_n_seq=pulse_n_seqs[var], return_idx=True)
                 gate_list.append(total_gate) # make sure to do the inverse gate
 
                 # print(gate_list)
@@ -394,7 +440,8 @@ class SimultaneousRBExperiment(Experiment):
 
 
                 # print('variation', var)
-                qubit_list = np.random.choice(self.cfg.expt.qubits, size=len(gate_list)-1)
+                qubit_list = qubit_lists[var]
+                assert len(qubit_list) == len(gate_list)-1
 
                 randbench = SimultaneousRBProgram(soccfg=self.soccfg, cfg=self.cfg, gate_list=gate_list, qubit_list=qubit_list)
                 # print(randbench)
@@ -402,26 +449,23 @@ class SimultaneousRBExperiment(Experiment):
                 # # print(progs2json([randbench.dump_prog()]))
 
 
-                assert self.cfg.expt.post_process is not None, 'need post processing for RB to make sense!'
                 popln, popln_err = randbench.acquire_rotated(soc=self.im[self.cfg.aliases.soc], progress=False, angle=angles_q, threshold=thresholds_q, ge_avgs=ge_avgs_q, post_process=self.cfg.expt.post_process)
 
-                adc_ch = self.cfg.hw.soc.adcs.readout.ch[qubits[0]]
-
                 if self.cfg.expt.post_process == 'threshold':
                     shots, _ = randbench.get_shots(angle=angles_q, threshold=thresholds_q)
                     # 0, 1
-                    counts = np.array([tomo_analysis.sort_counts([shots[adc_ch]])])
-                    data['counts_raw'].append(counts)
-                    tomo_analysis = TomoAnalysis(nb_qubits=1, tomo_qubits=qubits)
-                    counts = tomo_analysis.fix_neg_counts(tomo_analysis.correct_readout_err(counts, data['counts_calib']))
-                    counts = counts[0] # go back to just 1d array
-                    data["popln"][-1].append(counts[1]/sum(counts))
-                    # print('variation', var, 'gate list', gate_list, 'counts', counts)
+                    data['counts_raw'][i_depth, var] = tomo_analysis.sort_counts([shots[adc_ch]])
+                    # print('variation', var, 'gate list', gate_list, 'counts', data['counts_raw'][i_depth, var])
                 else:
-                    data["popln"][-1].append(popln[adc_ch])
+                    data["popln"][i_depth, var] = popln[adc_ch]
                     # print(depth, var, iq, avgi)
-                    data["popln_err"][-1].append(popln_err[adc_ch])
-                data['xpts'][-1].append(depth)
+                    data["popln_err"][i_depth, var] = popln_err[adc_ch]
+
+        if self.cfg.expt.post_process == 'threshold':
+            tomo_analysis = TomoAnalysis(nb_qubits=1, tomo_qubits=qubits)
+            counts = np.reshape(data['counts_raw'], (-1, 2))
+            counts = tomo_analysis.fix_neg_counts(tomo_analysis.correct_readout_err(counts, data['counts_calib']))
+            data["popln"] = np.reshape(counts[:,1]/np.sum(counts, axis=1), (self.cfg.expt.expts, self.cfg.expt.variations))
 
         for k, a in data.items():
             data[k] = np.array(a)
@@ -443,31 +487,18 @@ class SimultaneousRBExperiment(Experiment):
         data['med_probs'] = [None] * len(qubits)
         data['avg_probs'] = [None] * len(qubits)
 
-        probs = np.zeros_like(data['popln'])
-        for depth in range(len(data['popln'])):
-            probs[depth] = 1 - np.asarray(data['popln'][depth])
-        probs = np.asarray(probs)
+        # popln, xpts are (expts, variations)
+        probs = 1 - np.asarray(data['popln'])
         data['xpts'] = np.asarray(data['xpts'])
         data['probs'] = probs
-        # probs = np.reshape(probs, (self.cfg.expt.expts, self.cfg.expt.variations))
-        std_dev_probs = []
-        med_probs = []
-        avg_probs = []
-        working_depths = []
         depths = data['xpts']
-        for depth in range(len(probs)):
-            probs_depth = probs[depth]
-            if len(probs_depth) > 0:
-                std_dev_probs.append(np.std(probs_depth))
-                med_probs.append(np.median(probs_depth))
-                avg_probs.append(np.average(probs_depth))
-                working_depths.append(depths[depth][0])
-        std_dev_probs = np.asarray(std_dev_probs)
-        med_probs = np.asarray(med_probs)
-        avg_probs = np.asarray(avg_probs)
-        working_depths = np.asarray(working_depths)
-        flat_depths = np.concatenate(depths)
-        flat_probs = np.concatenate(data['probs'])
+        # only keep depths where every variation was measured
+        working = (~np.isnan(probs)).all(axis=1)
+        working_probs = probs[working]
+        std_dev_probs = np.std(working_probs, axis=1)
+        med_probs = np.median(working_probs, axis=1)
+        avg_probs = np.mean(working_probs, axis=1)
+        working_depths = depths[working, 0]
         # depths = self.cfg.expt.start + self.cfg.expt.step * np.arange(self.cfg.expt.expts)
         # popt, pcov = fitter.fitrb(depths[:-4], med_probs[:-4])
         # popt, pcov = fitter.fitrb(depths, med_probs)
@@ -478,7 +509,17 @@ class SimultaneousRBExperiment(Experiment):
         data['avg_probs'] = avg_probs
         data['working_depths'] = working_depths
         if fit:
-            popt, pcov = fitter.fitrb(flat_depths, flat_probs)
+            # fit the mean over variations at each depth weighted by its standard error (expts instead of expts*variations points)
+            # with absolute_sigma, fit_err is the covariance implied by those standard errors, not the pcov of a fit to all variations
+            # the standard error is floored at the binomial shot noise of the mean, sqrt(p(1-p)/(reps*variations)), so a depth
+            # whose variations happen to agree doesn't get an unphysically large weight
+            num_variations = working_probs.shape[1]
+            if num_variations > 1:
+                n_shots = self.cfg.expt.reps * num_variations
+                p_floor = np.clip(avg_probs, 1/n_shots, 1 - 1/n_shots)
+                sigma = np.maximum(std_dev_probs/np.sqrt(num_variations), np.sqrt(p_floor*(1 - p_floor)/n_shots))
+                popt, pcov = fitter.fitrb(working_depths, avg_probs, sigma=sigma, absolute_sigma=True)
+            else: popt, pcov = fitter.fitrb(working_depths, avg_probs)
             data['fit'] = popt
             data['fit_err'] = pcov
             data['error'] = fitter.rb_error(popt[0], d=2)
@@ -542,30 +583,14 @@ class SimultaneousRBEFProgram(QutritAveragerProgram):
         """
         pulse_name = pulse_name.upper()
         assert pulse_name in clifford_1q_names
-        gates = pulse_name.split(',')
-
-        # Normally gates are applied right to left, but if inverted apply them left to right
-        gate_order = reversed(gates)
-        if inverted:
-            gate_order = gates
-        for gate in gate_order:
-            pulse_func = None
-            if gate == 'I': continue
-            if 'X' in gate: pulse_func = self.Xef_pulse
-            elif 'Y' in gate: pulse_func = self.Yef_pulse
-            elif 'Z' in gate: pulse_func = self.Zef_pulse
-            # if 'X' in gate: pulse_func = self.X_pulse
-            # elif 'Y' in gate: pulse_func = self.Y_pulse
-            # elif 'Z' in gate: pulse_func = self.Z_pulse
-            else: assert False, 'Invalid gate'
-
-            neg = '-' in gate
-            if inverted: neg = not neg
-
+        pulse_funcs = dict(X=self.Xef_pulse, Y=self.Yef_pulse, Z=self.Zef_pulse)
+        # pulse_funcs = dict(X=self.X_pulse, Y=self.Y_pulse, Z=self.Z_pulse)
 
+        # Plan is already in play order (and sign flipped if inverted), see clifford_1q_pulse_plan
+        for axis, pihalf, neg in clifford_1q_pulse_plan[pulse_name, inverted]:
             # print('WARNING NOT PLAYING PULSE')
-            # pulse_func(qubit, pihalf='/2' in gate, neg=neg, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
-            pulse_func(qubit, pihalf='/2' in gate, ZZ_qubit=ZZ_qubit, neg=neg, divide_len=False, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
+            # pulse_funcs[axis](qubit, pihalf=pihalf, neg=neg, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
+            pulse_funcs[axis](qubit, pihalf=pihalf, ZZ_qubit=ZZ_qubit, neg=neg, divide_len=False, extra_phase=extra_phase, play=play, reload=False) # very important to not reload unless necessary to save memory on the gen
             self.sync_all(5) # THIS IS NECESSARY IN RB WHEN THERE ARE MORE THAN O(30) PULSES SINCE THE TPROC CAN'T KEEP UP FOR SHORT PULSES
 
     def __init__(self, soccfg, cfg, gate_list, qubit_list):
@@ -641,6 +666,7 @@ class SimultaneousRBEFExperiment(Experiment):
         qubits: [qTest]
         singleshot_reps: reps per state for singleshot calibration
         post_process: 'threshold' (uses single shot binning), 'scale' (scale by ge_avgs), or None
+        seed: (optional) seed for drawing the random Clifford sequences, to replay the same sequences
         ZZ_qubit: if not None, initializes this qubit in e in addition to the qubit we are doing the EF RB on
         test_qZZ: plays the pulse on qTest that is ZZ shifted by test_qZZ for all clifford gates
         measure_f: qubit: if not None, calibrates the single qubit f state measurement on this qubit and also runs the measurement twice to distinguish e and f states
@@ -705,6 +731,8 @@ class SimultaneousRBEFExperiment(Experiment):
             data['counts_calib_f_loops'] = []
         data['xpts'] = []
         depths = self.cfg.expt.start + self.cfg.expt.step * np.arange(self.cfg.expt.expts)
+        # a seeded generator replays the same sequences (and hits the total Clifford cache); otherwise use the global np.random state
+        rng = np.random.RandomState(self.cfg.expt.seed) if self.cfg.expt.get('seed') is not None else np.random
         gate_list_variations = [None]*len(depths)
 
         if 'loops' not in self.cfg.expt: self.cfg.expt.loops = 1
@@ -796,11 +824,13 @@ class SimultaneousRBEFExperiment(Experiment):
                 if loop == 0:
                     data['xpts'].append([])
                     gate_list_variations[i_depth] = []
+                    # draw the random Cliffords for all variations at this depth at once
+                    pulse_n_seqs = rng.randint(len(clifford_1q_names), size=(self.cfg.expt.variations, depth))
                 for var in range(self.cfg.expt.variations):
                     if loop == 0:
                         if 'gate_char' in self.cfg.expt and self.cfg.expt.gate_char is not None:
-                            gate_list, total_gate = interleaved_gate_sequence(depth, gate_char=self.cfg.expt.gate_char)
-                        else: gate_list, total_gate = gate_sequence(depth)
+                            gate_list, total_gate = interleaved_gate_sequence(depth, gate_char=self.cfg.expt.gate_char, pulse_n_seq_rand=pulse_n_seqs[var])
+                        else: gate_list, total_gate = gate_sequence(depth, pulse_n_seq=pulse_n_seqs[var])
                         gate_list.append(total_gate) # make sure to do the inverse gate
 
                         # gate_list = ['X', '-X/2,Z', 'Y/2', '-X/2,-Z/2', '-Y/2,Z', '-Z/2', 'X', 'Y']
@@ -1215,25 +1245,11 @@ class RBEgGfProgram(CliffordEgGfAveragerProgram):
         """
         pulse_name = pulse_name.upper()
         assert pulse_name in clifford_1q_names
-        gates = pulse_name.split(',')
+        pulse_funcs = dict(X=self.XEgGf_pulse, Y=self.YEgGf_pulse, Z=self.ZEgGf_pulse)
 
-        # Normally gates are applied right to left, but if inverted apply them left to right
-        gate_order = reversed(gates)
-        if inverted:
-            gate_order = gates
-        for gate in gate_order:
-            pulse_func = None
-            if gate == 'I': continue
-            if 'X' in gate:
-                pulse_func = self.XEgGf_pulse
-            elif 'Y' in gate:
-                pulse_func = self.YEgGf_pulse
-            elif 'Z' in gate:pulse_func = self.ZEgGf_pulse
-            else: assert False, 'Invalid gate'
-
-            neg = '-' in gate
-            if inverted: neg = not neg
-            pulse_func(qDrive=qDrive, qNotDrive=qNotDrive, pihalf='/2' in gate, neg=neg, extra_phase=extra_phase, add_virtual_Z=add_virtual_Z, play=play, reload=False)
+        # Plan is already in play order (and sign flipped if inverted), see clifford_1q_pulse_plan
+        for axis, pihalf, neg in clifford_1q_pulse_plan[pulse_name, inverted]:
+            pulse_funcs[axis](qDrive=qDrive, qNotDrive=qNotDrive, pihalf=pihalf, neg=neg, extra_phase=extra_phase, add_virtual_Z=add_virtual_Z, play=play, reload=False)
             # print(self.overall_phase[qubit])
             self.sync_all(5) # THIS IS NECESSARY IN RB WHEN THERE ARE MORE THAN O(30) PULSES SINCE THE TPROC CAN'T KEEP UP FOR SHORT PULSES
 
@@ -1305,30 +1321,27 @@ class SimultaneousRBEgGfExperiment(Experiment):
         qubits: the qubits to perform simultaneous RB on. If using EgGf subspace, specify just qA (where qA, qB represents the Eg->Gf qubits)
         singleshot_reps: reps per state for singleshot calibration
         post_process: 'threshold' (uses single shot binning), 'scale' (scale by ge_avgs), or None
+        seed: (optional) seed for drawing the random Clifford sequences, to replay the same sequences
         measure_f: qubit: if not None, calibrates the single qubit f state measurement on this qubit and also runs the measurement twice to distinguish e and f states
-        thresholds: (optional) don't rerun singleshot and instead use this
+        plot_calib: (optional) if True, plot the single shot histograms of each qubit during calibration (default False)
+        reuse_calib: (optional) if True, reuse the g/e singleshot calibration from a previous loop or acquire of this experiment as long as the singleshot calibration cfg is unchanged
+        thresholds: (optional) don't rerun singleshot and instead use this (only together with angles)
         ge_avgs: (optional) don't rerun singleshot and instead use this
-        angles: (optional) don't rerun singleshot and instead use this
+        angles: (optional) don't rerun singleshot and instead use this (only together with thresholds)
+        counts_calib: (optional) don't rerun the confusion matrix calibration and instead use this
     )
     """
 
     def __init__(self, soccfg=None, path='', prefix='SimultaneousRBEgGf', config_file=None, progress=None):
         super().__init__(path=path, soccfg=soccfg, prefix=prefix, config_file=config_file, progress=progress)
+        self._calib_cache = dict() # g/e singleshot calibration key -> (thresholds, angles, ge_avgs, counts_calib, fids), used if expt.reuse_calib
 
     def acquire(self, progress=False, debug=False):
         qubits = self.cfg.expt.qubits
 
         # expand entries in config that are length 1 to fill all qubits
         num_qubits_sample = len(self.cfg.device.readout.frequency)
-        for subcfg in (self.cfg.device.readout, self.cfg.device.qubit, self.cfg.hw.soc):
-            for key, value in subcfg.items() :
-                if isinstance(value, dict):
-                    for key2, value2 in value.items():
-                        for key3, value3 in value2.items():
-                            if not(isinstance(value3, list)):
-                                value2.update({key3: [value3]*num_qubits_sample})                                
-                elif not(isinstance(value, list)):
-                    subcfg.update({key: [value]*num_qubits_sample})
+        expand_cfg(self.cfg, num_qubits_sample)
 
         qA, qB = self.cfg.expt.qubits
         self.measure_f = False
@@ -1354,11 +1367,14 @@ class SimultaneousRBEgGfExperiment(Experiment):
         else: qNotDrive = qA
         self.qDrive = qDrive
         self.qNotDrive = qNotDrive
+        adcDrive_ch = self.cfg.hw.soc.adcs.readout.ch[qDrive]
+        adcNotDrive_ch = self.cfg.hw.soc.adcs.readout.ch[qNotDrive]
         
-        data={'counts_raw':[[]]}
+        data=dict()
+        plot_calib = self.cfg.expt.get('plot_calib', False)
+        num_readouts = 1
         if self.cfg.expt.measure_f is not None:
-            for i in range(len(self.cfg.expt.measure_f)): # measure g of everybody, second measurement of each measure_f qubit using the g/f readout
-                data['counts_raw'].append([])
+            num_readouts += len(self.cfg.expt.measure_f) # measure g of everybody, second measurement of each measure_f qubit using the g/f readout
 
         thresholds_q = ge_avgs_q = angles_q = fids_q = None
         if 'post_process' not in self.cfg.expt.keys(): # threshold or scale
@@ -1371,17 +1387,78 @@ class SimultaneousRBEgGfExperiment(Experiment):
         data['angles_loops'] = []
         data['ge_avgs_loops'] = []
         data['counts_calib_loops'] = []
+        data['fids_loops'] = []
 
         if self.measure_f:
             data['thresholds_f_loops'] = []
             data['angles_f_loops'] = []
             data['gf_avgs_loops'] = []
             data['counts_calib_f_loops'] = []
-        data['xpts'] = []
+            data['fids_f_loops'] = []
         depths = self.cfg.expt.start + self.cfg.expt.step * np.arange(self.cfg.expt.expts)
-        gate_list_variations = [None]*len(depths)
+        data['xpts'] = np.repeat(depths[:, np.newaxis], self.cfg.expt.variations, axis=1)
+
+        # Draw the gate lists for all depths and variations up front; every loop (and the measure_f pass) plays the same gate lists
+        # a seeded generator replays the same sequences (and hits the total Clifford cache); otherwise use the global np.random state
+        rng = np.random.RandomState(self.cfg.expt.seed) if self.cfg.expt.get('seed') is not None else np.random
+        gate_list_variations = []
+        for depth in depths:
+            pulse_n_seqs = rng.randint(len(clifford_1q_names), size=(self.cfg.expt.variations, depth))
+            gate_list_variations.append([])
+            for var in range(self.cfg.expt.variations):
+                if 'gate_char' in self.cfg.expt and self.cfg.expt.gate_char is not None:
+                    gate_list, total_gate = interleaved_gate_sequence(depth, gate_char=self.cfg.expt.gate_char, pulse_n_seq_rand=pulse_n_seqs[var])
+                else: gate_list, total_gate = gate_sequence(depth, pulse_n_seq=pulse_n_seqs[var])
+                gate_list.append(total_gate) # make sure to do the inverse gate
+
+                # gate_list = ['X', '-X/2,Z', 'Y/2', '-X/2,-Z/2', '-Y/2,Z', '-Z/2', 'X', 'Y']
+                # gate_list = ['X', 'X', 'I']
+                # print('variation', var)
+                # print(gate_list)
+                # gate_list = ['X/2', 'Z/2', '-Y/2', 'I']
+
+                gate_list_variations[-1].append(gate_list)
 
         if 'loops' not in self.cfg.expt: self.cfg.expt.loops = 1
+        # raw 2q counts of each sequence, binned directly into place: (readout, loop, depth, variation, 4)
+        data['counts_raw'] = np.zeros((num_readouts, self.cfg.expt.loops, len(depths), self.cfg.expt.variations, 4), dtype=np.int64)
+        # programs built in the first loop are reused in later loops (same gate lists and cfg, calibrations are only passed at acquire time)
+        rb_progs = [[None]*self.cfg.expt.variations for _ in depths]
+        rb_progs_f = [[None]*self.cfg.expt.variations for _ in depths]
+
+        if self.measure_f:
+            # cfg for the RB programs measured with the g/f readout; the same for every loop and variation
+            rbcfg = deepcopy(self.cfg)
+            rbcfg.device.readout.frequency[q_measure_f] = rbcfg.device.readout.frequency_ef[q_measure_f]
+            rbcfg.device.readout.readout_length[q_measure_f] = rbcfg.device.readout.readout_length_ef[q_measure_f]
+
+        if 'shot_avg' not in self.cfg.expt: self.cfg.expt.shot_avg=1
+
+        # We really just need the single shot plots here, but convenient to use the ErrorMitigation tomo to do it
+        # the same for every loop, so it is also what the g/e calibration is cached on
+        sscfg_ge = AttrDict(deepcopy(self.cfg))
+        sscfg_ge.expt.reps = sscfg_ge.expt.singleshot_reps
+        sscfg_ge.expt.tomo_qubits = self.cfg.expt.qubits
+        calib_key = None
+        if self.cfg.expt.get('reuse_calib', False):
+            calib_key = json.dumps(sscfg_ge, sort_keys=True, default=cfg_json_default)
+
+        # each of angles+thresholds, ge_avgs, counts_calib that is provided is reused on its own and only the rest is measured
+        # angles and thresholds only come as a pair, since a threshold is only meaningful at the angle it was found at
+        provided_ro = 'angles' in self.cfg.expt and 'thresholds' in self.cfg.expt
+        provided_avgs = 'ge_avgs' in self.cfg.expt
+        provided_counts = 'counts_calib' in self.cfg.expt
+        # the g/e histograms only need gg and the single qubit e states; counts_calib needs every calib state
+        calib_ge_states = ['gg'] + ['gg'[:qi] + 'e' + 'gg'[qi+1:] for qi in range(len(sscfg_ge.expt.tomo_qubits))]
+        calib_states = calib_ge_states if provided_counts else self.calib_order
+
+        def build_rb_prog(progs, cfg, i_depth, var):
+            # programs built in the first loop are cached in progs
+            if progs[i_depth][var] is None:
+                progs[i_depth][var] = RBEgGfProgram(soccfg=self.soccfg, cfg=cfg, gate_list=gate_list_variations[i_depth][var], qubits=self.cfg.expt.qubits, qDrive=self.cfg.expt.qDrive)
+            return progs[i_depth][var]
+        rb_keys = [(i_depth, var) for i_depth in range(len(depths)) for var in range(self.cfg.expt.variations)]
+
         print('running', self.cfg.expt.loops, 'loops')
         for loop in tqdm(range(self.cfg.expt.loops), disable=not progress or self.cfg.expt.loops == 1):
 
@@ -1389,12 +1466,20 @@ class SimultaneousRBEgGfExperiment(Experiment):
             # Get single shot calibration for all qubits
             # ================= #
 
-            if 'angles' in self.cfg.expt and 'thresholds' in self.cfg.expt and 'ge_avgs' in self.cfg.expt and 'counts_calib' in self.cfg.expt:
+            if provided_ro and provided_avgs and provided_counts:
                 angles_q = self.cfg.expt.angles
                 thresholds_q = self.cfg.expt.thresholds
                 ge_avgs_q = np.asarray(self.cfg.expt.ge_avgs)
                 counts_calib = self.cfg.expt.counts_calib
                 print('Re-using provided angles, thresholds, ge_avgs')
+            elif calib_key in self._calib_cache:
+                thresholds_q, angles_q, ge_avgs_q, counts_calib, fids_q = self._calib_cache[calib_key]
+                print('Re-using angles, thresholds, ge_avgs, counts_calib from previous calibration with the same config')
+                data['thresholds_loops'].append(thresholds_q)
+                data['angles_loops'].append(angles_q)
+                data['ge_avgs_loops'].append(ge_avgs_q)
+                data['counts_calib_loops'].append(np.array(counts_calib))
+                data['fids_loops'].append(fids_q)
             else:
                 thresholds_q = [0]*4
                 ge_avgs_q = [np.zeros(4), np.zeros(4), np.zeros(4), np.zeros(4)]
@@ -1402,42 +1487,55 @@ class SimultaneousRBEgGfExperiment(Experiment):
                 fids_q = [0]*4
                 counts_calib = []
 
-                # We really just need the single shot plots here, but convenient to use the ErrorMitigation tomo to do it
-                sscfg = AttrDict(deepcopy(self.cfg))
-                sscfg.expt.reps = sscfg.expt.singleshot_reps
-                sscfg.expt.tomo_qubits = self.cfg.expt.qubits
-                qA, qB = sscfg.expt.tomo_qubits
+                def build_calib_prog(prep_state):
+                    # print(prep_state)
+                    sscfg_ge.expt.state_prep_kwargs = dict(prep_state=prep_state, apply_q1_pi2=False)
+                    return ErrorMitigationStateTomo2QProgram(soccfg=self.soccfg, cfg=sscfg_ge)
 
+                # the program for the next prep state is built in the background while the current one is acquired
                 calib_prog_dict = dict()
-                for prep_state in tqdm(self.calib_order):
-                    # print(prep_state)
-                    sscfg.expt.state_prep_kwargs = dict(prep_state=prep_state, apply_q1_pi2=False)
-                    err_tomo = ErrorMitigationStateTomo2QProgram(soccfg=self.soccfg, cfg=sscfg)
-                    err_tomo.acquire(self.im[sscfg.aliases.soc], load_pulses=True, progress=False)
+                calib_progs = prebuild_iter(build_calib_prog, [(prep_state,) for prep_state in calib_states])
+                for prep_state, err_tomo in zip(tqdm(calib_states), calib_progs):
+                    err_tomo.acquire(self.im[sscfg_ge.aliases.soc], load_pulses=True, progress=False)
                     calib_prog_dict.update({prep_state:err_tomo})
 
-                g_prog = calib_prog_dict['gg']
-                Ig, Qg = g_prog.get_shots(verbose=False)
-
-                # Get readout angle + threshold for qubits
-                for qi, q in enumerate(sscfg.expt.tomo_qubits):
-                    calib_e_state = 'gg'
-                    calib_e_state = calib_e_state[:qi] + 'e' + calib_e_state[qi+1:]
-                    e_prog = calib_prog_dict[calib_e_state]
-                    Ie, Qe = e_prog.get_shots(verbose=False)
-                    shot_data = dict(Ig=Ig[q], Qg=Qg[q], Ie=Ie[q], Qe=Qe[q])
-                    print(f'Qubit ({q}) ge')
-                    fid, threshold, angle = hist(data=shot_data, plot=True, verbose=False)
-                    thresholds_q[q] = threshold[0]
-                    ge_avgs_q[q] = [np.average(Ig[q]), np.average(Qg[q]), np.average(Ie[q]), np.average(Qe[q])]
-                    angles_q[q] = angle
-                    fids_q[q] = fid[0]
-                    print(f'ge fidelity (%): {100*fid[0]}')
-
-                # Process the shots taken for the confusion matrix with the calibration angles
-                for prep_state in self.calib_order:
-                    counts = calib_prog_dict[prep_state].collect_counts(angle=angles_q, threshold=thresholds_q)
-                    counts_calib.append(counts)
+                if not (provided_ro and provided_avgs):
+                    g_prog = calib_prog_dict['gg']
+                    Ig, Qg = g_prog.get_shots(verbose=False)
+
+                    # Get readout angle + threshold for qubits
+                    shot_data_q = []
+                    for qi, q in enumerate(sscfg_ge.expt.tomo_qubits):
+                        e_prog = calib_prog_dict[calib_ge_states[qi+1]]
+                        Ie, Qe = e_prog.get_shots(verbose=False)
+                        shot_data_q.append(dict(Ig=Ig[q], Qg=Qg[q], Ie=Ie[q], Qe=Qe[q]))
+                        ge_avgs_q[q] = [np.average(Ig[q]), np.average(Qg[q]), np.average(Ie[q]), np.average(Qe[q])]
+                    if plot_calib:
+                        for q, shot_data in zip(sscfg_ge.expt.tomo_qubits, shot_data_q):
+                            print(f'Qubit ({q}) ge')
+                            fid, threshold, angle = hist(data=shot_data, plot=True, verbose=False)
+                            fids_q[q], thresholds_q[q], angles_q[q] = fid[0], threshold[0], angle
+                    else: # all qubits' histograms in one pass
+                        for q, fid, threshold, angle in zip(sscfg_ge.expt.tomo_qubits, *hist_batch(shot_data_q)):
+                            fids_q[q], thresholds_q[q], angles_q[q] = fid, threshold, angle
+                    for q in sscfg_ge.expt.tomo_qubits:
+                        print(f'Qubit ({q}) ge fidelity (%): {100*fids_q[q]}')
+
+                if provided_ro:
+                    angles_q = self.cfg.expt.angles
+                    thresholds_q = self.cfg.expt.thresholds
+                    print('Re-using provided angles, thresholds')
+                if provided_avgs:
+                    ge_avgs_q = np.asarray(self.cfg.expt.ge_avgs)
+                    print('Re-using provided ge_avgs')
+                if provided_counts:
+                    counts_calib = self.cfg.expt.counts_calib
+                    print('Re-using provided counts_calib')
+                else:
+                    # Process the shots taken for the confusion matrix with the calibration angles
+                    for prep_state in self.calib_order:
+                        counts = calib_prog_dict[prep_state].collect_counts(angle=angles_q, threshold=thresholds_q)
+                        counts_calib.append(counts)
 
                 print(f'thresholds={thresholds_q},')
                 print(f'angles={angles_q},')
@@ -1448,57 +1546,38 @@ class SimultaneousRBEgGfExperiment(Experiment):
                 data['angles_loops'].append(angles_q)
                 data['ge_avgs_loops'].append(ge_avgs_q)
                 data['counts_calib_loops'].append(np.array(counts_calib))
+                data['fids_loops'].append(fids_q)
+                if calib_key is not None: self._calib_cache[calib_key] = (thresholds_q, angles_q, ge_avgs_q, counts_calib, fids_q)
 
 
             # ================= #
             # Begin RB
             # ================= #
 
-            if 'shot_avg' not in self.cfg.expt: self.cfg.expt.shot_avg=1
-
-            tomo_analysis = TomoAnalysis(nb_qubits=2)
+            # the next program is built in the background while the current one is acquired
+            rb_prog_iter = prebuild_iter(functools.partial(build_rb_prog, rb_progs, self.cfg), rb_keys)
             for i_depth, depth in enumerate(tqdm(depths, disable=not progress)):
                 # print(f'depth {depth} gate list (last gate is the total gate)')
-                if loop == 0:
-                    data['xpts'].append([])
-                    gate_list_variations[i_depth] = []
                 for var in range(self.cfg.expt.variations):
-                    if loop == 0:
-                        if 'gate_char' in self.cfg.expt and self.cfg.expt.gate_char is not None:
-                            gate_list, total_gate = interleaved_gate_sequence(depth, gate_char=self.cfg.expt.gate_char)
-                        else: gate_list, total_gate = gate_sequence(depth)
-                        gate_list.append(total_gate) # make sure to do the inverse gate
-
-                        # gate_list = ['X', '-X/2,Z', 'Y/2', '-X/2,-Z/2', '-Y/2,Z', '-Z/2', 'X', 'Y']
-                        # gate_list = ['X', 'X', 'I']
-                        # print('variation', var)
-                        # print(gate_list)
-                        # gate_list = ['X/2', 'Z/2', '-Y/2', 'I']
-
-                        gate_list_variations[i_depth].append(gate_list)
-                    else: gate_list = gate_list_variations[i_depth][var]
+                    gate_list = gate_list_variations[i_depth][var]
 
-                    randbench = RBEgGfProgram(soccfg=self.soccfg, cfg=self.cfg, gate_list=gate_list, qubits=self.cfg.expt.qubits, qDrive=self.cfg.expt.qDrive)
+                    randbench = next(rb_prog_iter)
                     # print(randbench)
                     # # from qick.helpers import progs2json
                     # # print(progs2json([randbench.dump_prog()]))
 
                     assert self.cfg.expt.post_process is not None, 'need post processing for RB to make sense!'
-                    popln, popln_err = randbench.acquire_rotated(soc=self.im[self.cfg.aliases.soc], progress=False, angle=angles_q, threshold=thresholds_q, ge_avgs=ge_avgs_q, post_process=self.cfg.expt.post_process)
                     assert self.cfg.expt.post_process == 'threshold', 'Can only bin EgGf RB properly using threshold'
-
-                    adcDrive_ch = self.cfg.hw.soc.adcs.readout.ch[qDrive]
-                    adcNotDrive_ch = self.cfg.hw.soc.adcs.readout.ch[qNotDrive]
+                    # only the binned shots are used, so just acquire and threshold the shots once below (acquire_rotated would threshold them an extra time to average them)
+                    randbench.acquire(self.im[self.cfg.aliases.soc], load_pulses=True, progress=False)
 
                     if self.cfg.expt.post_process == 'threshold':
-                        shots, _ = randbench.get_shots(angle=angles_q, threshold=thresholds_q)
-                        # 00, 01, 10, 11
-                        counts = np.array([tomo_analysis.sort_counts([shots[adcNotDrive_ch], shots[adcDrive_ch]])])
-                        data['counts_raw'][0].append(counts)
+                        shots = randbench.get_threshold_shots(angle=angles_q, threshold=thresholds_q)
+                        # 00, 01, 10, 11 (same order as tomo_analysis.sort_counts([shots[adcNotDrive_ch], shots[adcDrive_ch]]))
+                        counts = np.bincount((shots[adcNotDrive_ch] << 1) | shots[adcDrive_ch], minlength=4)
+                        data['counts_raw'][0, loop, i_depth, var] = counts
                         # print('variation', var, 'gate list', gate_list, 'counts', counts)
 
-                    if loop == 0: data['xpts'][-1].append(depth)
-
             # ================= #
             # Measure the same thing with g/f distinguishing
             # ================= #
@@ -1522,11 +1601,15 @@ class SimultaneousRBEgGfExperiment(Experiment):
                 sscfg.device.readout.frequency[q_measure_f] = sscfg.device.readout.frequency_ef[q_measure_f]
                 sscfg.device.readout.readout_length[q_measure_f] = sscfg.device.readout.readout_length_ef[q_measure_f]
 
-                calib_prog_dict = dict()
-                for prep_state in tqdm(self.calib_order):
+                def build_calib_prog(prep_state):
                     # print(prep_state)
                     sscfg.expt.state_prep_kwargs = dict(prep_state=prep_state, apply_q1_pi2=False)
-                    err_tomo = ErrorMitigationStateTomo2QProgram(soccfg=self.soccfg, cfg=sscfg)
+                    return ErrorMitigationStateTomo2QProgram(soccfg=self.soccfg, cfg=sscfg)
+
+                # the program for the next prep state is built in the background while the current one is acquired
+                calib_prog_dict = dict()
+                calib_progs = prebuild_iter(build_calib_prog, [(prep_state,) for prep_state in self.calib_order])
+                for prep_state, err_tomo in zip(tqdm(self.calib_order), calib_progs):
                     err_tomo.acquire(self.im[sscfg.aliases.soc], load_pulses=True, progress=False)
                     calib_prog_dict.update({prep_state:err_tomo})
 
@@ -1534,19 +1617,24 @@ class SimultaneousRBEgGfExperiment(Experiment):
                 Ig, Qg = g_prog.get_shots(verbose=False)
 
                 # Get readout angle + threshold for qubits to distinguish g/f on one of the qubits
+                shot_data_q = []
                 for qi, q in enumerate(sscfg.expt.tomo_qubits):
                     calib_f_state = 'gg'
                     calib_f_state = calib_f_state[:qi] + f'{"f" if q == q_measure_f else "e"}' + calib_f_state[qi+1:]
                     f_prog = calib_prog_dict[calib_f_state]
                     If, Qf = f_prog.get_shots(verbose=False)
-                    shot_data = dict(Ig=Ig[q], Qg=Qg[q], Ie=If[q], Qe=Qf[q])
-                    print(f'Qubit ({q}){f" gf" if q == q_measure_f else " ge"}')
-                    fid, threshold, angle = hist(data=shot_data, plot=True, verbose=False)
-                    thresholds_f_q[q] = threshold[0]
+                    shot_data_q.append(dict(Ig=Ig[q], Qg=Qg[q], Ie=If[q], Qe=Qf[q]))
                     gf_avgs_q[q] = [np.average(Ig[q]), np.average(Qg[q]), np.average(If[q]), np.average(Qf[q])]
-                    angles_f_q[q] = angle
-                    fids_f_q[q] = fid[0]
-                    print(f'{"gf" if q == q_measure_f else "ge"} fidelity (%): {100*fid[0]}')
+                if plot_calib:
+                    for q, shot_data in zip(sscfg.expt.tomo_qubits, shot_data_q):
+                        print(f'Qubit ({q}){f" gf" if q == q_measure_f else " ge"}')
+                        fid, threshold, angle = hist(data=shot_data, plot=True, verbose=False)
+                        fids_f_q[q], thresholds_f_q[q], angles_f_q[q] = fid[0], threshold[0], angle
+                else: # all qubits' histograms in one pass
+                    for q, fid, threshold, angle in zip(sscfg.expt.tomo_qubits, *hist_batch(shot_data_q)):
+                        fids_f_q[q], thresholds_f_q[q], angles_f_q[q] = fid, threshold, angle
+                for q in sscfg.expt.tomo_qubits:
+                    print(f'Qubit ({q}) {"gf" if q == q_measure_f else "ge"} fidelity (%): {100*fids_f_q[q]}')
 
                 # Process the shots taken for the confusion matrix with the calibration angles
                 for prep_state in self.calib_order:
@@ -1562,39 +1650,35 @@ class SimultaneousRBEgGfExperiment(Experiment):
                 data['angles_f_loops'].append(angles_f_q)
                 data['gf_avgs_loops'].append(gf_avgs_q)
                 data['counts_calib_f_loops'].append(np.array(counts_calib_f))
+                data['fids_f_loops'].append(fids_f_q)
 
                 # ================= #
                 # Begin RB for measure f, using same gate list as measure with g/e
                 # ================= #
 
                 assert q_measure_f == qDrive, 'this code assumes we will be processing to distinguish gf from ge'
+                rb_prog_iter = prebuild_iter(functools.partial(build_rb_prog, rb_progs_f, rbcfg), rb_keys)
                 for i_depth, depth in enumerate(tqdm(depths, disable=not progress)):
                     for var in range(self.cfg.expt.variations):
                         gate_list = gate_list_variations[i_depth][var]
 
-                        rbcfg = deepcopy(self.cfg)
-                        rbcfg.device.readout.frequency[q_measure_f] = rbcfg.device.readout.frequency_ef[q_measure_f]
-                        rbcfg.device.readout.readout_length[q_measure_f] = rbcfg.device.readout.readout_length_ef[q_measure_f]
-
-                        randbench = RBEgGfProgram(soccfg=self.soccfg, cfg=rbcfg, gate_list=gate_list, qubits=self.cfg.expt.qubits, qDrive=self.cfg.expt.qDrive)
+                        randbench = next(rb_prog_iter)
                         # print(randbench)
                         # # from qick.helpers import progs2json
                         # # print(progs2json([randbench.dump_prog()]))
 
                         assert self.cfg.expt.post_process is not None, 'need post processing for RB to make sense!'
-                        popln, popln_err = randbench.acquire_rotated(soc=self.im[self.cfg.aliases.soc], progress=False, angle=angles_f_q, threshold=thresholds_f_q, ge_avgs=gf_avgs_q, post_process=self.cfg.expt.post_process)
                         assert self.cfg.expt.post_process == 'threshold', 'Can only bin EgGf RB properly using threshold'
+                        randbench.acquire(self.im[self.cfg.aliases.soc], load_pulses=True, progress=False)
 
                         if self.cfg.expt.post_process == 'threshold':
-                            shots, _ = randbench.get_shots(angle=angles_f_q, threshold=thresholds_f_q)
+                            shots = randbench.get_threshold_shots(angle=angles_f_q, threshold=thresholds_f_q)
                             # 00, 02, 10, 12
-                            counts = np.array([tomo_analysis.sort_counts([shots[adcNotDrive_ch], shots[adcDrive_ch]])])
-                            data['counts_raw'][1].append(counts)
+                            counts = np.bincount((shots[adcNotDrive_ch] << 1) | shots[adcDrive_ch], minlength=4)
+                            data['counts_raw'][1, loop, i_depth, var] = counts
                             # print('variation', var, 'gate list', gate_list, 'counts', counts)
 
         # print('shape', np.shape(data['counts_raw']))
-        for icounts in range(len(data['counts_raw'])):
-            data['counts_raw'][icounts] = np.reshape(data['counts_raw'][icounts], (self.cfg.expt.loops, len(depths), self.cfg.expt.variations, 4))
 
         for k, a in data.items():
             # print(k)
@@ -1605,7 +1689,13 @@ class SimultaneousRBEgGfExperiment(Experiment):
         self.data=data
         return data
 
-    def analyze(self, data=None, fit=True, **kwargs):
+    def analyze(self, data=None, fit=True, joint_fit=False, correction_method='SLSQP', **kwargs):
+        """
+        joint_fit: fit the subspace and eg decays together with a shared p1 (fitter.fitrb_l1_l2_joint)
+        instead of fixing p1, offset from the subspace fit before fitting the eg decay
+        correction_method: method for TomoAnalysis.correct_readout_err; 'pinv' corrects all sequences at once
+        with the confusion matrix pseudo-inverse instead of a constrained minimization per sequence
+        """
         if data is None:
             data=self.data
 
@@ -1636,15 +1726,16 @@ class SimultaneousRBEgGfExperiment(Experiment):
         # gg, ge, eg, ee, gf, ef
         data['poplns_2q_loops'] = np.zeros(shape=(self.cfg.expt.loops, len(unique_depths), self.cfg.expt.variations, 6))
 
+        tomo_analysis = TomoAnalysis(nb_qubits=2)
         for loop in range(self.cfg.expt.loops):
-            for idepth, depth in enumerate(unique_depths):
-                for ivar in range(self.cfg.expt.variations):
-                    # after correcting readout error, counts corrected should correspond to counts in [gg, ge, eg, ee, gf, ef] (the calib_order)
-                    # instead of [ggA, geA, egA, eeA, ggB, gfB, egB, efB] (the raw counts)
-                    tomo_analysis = TomoAnalysis(nb_qubits=2)
-                    counts_corrected = tomo_analysis.correct_readout_err([data['counts_raw_total'][loop, idepth, ivar]], data['counts_calib_total'][loop])
-                    # counts_corrected = tomo_analysis.fix_neg_counts(counts_corrected)
-                    data['poplns_2q_loops'][loop, idepth, ivar, :] = counts_corrected/np.sum(counts_corrected)
+            # after correcting readout error, counts corrected should correspond to counts in [gg, ge, eg, ee, gf, ef] (the calib_order)
+            # instead of [ggA, geA, egA, eeA, ggB, gfB, egB, efB] (the raw counts)
+            # correct all (depth, variation) rows that share this loop's confusion matrix in one call
+            counts_raw_loop = np.reshape(data['counts_raw_total'][loop], (-1, np.shape(data['counts_raw_total'])[-1]))
+            counts_corrected = tomo_analysis.correct_readout_err(counts_raw_loop, data['counts_calib_total'][loop], method=correction_method)
+            # counts_corrected = tomo_analysis.fix_neg_counts(counts_corrected)
+            counts_corrected /= np.sum(counts_corrected, axis=1, keepdims=True)
+            data['poplns_2q_loops'][loop] = np.reshape(counts_corrected, (len(unique_depths), self.cfg.expt.variations, 6))
 
         data['poplns_2q'] = np.average(data['poplns_2q_loops'], axis=0)
 
@@ -1679,7 +1770,11 @@ class SimultaneousRBEgGfExperiment(Experiment):
 
         if not fit: return data
 
-        popt1, pcov1 = fitter.fitrb(unique_depths, data['popln_subspace_avg'])
+        if joint_fit:
+            popt12, pcov12 = fitter.fitrb_l1_l2_joint(unique_depths, data['popln_subspace_avg'], data['popln_eg_avg'])
+            popt1, pcov1 = popt12[:3], pcov12[:3, :3]
+            popt2, pcov2 = popt12[3:], pcov12[3:, 3:]
+        else: popt1, pcov1 = fitter.fitrb(unique_depths, data['popln_subspace_avg'])
         print('fit1 p1, a, offset', popt1)
         data['fit1'] = popt1
         data['fit1_err'] = pcov1
@@ -1687,7 +1782,7 @@ class SimultaneousRBEgGfExperiment(Experiment):
         data['l1'] = fitter.leakage_err(p1, offset)
         data['l2'] = fitter.seepage_err(p1, offset)
 
-        popt2, pcov2 = fitter.fitrb_l1_l2(unique_depths, data['popln_eg_avg'], p1=p1, offset=offset)
+        if not joint_fit: popt2, pcov2 = fitter.fitrb_l1_l2(unique_depths, data['popln_eg_avg'], p1=p1, offset=offset)
         print('fit2 a0, b0, c0, p2', popt2)
         data['fit2'] = popt2
         data['fit2_err'] = pcov2
@@ -1706,6 +1801,11 @@ class SimultaneousRBEgGfExperiment(Experiment):
         if data is None:
             data=self.data 
 
+        # single shot calibration results stored during acquire (histograms are only plotted in acquire if expt.plot_calib)
+        for key in ['fids_loops', 'fids_f_loops']:
+            if key in data and len(data[key]) > 0:
+                print(f'{"gf" if "_f_" in key else "ge"} calibration fidelities (%) per loop: {(100*np.array(data[key])[:, self.cfg.expt.qubits]).tolist()}')
+
         plt.figure(figsize=(8,6))
         irb = 'gate_char' in self.cfg.expt and self.cfg.expt.gate_char is not None
         title = f'{"Interleaved " + self.cfg.expt.gate_char + " Gate" if irb else ""} EgGf RB on Q{self.cfg.expt.qubits[0]}, Q{self.cfg.expt.qubits[1]}'
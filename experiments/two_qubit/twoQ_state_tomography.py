@@ -1,19 +1,49 @@
+import functools
 import json
-from copy import deepcopy
 
 import matplotlib.pyplot as plt
 import numpy as np
 from experiments.clifford_averager_program import (
     CliffordAveragerProgram,
     QutritAveragerProgram,
+    cfg_json_default,
+    expand_cfg,
+    prebuild_iter,
     rotate_and_threshold,
 )
 from experiments.single_qubit.single_shot import hist
 from qick import *
+from qick.helpers import gauss
 from slab import AttrDict, Experiment, NpEncoder
 from TomoAnalysis import TomoAnalysis
 from tqdm import tqdm_notebook as tqdm
 
+"""
+Encode the states in calib_order (strings like gg, ge, ..., ef) as an int8 array of shape (len(calib_order), num qubits)
+with 0=g, 1=e, 2=f, so the populations of each qubit can be summed with a mask instead of per-character comparisons.
+calib_order should be passed as a tuple so the encoding is only computed once per calib_order.
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def encode_calib_order(calib_order):
+    state_to_int = dict(g=0, e=1, f=2)
+    return np.array([[state_to_int[state] for state in counts_state] for counts_state in calib_order], dtype=np.int8)
+
+
+"""
+qick.helpers.gauss envelope samples (mu, si, length in samples).
+Cached since the same envelopes are added to every program built in a tomography sweep; the returned array is read only.
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def cached_gauss(mu, si, length, maxv):
+    samples = gauss(mu=mu, si=si, length=length, maxv=maxv)
+    samples.setflags(write=False)
+    return samples
+
+
 """
 Infer the populations of the g, e, (and f) states given 1 (2) measurements:
 Obtain counts sorted into bins specified by calib_order.
@@ -75,16 +105,14 @@ def infer_gef_popln(
     counts1 = counts1[0]  # go back to just 1d array
     # print('corrected counts1', counts1)
 
-    tot_counts1 = sum(counts1)
-    for i_counts_state, counts_state in enumerate(calib_order):
-        for i_q, q in enumerate(qubits):
-            # counts_state is a string like xx (2q), xxx (3q) or xxxx (4q)
-            if counts_state[i_q] == "g":
-                gpop_q[q] += counts1[i_counts_state] / tot_counts1
-            else:
-                epop_q[q] += (
-                    counts1[i_counts_state] / tot_counts1
-                )  # this is the final answer if we don't care about distinguishing e/f
+    # counts_state is a string like xx (2q), xxx (3q) or xxxx (4q)
+    is_g = encode_calib_order(tuple(calib_order))[:, : len(qubits)] == 0
+    probs1 = counts1 / np.sum(counts1)
+    gpop1 = probs1 @ is_g
+    epop1 = 1 - gpop1  # all non-g counts; this is the final answer if we don't care about distinguishing e/f
+    for i_q, q in enumerate(qubits):
+        gpop_q[q] = gpop1[i_q]
+        epop_q[q] = epop1[i_q]
 
     if measure_f_qubits is not None and len(measure_f_qubits) > 0:
         # if we care about distinguishing e/f, the "g" popln of the 2nd experiment is the real e popln, and the real f popln is whatever is left
@@ -98,16 +126,11 @@ def infer_gef_popln(
         counts2 = counts2[0]  # go back to just 1d array
         # print('corrected counts2', counts2)
 
-        tot_counts2 = sum(counts2)
-        for i_counts_state, counts_state in enumerate(calib_order):
-            for i_q, q in enumerate(qubits):
-                if q not in measure_f_qubits:
-                    continue
-                if counts_state[i_q] == "g":
-                    epop_q[q] += counts2[i_counts_state] / tot_counts2  # e population shows up as g population
+        gpop2 = (counts2 / np.sum(counts2)) @ is_g
         for i_q, q in enumerate(qubits):
             if q not in measure_f_qubits:
                 continue
+            epop_q[q] = gpop2[i_q]  # e population shows up as g population
             fpop_q[q] = 1 - epop_q[q] - gpop_q[q]
 
     return gpop_q, epop_q, fpop_q
@@ -152,17 +175,16 @@ def infer_gef_popln_2readout(qubits, counts_raw_total, calib_order, counts_calib
         calib_order
     ), f"shape of counts_corrected is {np.shape(counts_corrected)} and shape of calib_order is {np.shape(calib_order)}"
 
+    # counts_state is a string like xx (2q), xxx (3q) or xxxx (4q)
+    calib_states = encode_calib_order(tuple(calib_order))[:, : len(qubits)]
     tot_counts = sum(counts_corrected)
-    for i_counts_state, counts_state in enumerate(calib_order):
-        for i_q, q in enumerate(qubits):
-            # counts_state is a string like xx (2q), xxx (3q) or xxxx (4q)
-            if counts_state[i_q] == "g":
-                gpop_q[q] += counts_corrected[i_counts_state] / tot_counts
-            elif counts_state[i_q] == "e":
-                # print(counts_corrected[i_counts_state], tot_counts, q, counts_state)
-                epop_q[q] += counts_corrected[i_counts_state] / tot_counts
-            else:
-                fpop_q[q] += counts_corrected[i_counts_state] / tot_counts
+    gpop = counts_corrected @ (calib_states == 0) / tot_counts
+    epop = counts_corrected @ (calib_states == 1) / tot_counts
+    fpop = counts_corrected @ (calib_states == 2) / tot_counts
+    for i_q, q in enumerate(qubits):
+        gpop_q[q] = gpop[i_q]
+        epop_q[q] = epop[i_q]
+        fpop_q[q] = fpop[i_q]
 
     return gpop_q, epop_q, fpop_q
 
@@ -227,58 +249,62 @@ class AbstractStateTomo2QProgram(QutritAveragerProgram):
         self.use_gf_readout = None
         if "use_gf_readout" in self.cfg.expt and self.cfg.expt.use_gf_readout:
             self.use_gf_readout = self.cfg.expt.use_gf_readout
+        # adc channels of the tomo qubits (in tomo_qubits order) to pick out their shots in collect_counts
+        self.tomo_adc_chs = None
+        if "tomo_qubits" in self.cfg.expt:
+            self.tomo_adc_chs = np.array([self.adc_chs[q] for q in self.cfg.expt.tomo_qubits])
+        # wait after the final measurement, shared by the 1Q and 2Q bodies
+        self.syncdelay = self.us2cycles(max(self.cfg.device.readout.relax_delay))
 
     def body(self):
         # Collect single shots and measure throughout pulses
-        qubits = self.cfg.expt.tomo_qubits
-        self.basis = self.cfg.expt.basis
+        expt = self.cfg.expt  # resolve the nested cfg attributes once
+        readout = self.cfg.device.readout
+        qubits = expt.tomo_qubits
+        self.basis = expt.basis
 
         self.reset_and_sync()
 
-        if "cool_qubits" in self.cfg.expt and self.cfg.expt.cool_qubits is not None:
-            cool_idle = [self.cfg.device.qubit.pulses.pi_f0g1.idle[q] for q in self.cfg.expt.cool_qubits]
-            if "cool_idle" in self.cfg.expt and self.cfg.expt.cool_idle is not None:
-                cool_idle = self.cfg.expt.cool_idle
-            self.active_cool(cool_qubits=self.cfg.expt.cool_qubits, cool_idle=cool_idle)
+        cool_qubits = expt.get("cool_qubits", None)
+        if cool_qubits is not None:
+            cool_idle = expt.get("cool_idle", None)
+            if cool_idle is None:
+                cool_idle = [self.cfg.device.qubit.pulses.pi_f0g1.idle[q] for q in cool_qubits]
+            self.active_cool(cool_qubits=cool_qubits, cool_idle=cool_idle)
 
         if self.readout_cool:
             self.measure_readout_cool()
 
         # Prep state to characterize
-        if "state_prep_kwargs" not in self.cfg.expt or self.cfg.expt.state_prep_kwargs is None:
+        kwargs = expt.get("state_prep_kwargs", None)
+        if kwargs is None:
             kwargs = dict()
-        else:
-            kwargs = self.cfg.expt.state_prep_kwargs
         self.state_prep_pulse(qubits, **kwargs)
         self.sync_all()  # DO NOT HAVE A WAIT TIME HERE
 
         # Go to the basis for the tomography measurement
-        ZZ_qubit = None
-        if "ZZ_qubit" in self.cfg.expt and self.cfg.expt.ZZ_qubit is not None:
-            ZZ_qubit = self.cfg.expt.ZZ_qubit
+        ZZ_qubit = expt.get("ZZ_qubit", None)
         self.setup_measure(qubit=qubits[0], basis=self.basis[0], ZZ_qubit=ZZ_qubit, play=True)
         self.setup_measure(qubit=qubits[1], basis=self.basis[1], ZZ_qubit=ZZ_qubit, play=True)
 
         # Simultaneous measurement
-        syncdelay = self.us2cycles(max(self.cfg.device.readout.relax_delay))
         self.measure(
             pulse_ch=self.measure_chs,
             adcs=self.adc_chs,
-            adc_trig_offset=self.cfg.device.readout.trig_offset[0],
+            adc_trig_offset=readout.trig_offset[0],
             wait=True,
-            syncdelay=syncdelay,
+            syncdelay=self.syncdelay,
         )
 
     def collect_counts(self, angle=None, threshold=None):
-        shots, _ = self.get_shots(angle=angle, threshold=threshold)
+        shots = self.get_threshold_shots(angle=angle, threshold=threshold)
         # collect shots for all adcs, then sorts into e, g based on >/< threshold and angle rotation
         # shots = np.array([np.heaviside(avgi[i] - threshold[i], 0) for i in range(len(self.adc_chs))])
 
-        qubits = self.cfg.expt.tomo_qubits
         # get the shots for the qubits we care about
-        shots = np.array([shots[self.adc_chs[q]] for q in qubits])
-        tomo_analysis = TomoAnalysis(nb_qubits=2)
-        return tomo_analysis.sort_counts([shots[0], shots[1]])
+        shots = shots[self.tomo_adc_chs]
+        # thresholded shots are 0/1: histogram into 00, 01, 10, 11 (same order as TomoAnalysis.sort_counts)
+        return np.bincount((shots[0] << 1) | shots[1], minlength=4)
 
     # def acquire(self, soc, angle=None, threshold=None, shot_avg=1, load_pulses=True, progress=False):
     #     avgi, avgq = super().acquire(soc, load_pulses=load_pulses, progress=progress)
@@ -342,10 +368,11 @@ class ErrorMitigationStateTomo2QProgram(AbstractStateTomo2QProgram):
 
             if apply_q1_pi2:
                 assert 1 not in qubits
-                freq = (self.f_ge[1, qubits[0]] + self.f_ge[1, qubits[1]]) / 2
+                # ZZ shifted frequencies and pulse params are the (4, 4) arrays already reshaped in initialize
+                freq = (self.f_ges[1, qubits[0]] + self.f_ges[1, qubits[1]]) / 2
                 freq = self.freq2reg(freq, gen_ch=self.qubit_chs[1])
                 waveform = f"pi_ge_ZZ{qubits[0]}_ZZ{qubits[1]}_q1"
-                sigma_cycles = self.us2cycles(self.pi_sigmas_us[1], gen_ch=self.qubit_chs[1])
+                sigma_cycles = self.us2cycles(self.pi_ge_sigmas[1, 1], gen_ch=self.qubit_chs[1])
                 self.add_gauss(
                     ch=self.qubit_chs[1],
                     name=waveform,
@@ -508,15 +535,7 @@ class EgGfStateTomographyExperiment(Experiment):
         num_qubits_sample = len(self.cfg.device.readout.frequency)
         qA, qB = self.cfg.expt.tomo_qubits
 
-        for subcfg in (self.cfg.device.readout, self.cfg.device.qubit, self.cfg.hw.soc):
-            for key, value in subcfg.items():
-                if isinstance(value, dict):
-                    for key2, value2 in value.items():
-                        for key3, value3 in value2.items():
-                            if not (isinstance(value3, list)):
-                                value2.update({key3: [value3] * num_qubits_sample})
-                elif not (isinstance(value, list)):
-                    subcfg.update({key: [value] * num_qubits_sample})
+        expand_cfg(self.cfg, num_qubits_sample)
 
         self.meas_order = ["ZZ", "ZX", "ZY", "XZ", "XX", "XY", "YZ", "YX", "YY"]
         self.calib_order = [
@@ -525,17 +544,28 @@ class EgGfStateTomographyExperiment(Experiment):
             "eg",
             "ee",
         ]  # should match with order of counts for each tomography measurement
-        data = {"counts_tomo": [], "counts_calib": []}
+        # (bases, states) and (prep states, states) matrices, so the readout correction in the analysis
+        # (TomoAnalysis.get_rho_from_counts) corrects all bases in one batched call with the same confusion matrix
+        data = {
+            "counts_tomo": np.zeros((len(self.meas_order), len(self.calib_order)), dtype=np.int64),
+            "counts_calib": np.zeros((len(self.calib_order), len(self.calib_order)), dtype=np.int64),
+        }
         self.pulse_dict = dict()
 
         # Error mitigation measurements: prep in gg, ge, eg, ee to recalibrate measurement angle and measure confusion matrix
-        calib_prog_dict = dict()
-        for prep_state in tqdm(self.calib_order):
+        # only the expt fields are changed for each program (here and by the programs), so just copy expt instead of the whole cfg
+        def build_calib_prog(prep_state):
             # print(prep_state)
-            cfg = AttrDict(deepcopy(self.cfg))
+            cfg = AttrDict(self.cfg)
+            cfg.expt = AttrDict(dict(self.cfg.expt))
             cfg.expt.reps = self.cfg.expt.singleshot_reps
             cfg.expt.state_prep_kwargs = dict(prep_state=prep_state, apply_q1_pi2=cfg.expt.calib_apply_q1_pi2)
-            err_tomo = ErrorMitigationStateTomo2QProgram(soccfg=self.soccfg, cfg=cfg)
+            return ErrorMitigationStateTomo2QProgram(soccfg=self.soccfg, cfg=cfg)
+
+        # the program for the next prep state is built in the background while the current one is acquired
+        calib_prog_dict = dict()
+        calib_progs = prebuild_iter(build_calib_prog, [(prep_state,) for prep_state in self.calib_order])
+        for prep_state, err_tomo in zip(tqdm(self.calib_order), calib_progs):
             err_tomo.acquire(self.im[self.cfg.aliases.soc], load_pulses=True, progress=False)
             calib_prog_dict.update({prep_state: err_tomo})
 
@@ -566,14 +596,14 @@ class EgGfStateTomographyExperiment(Experiment):
         print("angles", angle)
 
         # Process the shots taken for the confusion matrix with the calibration angles
-        for prep_state in self.calib_order:
-            counts = calib_prog_dict[prep_state].collect_counts(angle=angle, threshold=threshold)
-            data["counts_calib"].append(counts)
+        for i_prep, prep_state in enumerate(self.calib_order):
+            data["counts_calib"][i_prep] = calib_prog_dict[prep_state].collect_counts(angle=angle, threshold=threshold)
 
         # Tomography measurements
-        for basis in tqdm(self.meas_order):
+        for i_basis, basis in enumerate(tqdm(self.meas_order)):
             # print(basis)
-            cfg = AttrDict(deepcopy(self.cfg))
+            cfg = AttrDict(self.cfg)
+            cfg.expt = AttrDict(dict(self.cfg.expt))
             cfg.expt.basis = basis
             # assert 'Icontrols' in self.cfg.expt and 'Qcontrols' in self.cfg.expt and 'times_us' in self.cfg.expt
             # cfg.expt.state_prep_kwargs = dict(I_mhz_vs_us=cfg.expt.Icontrols, Q_mhz_vs_us=cfg.expt.Qcontrols, times_us=cfg.expt.times_us)
@@ -599,8 +629,7 @@ class EgGfStateTomographyExperiment(Experiment):
             #     print('q', q, 'avgq', avgq[adc_chs[q]])
             #     print('q', q, 'amps', np.abs(avgi[adc_chs[q]]+1j*avgi[adc_chs[q]]))
 
-            counts = tomo.collect_counts(angle=angle, threshold=threshold)
-            data["counts_tomo"].append(counts)
+            data["counts_tomo"][i_basis] = tomo.collect_counts(angle=angle, threshold=threshold)
             self.pulse_dict.update({basis: tomo.pulse_dict})
 
         self.data = data
@@ -666,6 +695,7 @@ class AbstractStateTomo1QProgram(AbstractStateTomo2QProgram):
         super().initialize()
         assert len(np.shape(self.cfg.expt.qubit)) == 0
         self.qubit = self.cfg.expt.qubit
+        self.adc_ch = self.adc_chs[self.qubit]  # the only adc channel collect_counts thresholds
         self.use_gf_readout = None
         if "use_gf_readout" in self.cfg.expt and self.cfg.expt.use_gf_readout:
             self.use_gf_readout = self.cfg.expt.use_gf_readout
@@ -692,27 +722,25 @@ class AbstractStateTomo1QProgram(AbstractStateTomo2QProgram):
         self.state_prep_pulse(**kwargs)
         self.sync_all()  # DO NOT HAVE A WAIT TIME HERE
 
-        # Go to the basis for the tomography measurement
+        # Go to the basis for the tomography measurement (setup_measure syncs after the pulse)
         self.setup_measure(basis=self.basis[0], play=True)
-        self.sync_all()
 
         # Simultaneous measurement
-        syncdelay = self.us2cycles(max(self.cfg.device.readout.relax_delay))
         self.measure(
             pulse_ch=self.measure_chs,
             adcs=self.adc_chs,
             adc_trig_offset=self.cfg.device.readout.trig_offset[0],
             wait=True,
-            syncdelay=syncdelay,
+            syncdelay=self.syncdelay,
         )
 
     def collect_counts(self, angle=None, threshold=None):
-        ishots, _ = self.get_shots(angle=angle, threshold=threshold)
-        # get the shots for the qubits we care about
-        shots = ishots[self.adc_chs[self.qubit]]
+        # only rotate and threshold the final readout shots for the qubit we care about: e if > threshold
+        shots, _ = self.get_shots(angle=angle, threshold=threshold, channels=[self.adc_ch])
 
-        tomo_analysis = TomoAnalysis(nb_qubits=1)
-        return tomo_analysis.sort_counts([shots])
+        # counts in g, e (same order as TomoAnalysis.sort_counts)
+        n_e = np.count_nonzero(shots)
+        return np.array([shots.size - n_e, n_e], dtype=np.int64)
 
 
 # ===================================================================== #
@@ -763,37 +791,52 @@ class StateTomo1QProgram(AbstractStateTomo1QProgram):
     )
     """
 
+    def add_gauss_cached(self, ch, name, sigma, length):
+        # same as add_gauss (sigma, length in clock cycles), but reuses the gauss samples computed by previous programs
+        gencfg = self.soccfg["gens"][ch]
+        maxv = gencfg["maxv"] * gencfg["maxv_scale"]  # the default maxv add_gauss uses
+        length = int(np.round(length)) * gencfg["samps_per_clk"]
+        sigma = sigma * gencfg["samps_per_clk"]
+        self.add_pulse(ch=ch, name=name, idata=cached_gauss(mu=length / 2 - 0.5, si=sigma, length=length, maxv=maxv))
+
+    def _emit_gauss_pulse(self, ch, freq_reg, phase, gain, sigma_us, waveform):
+        self.setup_and_pulse(
+            ch=ch,
+            style="arb",
+            freq=freq_reg,
+            phase=phase,
+            gain=gain,
+            waveform=waveform,
+        )
+
+    def _emit_flat_top_pulse(self, ch, freq_reg, phase, gain, sigma_us, waveform):
+        sigma_ramp_cycles = 3
+        flat_length_cycles = self.us2cycles(sigma_us, gen_ch=ch) - sigma_ramp_cycles * 4
+        self.setup_and_pulse(
+            ch=ch,
+            style="flat_top",
+            freq=freq_reg,
+            phase=phase,
+            gain=gain,
+            length=flat_length_cycles,
+            waveform=f"{waveform}_ramp",
+        )
+
+    def _emit_const_pulse(self, ch, freq_reg, phase, gain, sigma_us, waveform):
+        self.setup_and_pulse(
+            ch=ch,
+            style="const",
+            freq=freq_reg,
+            phase=phase,
+            gain=gain,
+            length=self.us2cycles(sigma_us, gen_ch=ch),
+        )
+
     def handle_next_pulse(self, count_us, ch, freq_reg, type, phase, gain, sigma_us, waveform):
-        if type == "gauss":
-            self.setup_and_pulse(
-                ch=ch,
-                style="arb",
-                freq=freq_reg,
-                phase=phase,
-                gain=gain,
-                waveform=waveform,
-            )
-        elif type == "flat_top":
-            sigma_ramp_cycles = 3
-            flat_length_cycles = self.us2cycles(sigma_us, gen_ch=ch) - sigma_ramp_cycles * 4
-            self.setup_and_pulse(
-                ch=ch,
-                style="flat_top",
-                freq=freq_reg,
-                phase=phase,
-                gain=gain,
-                length=flat_length_cycles,
-                waveform=f"{waveform}_ramp",
-            )
-        elif type == "const":
-            self.setup_and_pulse(
-                ch=ch,
-                style="const",
-                freq=freq_reg,
-                phase=phase,
-                gain=gain,
-                length=self.us2cycles(sigma_us, gen_ch=ch),
-            )
+        # pulse types other than gauss, flat_top, const are not played
+        emit_pulse = self.next_pulse_handlers.get(type)
+        if emit_pulse is not None:
+            emit_pulse(ch=ch, freq_reg=freq_reg, phase=phase, gain=gain, sigma_us=sigma_us, waveform=waveform)
 
     def state_prep_pulse(self, **kwargs):
         cfg = self.cfg
@@ -802,39 +845,56 @@ class StateTomo1QProgram(AbstractStateTomo1QProgram):
         # self.Y_pulse(q=1, play=True)
         # self.Y_pulse(q=1, special='pulseiq', play=True, **kwargs)
 
-        self.X_pulse(q=0, play=True, pihalf=True)
+        # all on q0's channel so the pulses already play back to back, body syncs after state prep
+        self.X_pulse(q=0, play=True, pihalf=True, sync_after=False)
         self.Z_pulse(q=0, play=True, pihalf=True)
-        self.Y_pulse(q=0, play=True, pihalf=True, neg=True)
+        self.Y_pulse(q=0, play=True, pihalf=True, neg=True, sync_after=False)
 
     def initialize(self):
         super().initialize()
         if "state_prep_kwargs" not in self.cfg.expt:
             self.cfg.expt.state_prep_kwargs = None
+        self.next_pulse_handlers = dict(
+            gauss=self._emit_gauss_pulse,
+            flat_top=self._emit_flat_top_pulse,
+            const=self._emit_const_pulse,
+        )
         self.swap_chs = self.cfg.hw.soc.dacs.swap.ch
         self.swap_ch_types = self.cfg.hw.soc.dacs.swap.type
-        self.f_EgGf_regs = [self.freq2reg(f, gen_ch=ch) for f, ch in zip(self.cfg.device.qubit.f_EgGf, self.swap_chs)]
+        # the swaps are between q1 and the other qubits, so there is no q1 entry (left as 0)
+        self.f_EgGf_regs = np.array(
+            [
+                0 if q == 1 else self.freq2reg(f, gen_ch=ch)
+                for q, (f, ch) in enumerate(zip(self.cfg.device.qubit.f_EgGf, self.swap_chs))
+            ],
+            dtype=int,
+        )
 
         self.swap_Q_chs = self.cfg.hw.soc.dacs.swap_Q.ch
         self.swap_Q_ch_types = self.cfg.hw.soc.dacs.swap_Q.type
-        self.f_EgGf_Q_regs = [
-            self.freq2reg(f, gen_ch=ch) for f, ch in zip(self.cfg.device.qubit.f_EgGf_Q, self.swap_chs)
-        ]
+        self.f_EgGf_Q_regs = np.array(
+            [
+                0 if q == 1 else self.freq2reg(f, gen_ch=ch)
+                for q, (f, ch) in enumerate(zip(self.cfg.device.qubit.f_EgGf_Q, self.swap_chs))
+            ],
+            dtype=int,
+        )
 
         # get aliases for the sigmas we need in clock cycles
         self.pi_EgGf_types = self.cfg.device.qubit.pulses.pi_EgGf.type
-        assert all(type == "flat_top" for type in self.pi_EgGf_types)
+        assert np.all(np.asarray(self.pi_EgGf_types) == "flat_top")
         self.pi_EgGf_sigmas_us = self.cfg.device.qubit.pulses.pi_EgGf.sigma
 
         self.pi_EgGf_Q_types = self.cfg.device.qubit.pulses.pi_EgGf_Q.type
-        assert all(type == "flat_top" for type in self.pi_EgGf_Q_types)
+        assert np.all(np.asarray(self.pi_EgGf_Q_types) == "flat_top")
         self.pi_EgGf_Q_sigmas_us = self.cfg.device.qubit.pulses.pi_EgGf_Q.sigma
 
-        # add qubit pulses to respective channels
+        # add qubit pulses to respective channels (the envelope samples are shared with the programs for the other bases)
         for q in range(4):
             if q != 1:
                 if self.pi_EgGf_types[q] == "gauss":
                     pi_EgGf_sigma_cycles = self.us2cycles(self.pi_EgGf_sigmas_us[q], gen_ch=self.swap_chs[1])
-                    self.add_gauss(
+                    self.add_gauss_cached(
                         ch=self.swap_chs[q],
                         name=f"pi_EgGf_swap{q}",
                         sigma=pi_EgGf_sigma_cycles,
@@ -842,7 +902,7 @@ class StateTomo1QProgram(AbstractStateTomo1QProgram):
                     )
                 elif self.pi_EgGf_types[q] == "flat_top":
                     sigma_ramp_cycles = 3
-                    self.add_gauss(
+                    self.add_gauss_cached(
                         ch=self.swap_chs[q],
                         name=f"pi_EgGf_swap{q}_ramp",
                         sigma=sigma_ramp_cycles,
@@ -851,7 +911,7 @@ class StateTomo1QProgram(AbstractStateTomo1QProgram):
 
                 if self.pi_EgGf_Q_types[q] == "flat_top":
                     sigma_ramp_cycles = 3
-                    self.add_gauss(
+                    self.add_gauss_cached(
                         ch=self.swap_Q_chs[q],
                         name=f"pi_EgGf_Q_swap{q}_ramp",
                         sigma=sigma_ramp_cycles,
@@ -873,6 +933,7 @@ class StateTomography1QExperiment(Experiment):
     expt = dict(
         reps: number averages per measurement basis iteration
         singleshot_reps: number averages in single shot calibration
+        reuse_progs: if True (default), reuse the programs built by a previous acquire with an identical program cfg
     )
     """
 
@@ -891,21 +952,31 @@ class StateTomography1QExperiment(Experiment):
             config_file=config_file,
             progress=progress,
         )
+        # (program class name, program cfg json) -> program, used if expt.reuse_progs
+        # only the programs used by the latest acquire are kept, so stale programs (and their buffers) are released
+        self._prog_cache = dict()
+        self._prog_cache_used = dict()
+
+    def build_prog(self, prog_class, cfg):
+        """
+        Construct prog_class with cfg, or return the program built by the previous acquire with an identical cfg.
+        threshold and angle only enter through collect_counts, so the program itself is fully determined by cfg.
+        """
+        if not self.cfg.expt.get("reuse_progs", True):
+            return prog_class(soccfg=self.soccfg, cfg=cfg)
+        key = (prog_class.__name__, json.dumps(cfg, sort_keys=True, default=cfg_json_default))
+        prog = self._prog_cache.get(key)
+        if prog is None:
+            prog = prog_class(soccfg=self.soccfg, cfg=cfg)
+        self._prog_cache_used[key] = prog
+        return prog
 
     def acquire(self, progress=False):
         # expand entries in config that are length 1 to fill all qubits
         num_qubits_sample = len(self.cfg.device.readout.frequency)
         q = self.cfg.expt.qubit
 
-        for subcfg in (self.cfg.device.readout, self.cfg.device.qubit, self.cfg.hw.soc):
-            for key, value in subcfg.items():
-                if isinstance(value, dict):
-                    for key2, value2 in value.items():
-                        for key3, value3 in value2.items():
-                            if not (isinstance(value3, list)):
-                                value2.update({key3: [value3] * num_qubits_sample})
-                elif not (isinstance(value, list)):
-                    subcfg.update({key: [value] * num_qubits_sample})
+        expand_cfg(self.cfg, num_qubits_sample)
 
         self.meas_order = ["Z", "X", "Y"]
         self.calib_order = [
@@ -913,30 +984,57 @@ class StateTomography1QExperiment(Experiment):
             "e",
         ]  # should match with order of counts for each tomography measurement
         data = {"counts_tomo": [], "counts_calib": []}
+        self._prog_cache_used = dict()
         self.pulse_dict = dict()
 
         # Error mitigation measurements: prep in g, e to recalibrate measurement angle and measure confusion matrix
-        calib_prog_dict = dict()
-        for prep_state in tqdm(self.calib_order):
+        # only the expt fields are changed for each program (here and by the programs), so just copy expt instead of the whole cfg
+        def build_calib_prog(prep_state):
             # print(prep_state)
-            cfg = AttrDict(deepcopy(self.cfg))
+            cfg = AttrDict(self.cfg)
+            cfg.expt = AttrDict(dict(self.cfg.expt))
             cfg.expt.reps = self.cfg.expt.singleshot_reps
             cfg.expt.state_prep_kwargs = dict(prep_state=prep_state)
-            err_tomo = ErrorMitigationStateTomo1QProgram(soccfg=self.soccfg, cfg=cfg)
-            err_tomo.acquire(self.im[self.cfg.aliases.soc], load_pulses=True, progress=False)
-            calib_prog_dict.update({prep_state: err_tomo})
+            return self.build_prog(ErrorMitigationStateTomo1QProgram, cfg)
+
+        # Tomography measurements
+        # each basis stays a separate program: setup_measure registers (reloads) a different pre-measurement envelope
+        # per basis, so the programs do not share an envelope layout; construction is overlapped/cached instead
+        def build_tomo_prog(basis):
+            # print(basis)
+            cfg = AttrDict(self.cfg)
+            cfg.expt = AttrDict(dict(self.cfg.expt))
+            cfg.expt.basis = basis
+            if "Icontrols" in cfg.expt and "Qcontrols" in cfg.expt and "times_us" in self.cfg.expt:
+                cfg.expt.state_prep_kwargs = dict(
+                    I_mhz_vs_us=cfg.expt.Icontrols,
+                    Q_mhz_vs_us=cfg.expt.Qcontrols,
+                    times_us=cfg.expt.times_us,
+                )
+            return self.build_prog(StateTomo1QProgram, cfg)
+
+        # the tomography programs don't depend on the calibration, so acquire all programs back to back as one batch
+        # (the next program is built in the background while the current one is acquired) and process the shots after
+        batch = [(build_calib_prog, prep_state) for prep_state in self.calib_order]
+        batch += [(build_tomo_prog, basis) for basis in self.meas_order]
+        progs = []
+        for prog in tqdm(prebuild_iter(lambda build, key: build(key), batch), total=len(batch)):
+            prog.acquire(self.im[self.cfg.aliases.soc], load_pulses=True, progress=False)
+            progs.append(prog)
+        # keep only this acquire's programs for the next one
+        self._prog_cache, self._prog_cache_used = self._prog_cache_used, dict()
+        calib_prog_dict = dict(zip(self.calib_order, progs[: len(self.calib_order)]))
+        tomo_progs = progs[len(self.calib_order) :]
 
-        g_prog = calib_prog_dict["g"]
-        Ig, Qg = g_prog.get_shots(verbose=False)
         threshold = [0] * num_qubits_sample
         angle = [0] * num_qubits_sample
 
-        # Get readout angle + threshold for qubit
-        e_prog = calib_prog_dict["e"]
-        Ie, Qe = e_prog.get_shots(verbose=False)
-        shot_data = dict(Ig=Ig[q], Qg=Qg[q], Ie=Ie[q], Qe=Qe[q])
+        # Get readout angle + threshold for qubit, only the qubit's channel is needed from the g/e shots
+        Ig, Qg = calib_prog_dict["g"].get_shots(verbose=False, channels=[q])
+        Ie, Qe = calib_prog_dict["e"].get_shots(verbose=False, channels=[q])
+        shot_data = dict(Ig=Ig[0], Qg=Qg[0], Ie=Ie[0], Qe=Qe[0])
         fid, thresholdq, angleq = hist(data=shot_data, plot=progress, verbose=False)
-        threshold[q] = thresholdq
+        threshold[q] = thresholdq[0]  # ge threshold as a scalar
         angle[q] = angleq
 
         if progress:
@@ -948,20 +1046,8 @@ class StateTomography1QExperiment(Experiment):
             counts = calib_prog_dict[prep_state].collect_counts(angle=angle, threshold=threshold)
             data["counts_calib"].append(counts)
 
-        # Tomography measurements
-        for basis in tqdm(self.meas_order):
-            # print(basis)
-            cfg = AttrDict(deepcopy(self.cfg))
-            cfg.expt.basis = basis
-            if "Icontrols" in cfg.expt and "Qcontrols" in cfg.expt and "times_us" in self.cfg.expt:
-                cfg.expt.state_prep_kwargs = dict(
-                    I_mhz_vs_us=cfg.expt.Icontrols,
-                    Q_mhz_vs_us=cfg.expt.Qcontrols,
-                    times_us=cfg.expt.times_us,
-                )
-            tomo = StateTomo1QProgram(soccfg=self.soccfg, cfg=cfg)
+        for basis, tomo in zip(self.meas_order, tomo_progs):
             # print(tomo)
-            tomo.acquire(self.im[self.cfg.aliases.soc], load_pulses=True, progress=False)
             counts = tomo.collect_counts(angle=angle, threshold=threshold)
             data["counts_tomo"].append(counts)
             self.pulse_dict.update({basis: tomo.pulse_dict})
@@ -985,6 +1071,8 @@ class StateTomography1QExperiment(Experiment):
         super().save_data(data=data)
         # print(self.pulse_dict)
         with self.datafile() as f:
+            # kept as the full basis -> pulse name -> pulse params dict (not deduplicated across bases) since the
+            # analysis notebooks load it directly for get_evol_mats
             f.attrs["pulse_dict"] = json.dumps(self.pulse_dict, cls=NpEncoder)
             f.attrs["meas_order"] = json.dumps(self.meas_order, cls=NpEncoder)
             f.attrs["calib_order"] = json.dumps(self.calib_order, cls=NpEncoder)
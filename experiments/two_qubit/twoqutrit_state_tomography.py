@@ -90,8 +90,10 @@ class AbstractStateTomo2qutritProgram(QutritAveragerProgram):
             avgi.append(new_bufi_ch)
         avgi = np.array(avgi)
         assert threshold_ef > threshold_ge
-        shots_cut_ge = np.array([np.heaviside(avgi[i]/self.ro_chs[ch].length-threshold_ge[i], 0) for i, ch in enumerate(self.ro_chs)])
-        shots_cut_ef = np.array([np.heaviside(avgi[i]/self.ro_chs[ch].length-threshold_ef[i], 0) for i, ch in enumerate(self.ro_chs)])
+        n_chs = len(self.ro_chs)
+        avgi = avgi / np.array([self.ro_chs[ch].length for ch in self.ro_chs])[:, np.newaxis]
+        shots_cut_ge = np.heaviside(avgi - np.asarray(threshold_ge, dtype=float)[:n_chs, np.newaxis], 0)
+        shots_cut_ef = np.heaviside(avgi - np.asarray(threshold_ef, dtype=float)[:n_chs, np.newaxis], 0)
         shots = shots_cut_ge + shots_cut_ef # 0, 1, or 2 depending on the measured state
 
         qubits = self.cfg.expt.qubits